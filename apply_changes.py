@@ -0,0 +1,219 @@
+"""
+This script applies an OsmChange file (.osc or .osc.gz), e.g. a daily diff,
+to a collection previously created by the import.py script.
+
+The geometries of changed ways are resolved from the node documents of the collection,
+together with the nodes of the change file, and stored ways whose nodes were changed
+get their geometries resolved again.
+"""
+
+import os
+import time
+
+from argparse import ArgumentParser
+from collections import Counter
+from typing import Optional, Set
+
+import bson
+from tqdm import tqdm
+import pymongo
+from pymongo.collection import Collection
+from data_wrangling.xml_processing import open_and_parse
+from data_wrangling.auditing import address_audit
+from data_wrangling.query_cache import bump_generation
+from data_wrangling.importing import BulkWriter, elem_to_doc, load_region_assigner, is_empty, create_indexes
+from data_wrangling.importing import StoredLocations, way_geometry
+from data_wrangling.importing import ImportStatistics, DEFAULT_VALUE_KEYS, AddressIndex, ensure_tag_tokens
+
+ACTIONS = {'create', 'modify', 'delete'}
+ELEMENT_TAGS = {'node', 'way', 'relation'}
+
+
+def validate_osc_version(events):
+    ev, el = next(events)
+    assert el.tag == 'osmChange', 'The specified file is not an OsmChange file.'
+    assert 'version' in el.attrib and el.attrib['version'] == '0.6', 'Unknown version of the OsmChange format.'
+
+
+auto_audit = [
+    address_audit()
+]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('file', help='The OsmChange file to apply.')
+    parser.add_argument('--connection', default='mongodb://localhost:27017/dand',
+                        help='The MongoDB connection string.')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='The number of changes to send per bulk write.')
+    parser.add_argument('--no-regions', action='store_true',
+                        help='Do not assign the district and Bezirksregion to nodes.')
+    parser.add_argument('--stats-keys', default=','.join(DEFAULT_VALUE_KEYS),
+                        help='The comma-separated tag keys whose values are counted in the statistics collection.')
+    parser.add_argument('--no-stats', action='store_true',
+                        help='Do not maintain the statistics collection.')
+    parser.add_argument('--no-addresses', action='store_true',
+                        help='Do not maintain the address collection used for reverse geocoding.')
+    parser.add_argument('--no-geometry', action='store_true',
+                        help='Do not resolve the geometries of changed ways.')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file) or not os.path.isfile(args.file):
+        parser.error(f'The specified argument is not a valid file: {args.file}')
+        exit(1)
+    if args.batch_size < 1:
+        parser.error('The batch size must be positive.')
+        exit(1)
+
+    client = pymongo.MongoClient(args.connection)
+    database = client.get_default_database()
+    collection = database.get_collection('osm_berlin')
+
+    regions = None
+    if not args.no_regions:
+        try:
+            regions = load_region_assigner()
+        except (ImportError, OSError, ValueError, KeyError) as e:
+            print(f'The district boundaries could not be loaded ({e}); changes are applied without districts.')
+
+    # Collections imported by earlier versions may lack indexes the changes rely on, e.g. the one on way nodes.
+    create_indexes(collection)
+    empty = is_empty(collection)
+    ensure_tag_tokens(collection, empty, batch_size=args.batch_size)
+    statistics = None
+    if not args.no_stats:
+        statistics = ImportStatistics(collection, [key for key in args.stats_keys.split(',') if len(key) > 0])
+        statistics.begin(empty)
+    addresses = None
+    if not args.no_addresses:
+        addresses = AddressIndex(collection, batch_size=args.batch_size)
+        addresses.begin(empty)
+
+    # Cached query results are invalidated as soon as the data starts to change, and again once it is complete.
+    bump_generation(database, collection.name)
+
+    locations = StoredLocations(collection) if not args.no_geometry else None
+
+    progress = tqdm()
+    start = time.perf_counter()
+
+    # Modified elements are complete in the change file, so they replace the
+    # stored documents; otherwise, removed tags would be kept.
+    with BulkWriter(collection, batch_size=args.batch_size, upsert=True, replace=True,
+                    geo_fields=('geometry', 'bbox') if locations is not None else (),
+                    prepare=regions, statistics=statistics, addresses=addresses, log=tqdm.write) as writer:
+        changes = apply_changes(args.file, writer, progress, locations)
+        if locations is not None:
+            changes['geometry'] = update_way_geometries(collection, writer, locations, changes.ways)
+    if statistics is not None:
+        statistics.finish()
+    if addresses is not None:
+        addresses.finish()
+    bump_generation(database, collection.name)
+
+    elapsed = time.perf_counter() - start
+
+    progress.close()
+    print('Audit summary:')
+    for audit in auto_audit:
+        print('- ' + str(audit))
+    print('Change summary:')
+    for action in ('create', 'modify', 'delete'):
+        print(f'- {action}: {changes[action]} elements')
+    if locations is not None:
+        print(f'- geometries resolved again: {changes["geometry"]} ways')
+    print(f'- {writer}')
+    print(f'- {elapsed:.1f} s total, {writer.write_time:.1f} s writing')
+
+
+class Changes(Counter):
+    """
+    The number of changed elements per action, along with the IDs of the changed ways.
+    """
+    def __init__(self):
+        super().__init__()
+        self.ways = set()  # type: Set[int]
+
+
+def apply_changes(filename: str, writer: BulkWriter, progress: tqdm,
+                  locations: Optional[StoredLocations] = None) -> Changes:
+    """
+    Applies the changes of an OsmChange file.
+    :param filename: The OsmChange file.
+    :param writer: The writer to apply the changes with.
+    :param progress: The progress bar.
+    :param locations: If given, the locations of the changed nodes are recorded in it
+                      and the geometries of created and modified ways are resolved with it.
+    :return: The number of changed elements per action.
+    """
+    events = open_and_parse(filename, events=('start', 'end'), progress=progress)
+    validate_osc_version(events)
+
+    changes = Changes()
+    action = None
+    for ev, el in events:
+        if el.tag in ACTIONS:
+            action = el if ev == 'start' else None
+            continue
+        # Elements are only complete at their end event.
+        if ev != 'end' or el.tag not in ELEMENT_TAGS:
+            continue
+        assert action is not None, f'Found a {el.tag} outside of a change block.'
+
+        changes[action.tag] += 1
+        if el.tag == 'way':
+            changes.ways.add(int(el.attrib['id']))
+        if locations is not None and el.tag == 'node':
+            if action.tag == 'delete':
+                locations.delete(int(el.attrib['id']))
+            else:
+                locations.add(int(el.attrib['id']), el.attrib['lat'], el.attrib['lon'])
+        if action.tag == 'delete':
+            writer.delete({'type': el.tag, 'id': bson.Int64(el.attrib['id'])})
+        else:
+            for audit in auto_audit:
+                el = audit(el)
+                if el is None:
+                    break
+            if el is not None:
+                id, doc = elem_to_doc(el, locations)
+                writer.add(id, doc)
+
+        # The change block is detached from the root once it started,
+        # so its processed elements have to be released explicitly.
+        action.clear()
+
+    return changes
+
+
+def update_way_geometries(collection: Collection, writer: BulkWriter,
+                          locations: StoredLocations, changed_ways: Set[int]) -> int:
+    """
+    Resolves the geometries of stored ways again whose nodes were changed, e.g. moved, but which
+    were not changed themselves.
+    :param collection: The collection the changes were applied to.
+    :param writer: The writer to apply the changes with.
+    :param locations: The locations the changes were applied with.
+    :param changed_ways: The IDs of the ways in the change file, whose geometries are up to date.
+    :return: The number of ways whose geometry was resolved again.
+    """
+    nodes = [bson.Int64(id) for id in locations.changed]
+    if len(nodes) == 0:
+        return 0
+    # The affected ways are read completely before they are written, so that the cursor does not see them again.
+    docs = [doc for doc in collection.find({'_id.type': 'way', 'nodes': {'$in': nodes}})
+            if doc['_id']['id'] not in changed_ways]
+    for doc in docs:
+        id = doc.pop('_id')
+        doc.pop('geometry', None)
+        doc.pop('bbox', None)
+        geometry = way_geometry(doc['nodes'], doc.get('tags', {}), locations)
+        if geometry is not None:
+            doc['geometry'], doc['bbox'] = geometry
+        writer.add(id, doc)
+    return len(docs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+This script benchmarks the decompression, parsing, auditing, conversion and writing of an extract,
+as well as the query helpers, on the extract itself and on synthetic extracts scaled up from it.
+The results are written as JSON and can be compared against a baseline to detect regressions.
+"""
+
+import os
+import json
+
+from argparse import ArgumentParser
+
+import pymongo
+from data_wrangling.benchmarking import BENCHMARK_VERSION, DEFAULT_REPEAT, DEFAULT_CHUNK_SIZE, BenchmarkException, \
+    synthesize_extract, run_benchmark, environment_info, compare_results
+from data_wrangling.importing import load_region_assigner
+from supplemental import get_district_geojson
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('file', nargs='?',
+                        default=os.path.join('osm-extracts', 'berlin-mitte.osm.bz2'),
+                        help='The OSM map file to benchmark.')
+    parser.add_argument('--scales', default='1',
+                        help='The comma-separated scales of the benchmarked extracts; scales above 1 '
+                             'use synthetic extracts containing each element of the file that many times.')
+    parser.add_argument('--synthetic-dir', default=os.path.join('osm-extracts', 'synthetic'),
+                        help='The directory to keep the synthetic extracts in.')
+    parser.add_argument('--connection', default='mongodb://localhost:27017/dand_benchmark',
+                        help='The MongoDB connection string; the collection osm_berlin of its database is replaced.')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Write to an in-process stand-in for MongoDB (requires the mongomock package) '
+                             'instead of a server.')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='The number of runs of each stage; the median time is reported.')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='The number of documents to send per bulk write.')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='The number of elements passed through the import stages at once.')
+    parser.add_argument('--no-regions', action='store_true',
+                        help='Do not assign districts during the writes and skip the per-district queries.')
+    parser.add_argument('--no-queries', action='store_true',
+                        help='Only benchmark the import stages.')
+    parser.add_argument('--out', default='benchmark.json',
+                        help='The file to write the results to.')
+    parser.add_argument('--baseline', default=None,
+                        help='Results of an earlier run to compare against; regressions make the script fail.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='The relative slowdown against the baseline that is tolerated.')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file) or not os.path.isfile(args.file):
+        parser.error(f'The specified argument is not a valid file: {args.file}')
+        exit(1)
+    try:
+        scales = sorted({int(scale) for scale in args.scales.split(',')})
+    except ValueError:
+        scales = []
+    if len(scales) == 0 or scales[0] < 1:
+        parser.error('The scales must be positive integers.')
+        exit(1)
+    if args.repeat < 1 or args.batch_size < 1 or args.chunk_size < 1:
+        parser.error('The number of runs, the batch size and the chunk size must be positive.')
+        exit(1)
+    if args.baseline is not None and not os.path.isfile(args.baseline):
+        parser.error(f'The specified baseline is not a valid file: {args.baseline}')
+        exit(1)
+
+    if args.in_process:
+        try:
+            import mongomock
+        except ImportError:
+            parser.error('The in-process stand-in requires the mongomock package.')
+            exit(1)
+        client = mongomock.MongoClient(args.connection)
+    else:
+        client = pymongo.MongoClient(args.connection)
+    collection = client.get_default_database().get_collection('osm_berlin')
+
+    regions, districts = None, None
+    if not args.no_regions:
+        try:
+            regions = load_region_assigner()
+            districts = get_district_geojson()
+        except (OSError, ValueError, KeyError) as e:
+            print(f'The district boundaries could not be loaded ({e}); benchmarking without districts.')
+
+    results = {'version': BENCHMARK_VERSION, 'environment': environment_info(),
+               'backend': 'mongomock' if args.in_process else 'mongodb', 'extracts': []}
+    for scale in scales:
+        filename = args.file
+        if scale > 1:
+            os.makedirs(args.synthetic_dir, exist_ok=True)
+            name = os.path.basename(args.file).split('.')[0]
+            filename = os.path.join(args.synthetic_dir, f'{name}-x{scale}.osm.bz2')
+            if not os.path.isfile(filename) or os.path.getmtime(filename) < os.path.getmtime(args.file):
+                print(f'Synthesizing {filename}')
+                synthesize_extract(args.file, filename, scale)
+        extract = run_benchmark(filename, collection, repeat=args.repeat, batch_size=args.batch_size,
+                                chunk_size=args.chunk_size, regions=regions, districts=districts,
+                                run_queries=not args.no_queries)
+        extract['scale'] = scale
+        results['extracts'].append(extract)
+        print_extract(extract)
+
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.out}')
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        try:
+            regressions = compare_results(baseline, results, tolerance=args.tolerance)
+        except BenchmarkException as e:
+            parser.error(str(e))
+            exit(1)
+        for name, before, after in regressions:
+            print(f'Regression in {name}: {before:.4f} s -> {after:.4f} s ({after / before - 1:+.0%})')
+        if len(regressions) > 0:
+            exit(1)
+        print(f'No regressions against {args.baseline}.')
+
+
+def print_extract(extract):
+    print(f'x{extract["scale"]}: {extract["elements"]} elements, {extract["bytes"]} bytes')
+    for name, result in extract['stages'].items():
+        print(f'- {name:>30}: {result["seconds"]:8.3f} s, {result["rate"]:.0f} {result["unit"]}/s')
+    for name, result in extract['queries'].items():
+        if 'error' in result:
+            print(f'- {name:>30}: not supported ({result["error"]})')
+        else:
+            print(f'- {name:>30}: {result["seconds"] * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
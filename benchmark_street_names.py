@@ -0,0 +1,107 @@
+"""
+This script compares the compiled street name rules against the original implementation
+that evaluated every regular expression separately. It uses a text file of row-wise
+street names that can be generated by the collect_street_names.py script.
+"""
+
+import os
+import time
+
+from argparse import ArgumentParser
+from typing import Callable, List, Optional, Tuple
+
+from data_wrangling.auditing import audit_street_name
+from data_wrangling.auditing.streets import valid_street_names, known_valids, not_a_road, known_corrections
+
+
+def legacy_audit_street_name(name: str) -> Tuple[bool, Optional[str]]:
+    """
+    The original implementation of audit_street_name.
+    """
+    assert isinstance(name, str) and not name.endswith(os.linesep)
+
+    name = name.strip()
+    original_name = name
+
+    if name in known_valids:
+        return True, name
+    elif len(name) == 0:
+        return False, None
+    elif name in not_a_road:
+        return False, None
+
+    if name in known_corrections:
+        return False, known_corrections[name]
+
+    if name[0].islower():
+        name = name[0].upper() + name[1:]
+    if name.endswith('staße'):
+        name = name[:-5] + 'straße'
+    elif name.endswith('strasse'):
+        name = name[:-7] + 'straße'
+    elif name.endswith(' Str.'):
+        name = name[:-1] + 'aße'
+    elif name.endswith('str.'):
+        name = name[:-1] + 'aße'
+    elif name.endswith('promedade'):
+        name = name[:-9] + 'promenade'
+
+    was_valid = name == original_name
+
+    ms = [regex.search(name) for regex in valid_street_names]
+    if any(m is not None for m in ms):
+        return was_valid, name
+
+    raise ValueError(f'No correction found for the given street name: {name}')
+
+
+def run(audit: Callable[[str], Tuple[bool, Optional[str]]], names: List[str]) -> List[Tuple[bool, Optional[str]]]:
+    results = []
+    for name in names:
+        try:
+            results.append(audit(name))
+        except ValueError:
+            results.append((False, 'INVALID'))
+    return results
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('file', nargs='?',
+                        default='street_names.txt',
+                        help='The street name file to use.')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='The number of times to audit the list of names.')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file) or not os.path.isfile(args.file):
+        parser.error(f'The specified argument is not a valid file: {args.file}')
+        exit(1)
+    if args.repeat < 1:
+        parser.error('The number of repetitions must be positive.')
+        exit(1)
+
+    with open(args.file, 'r', encoding='utf-8') as f:
+        names = [line.rstrip(os.linesep) for line in f]
+    # Legacy and compiled rules must agree on every name before their speed is compared.
+    expected = run(legacy_audit_street_name, names)
+    actual = run(audit_street_name, names)
+    mismatches = [(name, e, a) for name, e, a in zip(names, expected, actual) if e != a]
+    for name, e, a in mismatches:
+        print(f'Mismatch for "{name}": {e} (legacy) vs. {a} (compiled)')
+    if len(mismatches) > 0:
+        exit(1)
+
+    timings = {}
+    for label, audit in (('legacy', legacy_audit_street_name), ('compiled', audit_street_name)):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            run(audit, names)
+        timings[label] = time.perf_counter() - start
+        total = len(names) * args.repeat
+        print(f'{label:>8}: {timings[label]:.3f} s, {total / max(timings[label], 1e-9):.0f} names/s')
+    print(f'Speedup: {timings["legacy"] / max(timings["compiled"], 1e-9):.2f}x over {len(names)} names')
+
+
+if __name__ == '__main__':
+    main()
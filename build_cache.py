@@ -0,0 +1,40 @@
+"""
+This script converts an OpenStreetMap XML file into a columnar, memory-mapped
+cache that later analyses can open instead of parsing the XML again.
+"""
+
+import os
+from argparse import ArgumentParser
+
+from tqdm import tqdm
+
+from data_wrangling.columnar import build_cache
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('file', nargs='?',
+                        default=os.path.join('osm-extracts', 'berlin.osm.bz2'),
+                        help='The OSM map file to convert.')
+    parser.add_argument('--out', default=None,
+                        help='The cache directory; defaults to the file name with a .cache suffix.')
+    parser.add_argument('--decompress-workers', type=int, default=os.cpu_count(),
+                        help='The number of processes used to decompress bzip2 files.')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file) or not os.path.isfile(args.file):
+        parser.error(f'The specified argument is not a valid file: {args.file}')
+        exit(1)
+
+    directory = args.out if args.out is not None else args.file + '.cache'
+    progress = tqdm(desc='Building cache')
+    extract = build_cache(args.file, directory, progress=progress, decompress_workers=args.decompress_workers)
+    progress.close()
+
+    print(f'Wrote {directory}:')
+    for element_type, count in extract.manifest['counts'].items():
+        print(f'{count:10d} {element_type}')
+
+
+if __name__ == '__main__':
+    main()
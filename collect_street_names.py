@@ -8,18 +8,7 @@ from argparse import ArgumentParser
 
 from tqdm import tqdm
 
-from data_wrangling.xml_processing import open_and_parse
-
-
-def is_street_name(elem):
-    assert 'k' in elem.attrib and 'v' in elem.attrib
-    return elem.attrib['k'] == 'addr:street'
-
-
-def validate_osm_version(events):
-    ev, el = next(events)
-    assert el.tag == 'osm'
-    assert 'version' in el.attrib and el.attrib['version'] == '0.6', 'Unknown version of the OSM format.'
+from data_wrangling.xml_processing import open_elements, scan_elements, Select
 
 
 def main():
@@ -30,6 +19,10 @@ def main():
     parser.add_argument('--out', type=str,
                         default='street_names.txt',
                         help='The file to write street names to.')
+    parser.add_argument('--decompress-workers', type=int, default=os.cpu_count(),
+                        help='The number of processes used to decompress bzip2 files.')
+    parser.add_argument('--backend', choices=('lxml', 'expat'), default='lxml',
+                        help='The parser to use; expat only reports element names and attributes and is faster.')
     args = parser.parse_args()
 
     if not os.path.exists(args.file) or not os.path.isfile(args.file):
@@ -38,22 +31,30 @@ def main():
 
     progress = tqdm(desc="Extracting street names")
 
-    events = open_and_parse(args.file, events=('start',), progress=progress)
-    validate_osm_version(events)
-
-    street_names = set()
-    for ev, el in events:
-        assert el.tag != 'osm'
-        if el.tag != 'way':
-            continue
-        street_name_tags = (tag for tag in el.iter('tag') if is_street_name(tag))
-        for tag in street_name_tags:
-            street_names.add(tag.attrib['v'])
+    if args.backend == 'expat':
+        street_names = collect_street_names_expat(args.file, progress, args.decompress_workers)
+    else:
+        street_names = collect_street_names_lxml(args.file, progress, args.decompress_workers)
 
     with open(args.out, 'w', encoding='utf-8') as f:
         lines = '\n'.join(sorted(street_names))
         f.writelines(lines)
 
 
+def collect_street_names_lxml(filename, progress, decompress_workers):
+    street_names = set()
+    for way in open_elements(filename, types=('way',), progress=progress,
+                             decompress_workers=decompress_workers, osm_version='0.6'):
+        if 'addr:street' in way.tags:
+            street_names.add(way.tags['addr:street'])
+    return street_names
+
+
+def collect_street_names_expat(filename, progress, decompress_workers):
+    select = Select('tag', attributes=('v',), parent='way', where={'k': 'addr:street'})
+    return {name for name, in scan_elements(filename, select, progress=progress,
+                                            decompress_workers=decompress_workers, osm_version='0.6')}
+
+
 if __name__ == '__main__':
     main()
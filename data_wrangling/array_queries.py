@@ -0,0 +1,305 @@
+"""
+The queries of data_wrangling.queries, answered from a columnar cache instead of MongoDB.
+
+The functions take an ArrayExtract in place of the collection and otherwise have the same
+signatures and results, so that exploratory work does not require a running database:
+
+    from data_wrangling import array_queries as queries
+    berlin = queries.open_extract('berlin.cache')
+    queries.get_trees_in_region(berlin, get_district_geojson('Spandau'))
+
+Address tags are audited like during the import, so that results match the imported data.
+Regions are tested with the planar point-in-polygon test of data_wrangling.spatial, whereas
+MongoDB uses geodesic edges; for boundaries as finely resolved as the districts, this only
+matters for points within centimeters of a border.
+"""
+
+import re
+from xml.etree.cElementTree import Element, SubElement
+from typing import List, Dict, Set, Tuple, Optional
+
+import numpy as np
+
+from data_wrangling.auditing import AuditEngine, address_audit
+from data_wrangling.columnar import ColumnarExtract, open_cache
+from data_wrangling.spatial import PolygonIndex, KDTree, unit_vectors, chord_to_angle
+from supplemental import GeoJSON
+
+ELEMENT_TYPES = ('node', 'way', 'relation')
+EARTH_RADIUS_METERS = 6371 * 1000
+STREET_KEY = 'addr:street'
+HOUSE_NUMBER_KEY = 'addr:housenumber'
+# The tags corrected by the audits of the import.
+AUDITED_KEYS = (STREET_KEY, 'addr:city', 'addr:country', 'addr:suburb')
+# The tags whose audit depends on another tag of the element, see PostcodeSuburbRule.
+CONTEXT_KEYS = {'addr:suburb': 'addr:postcode'}
+
+
+class ArrayExtract:
+    """
+    The arrays of a columnar cache prepared for queries. Derived arrays, such as the
+    audited street name of each element, are computed once on first use.
+    """
+    def __init__(self, extract: ColumnarExtract, audit: bool = True,
+                 postcode_suburbs: Optional[Dict[str, Set[str]]] = None):
+        """
+        Prepares the extract.
+        :param extract: The opened columnar cache.
+        :param audit: Whether to apply the address audits of the import to the address tags.
+        :param postcode_suburbs: The suburbs of each postcode, if the import checked them; see load_postcode_suburbs.
+        """
+        self.extract = extract
+        self._engine = address_audit(postcode_suburbs=postcode_suburbs) \
+            if audit else None  # type: Optional[AuditEngine]
+        self._streets = None  # type: Optional[List[Optional[str]]]
+        self._street_codes = {}  # type: Dict[str, np.ndarray]
+        self._audited = {}  # type: Dict[Tuple[str, str], Tuple[np.ndarray, List[str]]]
+        self._addresses = None  # type: Optional[np.ndarray]
+        self._address_tree = None  # type: Optional[KDTree]
+
+    @property
+    def streets(self) -> List[Optional[str]]:
+        """
+        The (audited) street name of each value code, or None for values not used as street names.
+        """
+        if self._streets is None:
+            extract = self.extract
+            key = extract.keys.code_of(STREET_KEY)
+            codes = set()
+            if key >= 0:
+                for element_type in ELEMENT_TYPES:
+                    table = extract.table(element_type)
+                    codes.update(np.unique(table.tag_values[table.tag_keys == key]).tolist())
+            streets = [None] * len(extract.values)  # type: List[Optional[str]]
+            for code in codes:
+                streets[code] = self._audit_tags({STREET_KEY: extract.values[code]})[STREET_KEY]
+            self._streets = streets
+        return self._streets
+
+    def street_codes(self, element_type: str) -> np.ndarray:
+        """
+        Gets the value code of the street name of each element of a type, or -1 for elements without one.
+        """
+        codes = self._street_codes.get(element_type)
+        if codes is None:
+            codes = self._value_codes(element_type, STREET_KEY)
+            self._street_codes[element_type] = codes
+        return codes
+
+    def audited_values(self, element_type: str, key: str) -> Tuple[np.ndarray, List[str]]:
+        """
+        Gets the audited values of a tag. The audits run once per distinct value or, for tags whose audit
+        depends on another tag, once per distinct combination with the value of that tag.
+        :param element_type: The element type, e.g. 'node'.
+        :param key: The tag key, e.g. 'addr:city'.
+        :return: For each element the index of its audited value or -1 for elements without the tag,
+                 and the audited values.
+        """
+        audited = self._audited.get((element_type, key))
+        if audited is not None:
+            return audited
+        extract = self.extract
+        table = extract.table(element_type)
+        indices = np.full(len(table), -1, dtype=np.int64)
+        values = []  # type: List[str]
+        key_code = extract.keys.code_of(key)
+        if key_code >= 0 and np.any(table.tag_keys == key_code):
+            matches = table.tag_keys == key_code
+            owners = table.tag_owners[matches]
+            combinations = table.tag_values[matches].astype(np.int64)[:, np.newaxis]
+            context = CONTEXT_KEYS.get(key) if self._engine is not None else None
+            if context is not None:
+                context_codes = self._value_codes(element_type, context)[owners]
+                combinations = np.hstack([combinations, context_codes[:, np.newaxis]])
+            distinct, inverse = np.unique(combinations, axis=0, return_inverse=True)
+            for row in distinct.tolist():
+                tags = {key: extract.values[row[0]]}
+                if len(row) > 1 and row[1] >= 0:
+                    tags[context] = extract.values[row[1]]
+                values.append(self._audit_tags(tags)[key])
+            indices[owners] = inverse.reshape(-1)
+        self._audited[(element_type, key)] = indices, values
+        return indices, values
+
+    def _value_codes(self, element_type: str, key: str) -> np.ndarray:
+        """
+        Gets the value code of a tag of each element of a type, or -1 for elements without the tag.
+        """
+        table = self.extract.table(element_type)
+        codes = np.full(len(table), -1, dtype=np.int64)
+        key_code = self.extract.keys.code_of(key)
+        if key_code >= 0:
+            matches = table.tag_keys == key_code
+            codes[table.tag_owners[matches]] = table.tag_values[matches]
+        return codes
+
+    def _audit_tags(self, tags: Dict[str, str]) -> Dict[str, str]:
+        """
+        Applies the audits of the import to the tags of an element.
+        """
+        if self._engine is None:
+            return tags
+        el = Element('node')
+        for key, value in tags.items():
+            SubElement(el, 'tag', {'k': key, 'v': value})
+        self._engine.audit(el)
+        return {tag.attrib['k']: tag.attrib['v'] for tag in el.iter('tag')}
+
+    @property
+    def addresses(self) -> np.ndarray:
+        """
+        The indices of the nodes with a street name and a house number.
+        """
+        if self._addresses is None:
+            mask = (self.street_codes('node') >= 0) & self.extract.tag_mask('node', HOUSE_NUMBER_KEY)
+            self._addresses = np.flatnonzero(mask)
+        return self._addresses
+
+    @property
+    def address_tree(self) -> KDTree:
+        if self._address_tree is None:
+            nodes = self.extract.nodes
+            self._address_tree = KDTree(unit_vectors(nodes.lon[self.addresses], nodes.lat[self.addresses]))
+        return self._address_tree
+
+
+def open_extract(directory: str, source: Optional[str] = None, audit: bool = True,
+                 postcode_suburbs: Optional[Dict[str, Set[str]]] = None) -> ArrayExtract:
+    """
+    Opens a columnar cache for queries, see build_cache.py.
+    :param directory: The cache directory.
+    :param source: If specified, the OSM file the cache must have been built from.
+    :param audit: Whether to apply the address audits of the import to the address tags.
+    :param postcode_suburbs: The suburbs of each postcode, if the import checked them; see load_postcode_suburbs.
+    :return: The extract.
+    """
+    return ArrayExtract(open_cache(directory, source=source), audit=audit, postcode_suburbs=postcode_suburbs)
+
+
+def get_tag_types(berlin: ArrayExtract) -> str:
+    return '\n'.join([f"{t:9}: {len(berlin.extract.table(t))}"
+                      for t in ELEMENT_TYPES])
+
+
+def count_elems(berlin: ArrayExtract, name: str) -> int:
+    return len(berlin.extract.table(name))
+
+
+def count_tags(berlin: ArrayExtract, tag: str, value: str) -> int:
+    """
+    Counts the elements having a tag.
+    :param berlin: The extract.
+    :param tag: The document field of the tag, e.g. 'tags.amenity'.
+    :param value: The tag value.
+    :return: The number of elements.
+    """
+    assert tag.startswith('tags.'), 'Only tag fields are supported.'
+    key = tag[len('tags.'):]
+    if key in AUDITED_KEYS:
+        count = 0
+        for t in ELEMENT_TYPES:
+            indices, values = berlin.audited_values(t, key)
+            # Elements without the tag use the index -1, which refers to the extra False entry.
+            matching = np.array([audited == value for audited in values] + [False], dtype=bool)
+            count += int(np.count_nonzero(matching[indices]))
+        return count
+    return sum(int(np.count_nonzero(berlin.extract.tag_mask(t, key, value))) for t in ELEMENT_TYPES)
+
+
+def get_closest_address(berlin: ArrayExtract, coordinate: List[float]):
+    index, chord = berlin.address_tree.nearest(unit_vectors(coordinate[0], coordinate[1]))
+    if index < 0:
+        raise IndexError('The extract contains no addresses.')
+    node = int(berlin.addresses[index])
+    nodes = berlin.extract.nodes
+    tags = berlin.extract.tags('node', node)
+    return {
+        'distance_meters': chord_to_angle(chord) * EARTH_RADIUS_METERS,
+        'coordinates': [float(nodes.lon[node]), float(nodes.lat[node])],
+        'addr': {
+            'street': berlin.streets[berlin.street_codes('node')[node]],
+            'house_no': tags[HOUSE_NUMBER_KEY]
+        }
+    }
+
+
+def count_street_types_by_regex(berlin: ArrayExtract, regex: str) -> int:
+    pattern = re.compile(regex)
+    return sum(int(np.count_nonzero(_street_mask(berlin, t, lambda street: pattern.search(street) is not None)))
+               for t in ELEMENT_TYPES)
+
+
+def count_street_types_by_suffix(berlin: ArrayExtract, regex: str) -> int:
+    return count_street_types_by_regex(berlin, regex + '$')
+
+
+def get_streets_in_region(berlin: ArrayExtract, region: GeoJSON, include_ways: bool = False) -> List[str]:
+    index = PolygonIndex({'region': region})
+    codes = []
+    street_codes = berlin.street_codes('node')
+    candidates = np.flatnonzero(street_codes >= 0)
+    codes.append(street_codes[candidates[_within(berlin, index, candidates)]])
+    if include_ways:
+        street_codes = berlin.street_codes('way')
+        candidates = np.flatnonzero(street_codes >= 0)
+        codes.append(street_codes[candidates[_ways_within(berlin, index, candidates)]])
+    streets = berlin.streets
+    return sorted({streets[code] for code in np.unique(np.concatenate(codes)).tolist()})
+
+
+def get_streets_per_district(berlin: ArrayExtract, districts: Dict[str, GeoJSON]) -> Dict[str, List[str]]:
+    return {district: get_streets_in_region(berlin, districts[district]) for district in sorted(districts.keys())}
+
+
+def get_trees_in_region(berlin: ArrayExtract, region: GeoJSON) -> int:
+    candidates = np.flatnonzero(berlin.extract.tag_mask('node', 'natural', 'tree'))
+    return int(np.count_nonzero(_within(berlin, PolygonIndex({'region': region}), candidates)))
+
+
+def get_trees_per_district(berlin: ArrayExtract, districts: Dict[str, GeoJSON]) -> Dict[str, int]:
+    return {district: get_trees_in_region(berlin, districts[district]) for district in sorted(districts.keys())}
+
+
+def _street_mask(berlin: ArrayExtract, element_type: str, predicate) -> np.ndarray:
+    """
+    Determines the elements whose street name matches a predicate, which is evaluated once per distinct name.
+    """
+    streets = berlin.streets
+    codes = berlin.street_codes(element_type)
+    used = np.unique(codes[codes >= 0])
+    matching = np.zeros(len(streets) + 1, dtype=bool)
+    matching[used] = [predicate(streets[code]) for code in used.tolist()]
+    # Elements without a street name use the code -1, which refers to the extra False entry.
+    return matching[codes]
+
+
+def _within(berlin: ArrayExtract, index: PolygonIndex, nodes: np.ndarray) -> np.ndarray:
+    """
+    Tests which of the given nodes are located within the region of an index.
+    """
+    table = berlin.extract.nodes
+    return index.query(table.lon[nodes], table.lat[nodes]) >= 0
+
+
+def _ways_within(berlin: ArrayExtract, index: PolygonIndex, ways: np.ndarray) -> np.ndarray:
+    """
+    Tests which of the given ways have all of their known nodes, and at least two, within the region of an index.
+    Like a geometry resolved during the import, a way ignores the nodes missing from the extract.
+    """
+    extract = berlin.extract
+    offsets = extract.ways.node_offsets
+    starts, lengths = offsets[ways], offsets[ways + 1] - offsets[ways]
+    owners = np.repeat(np.arange(len(ways)), lengths)
+    # The position of each reference within its way, added to the start of the way.
+    within_way = np.arange(len(owners)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    refs = extract.ways.node_refs[np.repeat(starts, lengths) + within_way]
+    node_ids = extract.nodes.id
+    order = np.argsort(node_ids, kind='stable')
+    positions = np.minimum(np.searchsorted(node_ids, refs, sorter=order), max(0, len(node_ids) - 1))
+    nodes = order[positions] if len(node_ids) > 0 else positions
+    found = node_ids[nodes] == refs if len(node_ids) > 0 else np.zeros(len(refs), dtype=bool)
+    inside = np.zeros(len(refs), dtype=bool)
+    inside[found] = _within(berlin, index, nodes[found])
+    known = np.bincount(owners[found], minlength=len(ways))
+    outside = np.bincount(owners[found & ~inside], minlength=len(ways))
+    return (known >= 2) & (outside == 0)
@@ -1,5 +1,12 @@
 from xml.etree.cElementTree import Element
-from typing import Tuple, Optional, Callable, Union, Iterable
+from typing import Tuple, Optional, Callable, Union, Iterable, Set, List
+
+from .memoize import MemoizedAudit, CacheEntry
+
+# The outcomes of auditing a single tag.
+UNCHANGED = 0
+CORRECTED = 1
+REMOVED = 2
 
 
 class AuditTag:
@@ -32,6 +39,83 @@ class AuditTag:
     def attributes_corrected(self) -> int:
         return self._attributes_corrected
 
+    @property
+    def cache(self) -> Optional[MemoizedAudit]:
+        """
+        The cache of the audit function if it is memoized.
+        """
+        return self._audit if isinstance(self._audit, MemoizedAudit) else None
+
+    def merge_counts(self, corrected: int, removed: int):
+        """
+        Adds counts gathered by a copy of this audit, e.g. in a worker process.
+        :param corrected: The number of corrected attributes.
+        :param removed: The number of removed attributes.
+        """
+        self._attributes_corrected += corrected
+        self._attributes_removed += removed
+
+    def save_cache(self):
+        """
+        Saves the cached audit results if the audit function is memoized and has a cache file.
+        """
+        if self.cache is not None:
+            self.cache.save()
+
+    def record_cache_entries(self):
+        """
+        Starts recording the entries added to the cache of a memoized audit, see take_cache_entries.
+        """
+        if self.cache is not None:
+            self.cache.record_added()
+
+    def take_cache_entries(self) -> List[CacheEntry]:
+        """
+        Gets the cache entries added by this audit, e.g. in a worker process, since the last call.
+        """
+        return self.cache.take_added() if self.cache is not None else []
+
+    def merge_cache_entries(self, entries: List[CacheEntry]):
+        """
+        Adds cache entries gathered by a copy of this audit, so that they are saved with the cache.
+        """
+        if self.cache is not None:
+            self.cache.merge_entries(entries)
+
+    @property
+    def element_types(self) -> Set[str]:
+        """
+        The types of the elements to which the audit applies, e.g. 'node'.
+        """
+        return self._tag
+
+    def applies_to(self, tag: Element) -> bool:
+        """
+        Determines whether the audit applies to a tag element.
+        :param tag: The tag element.
+        :return: The result of the filter function.
+        """
+        return self._filter(tag)
+
+    def counts(self) -> Tuple[int, int, int, int]:
+        """
+        Gets the counters of the audit, e.g. to pass them from a worker process to the main process.
+        :return: The number of corrected and removed attributes and the number of cache hits and misses.
+        """
+        cache = self.cache
+        return (self._attributes_corrected, self._attributes_removed,
+                cache.hits if cache is not None else 0, cache.misses if cache is not None else 0)
+
+    def merge(self, counts: Tuple[int, ...]):
+        """
+        Adds the difference of two results of counts() gathered by a copy of this audit.
+        :param counts: The difference of the counters.
+        """
+        corrected, removed, hits, misses = counts
+        self.merge_counts(corrected, removed)
+        if self.cache is not None:
+            self.cache.merge_stats(hits, misses)
+
     def audit(self, el: Element) -> Optional[Element]:
         """
         Audits the XML element.
@@ -43,23 +127,32 @@ class AuditTag:
         if el.tag not in self._tag:
             return el
         for tag in list(el.iter('tag')):
-            if not self._filter(tag):
-                continue
-            try:
-                was_valid, corrected = self._audit(tag.attrib['v'])
-                if was_valid:
-                    continue
-                if corrected is None:
-                    raise ValueError
-                self._attributes_corrected += 1
-                tag.attrib['v'] = corrected
-                # print(f'Corrected tag {tag.attrib["k"]} to {corrected}')
-            except ValueError:
-                # print(f'Deleted tag {tag.attrib["k"]}: uncorrectable.')
-                tag.attrib['v'] = 'INVALID-REMOVED'
-                self._attributes_removed += 1
+            if self._filter(tag):
+                self.audit_tag(tag)
         return el
 
+    def audit_tag(self, tag: Element) -> int:
+        """
+        Audits a single tag element to which the audit applies.
+        :param tag: The tag element.
+        :return: One of UNCHANGED, CORRECTED or REMOVED.
+        """
+        try:
+            was_valid, corrected = self._audit(tag.attrib['v'])
+            if was_valid:
+                return UNCHANGED
+            if corrected is None:
+                raise ValueError
+            self._attributes_corrected += 1
+            tag.attrib['v'] = corrected
+            # print(f'Corrected tag {tag.attrib["k"]} to {corrected}')
+            return CORRECTED
+        except ValueError:
+            # print(f'Deleted tag {tag.attrib["k"]}: uncorrectable.')
+            tag.attrib['v'] = 'INVALID-REMOVED'
+            self._attributes_removed += 1
+            return REMOVED
+
     def __call__(self, el: Element) -> Optional[Element]:
         """
         Audits the XML element.
@@ -71,4 +164,7 @@ class AuditTag:
         return self.audit(el)
 
     def __repr__(self):
-        return f'{type(self).__name__}: corrected {self.attributes_corrected}, removed {self.attributes_removed}'
+        text = f'{type(self).__name__}: corrected {self.attributes_corrected}, removed {self.attributes_removed}'
+        if self.cache is not None:
+            text += f'; cache: {self.cache}'
+        return text
@@ -1,2 +1,7 @@
 from .AuditTag import AuditTag
-from .streets import audit_street_name, is_street_name, AuditStreetName
+from .streets import audit_street_name, audit_street_name_rule, match_street_name_rule, is_street_name, \
+    AuditStreetName, memoized_street_name_audit
+from .memoize import MemoizedAudit, rules_hash
+from .engine import AuditEngine, CrossTagRule, RuleStats
+from .addresses import AuditCountry, AuditCity, PostcodeSuburbRule, audit_country, audit_city, \
+    load_postcode_suburbs, address_audit
@@ -0,0 +1,153 @@
+"""
+Audits of the address tags described in VALIDATE.md.
+"""
+
+from xml.etree.cElementTree import Element
+from typing import Dict, Set, Tuple, Optional
+
+from .AuditTag import AuditTag, UNCHANGED, CORRECTED
+from .engine import AuditEngine, CrossTagRule
+from .streets import AuditStreetName
+from .memoize import DEFAULT_CACHE_SIZE
+
+EXPECTED_COUNTRY = 'DE'
+EXPECTED_CITY = 'Berlin'
+# Misspellings of the expected city, in lower case. Similar names are not corrected in general,
+# since they may well be places in Brandenburg.
+known_city_misspellings = {'berln', 'belin', 'brelin', 'berlim', 'berlinn', 'berline', 'berlin,'}
+
+# Names of the country that are corrected to the expected country code.
+known_country_names = {'de', 'deutschland', 'germany', 'brd'}
+
+
+class AuditCountry(AuditTag):
+    def __init__(self):
+        super().__init__(['node', 'way', 'relation'], is_country, audit_country)
+
+
+class AuditCity(AuditTag):
+    def __init__(self):
+        super().__init__(['node', 'way', 'relation'], is_city, audit_city)
+
+
+def is_country(elem: Element) -> bool:
+    return elem.attrib['k'] == 'addr:country'
+
+
+def is_city(elem: Element) -> bool:
+    return elem.attrib['k'] == 'addr:city'
+
+
+def audit_country(country: str) -> Tuple[bool, Optional[str]]:
+    """
+    Checks that an address is located in Germany.
+
+    :param country: The country code.
+    :return: A tuple containing a boolean indicating if the code was valid, as well as the (corrected) code.
+    """
+    if country == EXPECTED_COUNTRY:
+        return True, country
+    if country.strip().lower() in known_country_names:
+        return False, EXPECTED_COUNTRY
+    raise ValueError(f'Unexpected country: {country}')
+
+
+def audit_city(city: str) -> Tuple[bool, Optional[str]]:
+    """
+    Checks a city name for misspellings of Berlin. Other cities are accepted, since the
+    extract also covers parts of Brandenburg.
+
+    :param city: The city name.
+    :return: A tuple containing a boolean indicating if the name was valid, as well as the (corrected) name.
+    """
+    if city == EXPECTED_CITY:
+        return True, city
+    normalized = ' '.join(city.split()).lower()
+    if normalized == EXPECTED_CITY.lower() or normalized in known_city_misspellings:
+        return False, EXPECTED_CITY
+    return True, city
+
+
+class PostcodeSuburbRule(CrossTagRule):
+    """
+    Checks that the suburb of an address matches its postcode.
+    """
+    name = 'postcode_suburb'
+    keys = ('addr:postcode', 'addr:suburb')
+
+    def __init__(self, table: Dict[str, Set[str]]):
+        """
+        Initializes the rule.
+        :param table: The suburbs of each postcode, see load_postcode_suburbs.
+        """
+        self._table = table
+        self.mismatches = 0
+        self.unknown = 0
+
+    def check(self, tags: Dict[str, Element]) -> int:
+        postcode, suburb = tags['addr:postcode'], tags['addr:suburb']
+        suburbs = self._table.get(postcode.attrib['v'])
+        if suburbs is None:
+            self.unknown += 1
+            return UNCHANGED
+        if suburb.attrib['v'] in suburbs:
+            return UNCHANGED
+        if len(suburbs) == 1:
+            # The postcode is unambiguous, so the suburb can be corrected.
+            suburb.attrib['v'] = next(iter(suburbs))
+            return CORRECTED
+        self.mismatches += 1
+        return UNCHANGED
+
+    def counts(self) -> Tuple[int, int]:
+        return self.mismatches, self.unknown
+
+    def merge(self, counts: Tuple[int, int]):
+        mismatches, unknown = counts
+        self.mismatches += mismatches
+        self.unknown += unknown
+
+    def details(self) -> str:
+        return f'{self.mismatches} ambiguous mismatches, {self.unknown} unknown postcodes'
+
+
+def load_postcode_suburbs(filename: str, min_share: float = 0.1) -> Dict[str, Set[str]]:
+    """
+    Loads the suburbs of each postcode from the report of the postcode-suburbs survey.
+    :param filename: The report file.
+    :param min_share: The minimum share of the addresses with a postcode a suburb needs to have
+                      to be accepted for that postcode; this disregards erroneous combinations.
+    :return: The suburbs of each postcode.
+    """
+    counts = {}  # type: Dict[str, Dict[str, int]]
+    with open(filename, 'r', encoding='utf-8') as f:
+        next(f)  # the header
+        for line in f:
+            count, _, pair = line.strip().partition(' ')
+            postcode, _, suburb = pair.partition('\t')
+            counts.setdefault(postcode, {})[suburb] = int(count)
+    table = {}
+    for postcode, suburbs in counts.items():
+        total = sum(suburbs.values())
+        table[postcode] = {suburb for suburb, count in suburbs.items() if count >= min_share * total}
+    return table
+
+
+def address_audit(cache_size: int = DEFAULT_CACHE_SIZE, cache_file: Optional[str] = None,
+                  postcode_suburbs: Optional[Dict[str, Set[str]]] = None, profile: bool = False) -> AuditEngine:
+    """
+    Creates an audit engine for the street, country and city of addresses and,
+    given a lookup table, the consistency of postcodes and suburbs.
+    :param cache_size: The maximum number of cached street names.
+    :param cache_file: An optional file to persist the street name cache in.
+    :param postcode_suburbs: The suburbs of each postcode, see load_postcode_suburbs.
+    :param profile: Whether to measure the time spent in each rule.
+    :return: The audit engine.
+    """
+    engine = AuditEngine(profile=profile)
+    engine.add_audit(AuditStreetName(cache_size=cache_size, cache_file=cache_file), keys=['addr:street'])
+    engine.add_audit(AuditCountry(), keys=['addr:country'])
+    engine.add_audit(AuditCity(), keys=['addr:city'])
+    if postcode_suburbs is not None:
+        engine.add_rule(PostcodeSuburbRule(postcode_suburbs))
+    return engine
@@ -0,0 +1,250 @@
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from xml.etree.cElementTree import Element
+from typing import Dict, List, Tuple, Optional, Iterable, Set
+
+from .AuditTag import AuditTag, CORRECTED, REMOVED
+from .memoize import CacheEntry
+
+
+class RuleStats:
+    """
+    The counters of a single rule of an audit engine.
+    """
+    __slots__ = ('name', 'checked', 'corrected', 'removed', 'time')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.checked = 0
+        self.corrected = 0
+        self.removed = 0
+        self.time = 0.
+
+    def counts(self) -> Tuple[int, int, int, float]:
+        return self.checked, self.corrected, self.removed, self.time
+
+    def merge(self, counts: Tuple[int, int, int, float]):
+        checked, corrected, removed, elapsed = counts
+        self.checked += checked
+        self.corrected += corrected
+        self.removed += removed
+        self.time += elapsed
+
+    def __repr__(self):
+        return f'{self.name}: checked {self.checked}, corrected {self.corrected}, removed {self.removed}'
+
+
+class CrossTagRule(ABC):
+    """
+    A rule that validates several tags of an element together.
+    Subclasses define the name of the rule and the tag keys it needs, and implement check().
+    """
+    name = 'cross_tag'
+    keys = ()  # type: Tuple[str, ...]
+
+    @abstractmethod
+    def check(self, tags: Dict[str, Element]) -> int:
+        """
+        Validates the tags of an element and corrects them where possible.
+        :param tags: The tag elements of the element by key; all keys of the rule are present.
+        :return: One of UNCHANGED, CORRECTED or REMOVED.
+        """
+
+    def counts(self) -> Tuple:
+        """
+        Gets additional counters of the rule; see AuditTag.counts.
+        """
+        return ()
+
+    def merge(self, counts: Tuple):
+        """
+        Adds the difference of two results of counts() gathered by a copy of this rule.
+        """
+        pass
+
+    def details(self) -> str:
+        """
+        Describes additional counters of the rule for the summary of the engine.
+        """
+        return ''
+
+
+class AuditEngine:
+    """
+    Applies a set of audits to the tags of an element in a single walk over its tags.
+
+    Tag audits are indexed by the tag keys they apply to, so that each tag is only
+    passed to the audits interested in it. Cross-tag rules are run once the walk
+    collected all of the tags they need.
+    """
+    def __init__(self, element_types: Iterable[str] = ('node', 'way', 'relation'), profile: bool = False):
+        """
+        Initializes the engine.
+        :param element_types: The types of the elements to audit.
+        :param profile: Whether to measure the time spent in each rule.
+        """
+        self._element_types = set(element_types)
+        self._profile = profile
+        self._audits = []  # type: List[Tuple[AuditTag, RuleStats]]
+        self._by_key = defaultdict(list)  # type: Dict[str, List[Tuple[AuditTag, RuleStats]]]
+        self._any_key = []  # type: List[Tuple[AuditTag, RuleStats]]
+        self._rules = []  # type: List[Tuple[CrossTagRule, RuleStats]]
+        self._rule_keys = set()  # type: Set[str]
+
+    def add_audit(self, audit: AuditTag, keys: Optional[Iterable[str]] = None, name: Optional[str] = None):
+        """
+        Adds a tag audit.
+        :param audit: The audit; its filter function is still applied to the tags of the given keys.
+        :param keys: The tag keys the audit applies to; if None, every tag is passed to the audit.
+        :param name: The name of the audit in the statistics; defaults to the class name.
+        """
+        entry = audit, RuleStats(name if name is not None else type(audit).__name__)
+        self._audits.append(entry)
+        if keys is None:
+            self._any_key.append(entry)
+            return
+        for key in keys:
+            self._by_key[key].append(entry)
+
+    def add_rule(self, rule: CrossTagRule):
+        """
+        Adds a cross-tag rule.
+        :param rule: The rule.
+        """
+        self._rules.append((rule, RuleStats(rule.name)))
+        self._rule_keys.update(rule.keys)
+
+    @property
+    def stats(self) -> List[RuleStats]:
+        """
+        The counters of all audits and rules.
+        """
+        return [stats for _, stats in self._audits] + [stats for _, stats in self._rules]
+
+    @property
+    def audits(self) -> List[AuditTag]:
+        return [audit for audit, _ in self._audits]
+
+    @property
+    def rules(self) -> List[CrossTagRule]:
+        return [rule for rule, _ in self._rules]
+
+    @property
+    def attributes_corrected(self) -> int:
+        return sum(stats.corrected for stats in self.stats)
+
+    @property
+    def attributes_removed(self) -> int:
+        return sum(stats.removed for stats in self.stats)
+
+    def counts(self) -> Tuple:
+        """
+        Gets the counters of all audits and rules; see AuditTag.counts.
+        """
+        counts = []
+        for rule, stats in self._audits + self._rules:
+            counts.extend(stats.counts())
+            counts.extend(rule.counts())
+        return tuple(counts)
+
+    def merge(self, counts: Tuple):
+        """
+        Adds the difference of two results of counts() gathered by a copy of this engine.
+        """
+        offset = 0
+        for rule, stats in self._audits + self._rules:
+            size = len(stats.counts())
+            stats.merge(counts[offset:offset + size])
+            offset += size
+            size = len(rule.counts())
+            rule.merge(counts[offset:offset + size])
+            offset += size
+
+    def record_cache_entries(self):
+        """
+        Starts recording the entries added to the caches of all memoized audits, see take_cache_entries.
+        """
+        for audit, _ in self._audits:
+            audit.record_cache_entries()
+
+    def take_cache_entries(self) -> List[List[CacheEntry]]:
+        """
+        Gets the cache entries added by each audit since the last call.
+        """
+        return [audit.take_cache_entries() for audit, _ in self._audits]
+
+    def merge_cache_entries(self, entries: List[List[CacheEntry]]):
+        """
+        Adds the cache entries gathered by a copy of this engine, see take_cache_entries.
+        """
+        for (audit, _), added in zip(self._audits, entries):
+            audit.merge_cache_entries(added)
+
+    def save_cache(self):
+        """
+        Saves the caches of all memoized audits.
+        """
+        for audit, _ in self._audits:
+            audit.save_cache()
+
+    def audit(self, el: Element) -> Optional[Element]:
+        """
+        Audits the XML element.
+        :param el: The element to audit.
+        :return: The (corrected) element.
+        """
+        if el.tag not in self._element_types:
+            return el
+        by_key, any_key, rule_keys = self._by_key, self._any_key, self._rule_keys
+        collected = {}  # type: Dict[str, Element]
+        for tag in el.iter('tag'):
+            key = tag.attrib['k']
+            audits = by_key.get(key)
+            if audits is not None:
+                self._apply(audits, el, tag)
+            if len(any_key) > 0:
+                self._apply(any_key, el, tag)
+            if key in rule_keys:
+                collected[key] = tag
+        if len(collected) > 0:
+            for rule, stats in self._rules:
+                if all(key in collected for key in rule.keys):
+                    start = time.perf_counter() if self._profile else 0.
+                    self._count(stats, rule.check(collected))
+                    if self._profile:
+                        stats.time += time.perf_counter() - start
+        return el
+
+    def _apply(self, audits: List[Tuple[AuditTag, RuleStats]], el: Element, tag: Element):
+        for audit, stats in audits:
+            if el.tag not in audit.element_types or not audit.applies_to(tag):
+                continue
+            start = time.perf_counter() if self._profile else 0.
+            self._count(stats, audit.audit_tag(tag))
+            if self._profile:
+                stats.time += time.perf_counter() - start
+
+    @staticmethod
+    def _count(stats: RuleStats, outcome: int):
+        stats.checked += 1
+        if outcome == CORRECTED:
+            stats.corrected += 1
+        elif outcome == REMOVED:
+            stats.removed += 1
+
+    def __call__(self, el: Element) -> Optional[Element]:
+        return self.audit(el)
+
+    def __repr__(self):
+        lines = [f'{type(self).__name__}: corrected {self.attributes_corrected}, removed {self.attributes_removed}']
+        for audit, stats in self._audits:
+            lines.append(f'  - {stats}' + self._format_time(stats) +
+                         (f'; cache: {audit.cache}' if audit.cache is not None else ''))
+        for rule, stats in self._rules:
+            details = rule.details()
+            lines.append(f'  - {stats}' + self._format_time(stats) + (f'; {details}' if len(details) > 0 else ''))
+        return '\n'.join(lines)
+
+    def _format_time(self, stats: RuleStats) -> str:
+        return f' in {stats.time * 1000:.1f} ms' if self._profile else ''
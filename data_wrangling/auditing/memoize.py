@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from typing import Callable, Tuple, Optional, Iterable, Any, Union, List
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_SIZE = 65536
+
+AuditResult = Tuple[bool, Optional[str]]
+# A cached value and its audit result, or the message of the ValueError it failed with.
+CacheEntry = Tuple[str, Union[AuditResult, str]]
+
+
+def rules_hash(*tables: Iterable[Any]) -> str:
+    """
+    Computes a hash over rule tables, e.g. sets of strings, dictionaries or sets of compiled regular expressions.
+    :param tables: The rule tables.
+    :return: The hex digest.
+    """
+    sha = hashlib.sha256()
+    for table in tables:
+        if isinstance(table, dict):
+            entries = sorted(f'{key}\0{value}' for key, value in table.items())
+        else:
+            entries = sorted(getattr(entry, 'pattern', entry) for entry in table)
+        sha.update(json.dumps(entries).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class MemoizedAudit:
+    """
+    Caches the results of an audit function in a bounded least-recently-used cache.
+    Values that fail the audit with a ValueError are cached as well and fail again on lookup.
+    """
+    def __init__(self, audit_fn: Callable[[str], AuditResult], max_size: int = DEFAULT_CACHE_SIZE,
+                 cache_file: Optional[str] = None, rules: Optional[str] = None):
+        """
+        Initializes the cache.
+        :param audit_fn: The audit function to memoize.
+        :param max_size: The maximum number of cached values.
+        :param cache_file: An optional file to load the cache from and save it to.
+        :param rules: A hash of the rules used by the audit function, see rules_hash; a cache file
+                      is only loaded if it was saved with the same rules.
+        """
+        assert max_size > 0, 'The cache size must be positive.'
+        self._audit = audit_fn
+        self._max_size = max_size
+        self._cache_file = cache_file
+        self._rules = rules
+        self._cache = OrderedDict()  # type: OrderedDict[str, Union[AuditResult, str]]
+        self._hits = 0
+        self._misses = 0
+        self._loaded = 0
+        self._added = None  # type: Optional[List[CacheEntry]]
+        if cache_file is not None:
+            self.load()
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    @property
+    def loaded(self) -> int:
+        """
+        The number of entries loaded from the cache file.
+        """
+        return self._loaded
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def merge_stats(self, hits: int, misses: int):
+        """
+        Adds statistics gathered by a copy of this cache, e.g. in a worker process.
+        :param hits: The number of cache hits.
+        :param misses: The number of cache misses.
+        """
+        self._hits += hits
+        self._misses += misses
+
+    def record_added(self):
+        """
+        Starts recording the entries added to the cache, e.g. in a worker process whose
+        entries are merged into the cache of the main process; see take_added.
+        """
+        self._added = []
+
+    def take_added(self) -> List[CacheEntry]:
+        """
+        Gets the entries added since the last call and clears them.
+        :return: The added entries, or an empty list if they are not recorded.
+        """
+        if self._added is None:
+            return []
+        added, self._added = self._added, []
+        return added
+
+    def merge_entries(self, entries: Iterable[CacheEntry]):
+        """
+        Adds entries gathered by a copy of this cache, without counting them as hits or misses.
+        :param entries: The entries, see take_added.
+        """
+        for value, result in entries:
+            self._cache[value] = result
+            self._cache.move_to_end(value)
+            if len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+
+    def __call__(self, value: str) -> AuditResult:
+        try:
+            result = self._cache[value]
+            self._cache.move_to_end(value)
+            self._hits += 1
+        except KeyError:
+            self._misses += 1
+            try:
+                result = self._audit(value)
+            except ValueError as e:
+                result = str(e)
+            self._cache[value] = result
+            if self._added is not None:
+                self._added.append((value, result))
+            if len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+        if isinstance(result, str):
+            raise ValueError(result)
+        return result
+
+    def load(self):
+        """
+        Loads the cache file if it exists and matches the rules.
+        """
+        if self._cache_file is None or not os.path.isfile(self._cache_file):
+            return
+        with open(self._cache_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != CACHE_VERSION or data.get('rules') != self._rules:
+            return
+        for value, result in data['entries'][-self._max_size:]:
+            self._cache[value] = result if isinstance(result, str) else tuple(result)
+        self._loaded = len(self._cache)
+
+    def save(self):
+        """
+        Saves the cache to the cache file.
+        """
+        if self._cache_file is None:
+            return
+        data = {
+            'version': CACHE_VERSION,
+            'rules': self._rules,
+            'entries': list(self._cache.items())
+        }
+        temp_path = self._cache_file + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temp_path, self._cache_file)
+
+    def __repr__(self):
+        total = self._hits + self._misses
+        rate = self._hits / total if total > 0 else 0.
+        return f'{self._hits} hits, {self._misses} misses ({rate:.1%} hit rate), {len(self._cache)} cached'
@@ -2,13 +2,35 @@ import os
 import re
 
 from .AuditTag import AuditTag
-from typing import Optional, Tuple
+from .memoize import MemoizedAudit, rules_hash, DEFAULT_CACHE_SIZE
+from typing import Optional, Tuple, Iterable, Callable, Dict, Pattern, Match
 from xml.etree.cElementTree import Element
 
 
 class AuditStreetName(AuditTag):
-    def __init__(self):
-        super().__init__(['node', 'way', 'relation'], is_street_name, audit_street_name)
+    def __init__(self, memoize: bool = True, cache_size: int = DEFAULT_CACHE_SIZE, cache_file: Optional[str] = None):
+        """
+        Initializes the street name audit.
+        :param memoize: Whether to cache the audit results of street names.
+        :param cache_size: The maximum number of cached street names.
+        :param cache_file: An optional file to persist the cache in between runs.
+        """
+        audit_fn = audit_street_name
+        if memoize:
+            audit_fn = memoized_street_name_audit(cache_size, cache_file)
+        super().__init__(['node', 'way', 'relation'], is_street_name, audit_fn)
+
+
+def memoized_street_name_audit(cache_size: int = DEFAULT_CACHE_SIZE,
+                               cache_file: Optional[str] = None) -> MemoizedAudit:
+    """
+    Creates a memoizing version of audit_street_name.
+    :param cache_size: The maximum number of cached street names.
+    :param cache_file: An optional file to persist the cache in; it is discarded if any of the rule tables changed.
+    :return: The memoized audit function.
+    """
+    rules = rules_hash(valid_street_names, known_valids, not_a_road, known_corrections)
+    return MemoizedAudit(audit_street_name, max_size=cache_size, cache_file=cache_file, rules=rules)
 
 
 def is_street_name(elem: Element) -> bool:
@@ -31,6 +53,20 @@ def audit_street_name(name: str) -> Tuple[bool, Optional[str]]:
     :return: A tuple containing a boolean indicating if the name was corrected, as well as the (corrected) name or
              None if the name does not refer to an actual street.
     """
+    was_valid, name, _ = audit_street_name_rule(name)
+    return was_valid, name
+
+
+def audit_street_name_rule(name: str) -> Tuple[bool, Optional[str], str]:
+    """
+    Checks a street name for validity like audit_street_name and reports the rule that decided the result.
+
+    :param name: The street name to audit.
+    :return: A tuple containing a boolean indicating if the name was corrected, the (corrected) name or
+             None if the name does not refer to an actual street, and the deciding rule. The rule is
+             either one of RULE_KNOWN_VALID, RULE_EMPTY, RULE_NOT_A_ROAD and RULE_KNOWN_CORRECTION
+             or the pattern of the matching regular expression in valid_street_names.
+    """
     assert isinstance(name, str) and not name.endswith(os.linesep)
 
     # Make sure there are no white spaces around
@@ -39,37 +75,30 @@ def audit_street_name(name: str) -> Tuple[bool, Optional[str]]:
 
     # Override checks first
     if name in known_valids:
-        return True, name
+        return True, name, RULE_KNOWN_VALID
     elif len(name) == 0:
-        return False, None
+        return False, None, RULE_EMPTY
     elif name in not_a_road:
-        return False, None
+        return False, None, RULE_NOT_A_ROAD
 
     # Before applying the regex sledgehammer we try to handle
     # the easier fixes directly
     if name in known_corrections:
-        return False, known_corrections[name]
+        return False, known_corrections[name], RULE_KNOWN_CORRECTION
 
     if name[0].islower():
         name = name[0].upper() + name[1:]
-    if name.endswith('staße'):
-        name = name[:-5] + 'straße'
-    elif name.endswith('strasse'):
-        name = name[:-7] + 'straße'
-    elif name.endswith(' Str.'):
-        name = name[:-1] + 'aße'
-    elif name.endswith('str.'):
-        name = name[:-1] + 'aße'
-    elif name.endswith('promedade'):
-        name = name[:-9] + 'promenade'
+    m = _suffix_fix.search(name)
+    if m is not None:
+        name = name[:m.start()] + suffix_fixes[m.group(0)]
 
     # Make sure the easy fixes are noticed.
     was_valid = name == original_name
 
     # Check if any of the positive regexes match.
-    ms = [regex.search(name) for regex in valid_street_names]
-    if any(m is not None for m in ms):
-        return was_valid, name
+    rule = match_street_name_rule(name)
+    if rule is not None:
+        return was_valid, name, rule
 
     # Finally, if the name could not be corrected and didn't check out,
     # we're raising an error. Either the dictionaries/sets need to be
@@ -77,6 +106,54 @@ def audit_street_name(name: str) -> Tuple[bool, Optional[str]]:
     raise ValueError(f'No correction found for the given street name: {name}')
 
 
+def match_street_name_rule(name: str) -> Optional[str]:
+    """
+    Finds a rule in valid_street_names that matches a street name.
+
+    All rules are compiled into a single alternation of named groups, so that the name is
+    scanned once and the search stops at the first matching rule.
+
+    :param name: The street name.
+    :return: The pattern of the matching rule or None if no rule matches.
+    """
+    global _combined_rules
+    if _combined_rules is None or _combined_rules[0] is not valid_street_names \
+            or _combined_rules[1] != len(valid_street_names):
+        # The rules are recompiled if the set was replaced or modified.
+        _combined_rules = valid_street_names, len(valid_street_names), *_compile_rules(valid_street_names)
+    _, _, matcher, patterns = _combined_rules
+    m = matcher(name)
+    return patterns[m.lastgroup] if m is not None else None
+
+
+def _compile_rules(rules: Iterable[Pattern]) -> Tuple[Callable[[str], Optional[Match]], Dict[str, str]]:
+    # Sorting makes the reported rule independent of the iteration order of the set.
+    rules = sorted(rules, key=lambda r: r.pattern)
+    patterns = {f'rule{i}': rule.pattern for i, rule in enumerate(rules)}
+    combined = re.compile('|'.join(f'(?P<{group}>{pattern})' for group, pattern in patterns.items()),
+                          re.UNICODE)
+    # Rules anchored at the start only need to be tried at the first position.
+    anchored = all(rule.pattern.startswith('^') for rule in rules)
+    return (combined.match if anchored else combined.search), patterns
+
+
+RULE_KNOWN_VALID = 'known_valids'
+RULE_EMPTY = 'empty'
+RULE_NOT_A_ROAD = 'not_a_road'
+RULE_KNOWN_CORRECTION = 'known_corrections'
+
+# Mapping of common misspellings at the end of street names to their fixes.
+suffix_fixes = {'staße': 'straße',
+                'strasse': 'straße',
+                ' Str.': ' Straße',
+                'str.': 'straße',
+                'promedade': 'promenade'
+                }
+_suffix_fix = re.compile('(' + '|'.join(re.escape(suffix) for suffix in suffix_fixes) + ')$', re.UNICODE)
+
+_combined_rules = None
+
+
 # The following set contains all rules gathered during initial screening
 # of the dataset. If any of the rules evaluates positively, we assume
 # the street name is correct.
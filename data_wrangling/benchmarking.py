@@ -0,0 +1,410 @@
+"""
+A reproducible benchmark of the import and query stages, see benchmark.py.
+
+Each stage is timed separately on the same extract:
+
+- decompression: reading the decompressed contents of the input file,
+- parsing: iterating the elements of the decompressed XML,
+- auditing: applying the audits of import.py to the elements,
+- conversion: converting the audited elements to documents,
+- writes: writing the documents, including the statistics and address collections,
+- queries: each helper of data_wrangling.queries on the written collection.
+
+The pipeline stages alternate on chunks of elements, so that their times can be taken apart without
+keeping the whole extract in memory. Every stage is run several times and its median time is reported.
+Larger inputs are synthesized from an extract by repeating its elements with shifted IDs.
+"""
+
+import os
+import bz2
+import time
+import shutil
+import platform
+import tempfile
+import statistics
+from datetime import datetime
+from typing import Dict, List, Tuple, Optional, Callable, Any
+
+import numpy as np
+from lxml import etree
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+
+from data_wrangling import queries
+from data_wrangling.auditing import address_audit
+from data_wrangling.query_cache import query_cache, bump_generation
+from data_wrangling.xml_processing import InputFile, parse_input
+from data_wrangling.importing import BulkWriter, RegionAssigner, ImportStatistics, AddressIndex, elem_to_doc, \
+    create_indexes, ensure_tag_tokens, statistics_collection, address_collection
+from supplemental import GeoJSON
+
+BENCHMARK_VERSION = 2
+ELEMENT_TYPES = ('node', 'way', 'relation')
+# The ID offset between the copies of an element in a synthetic extract.
+ID_STRIDE = 10 ** 10
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_REPEAT = 3
+# The number of coordinates reverse geocoded at once, with and without the in-memory address tree.
+GEOCODING_POINTS = 1000
+GEOCODING_QUERIES = 10
+_READ_SIZE = 1024 * 1024
+
+
+class BenchmarkException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def synthesize_extract(source: str, target: str, scale: int) -> int:
+    """
+    Writes a bzip2 compressed extract containing each element of a source extract several times.
+    The copies of an element, and all of their references, are shifted by multiples of ID_STRIDE;
+    the elements stay ordered by type and ID, and their locations are unchanged.
+    :param source: The source extract.
+    :param target: The synthetic extract to write.
+    :param scale: The number of copies of each element.
+    :return: The number of elements written.
+    """
+    assert scale >= 1, 'The scale must be positive.'
+    directory = tempfile.mkdtemp(prefix='osm-synthetic-')
+    try:
+        # The elements are split by type first, so that the copies can be written type by type.
+        parts = {t: os.path.join(directory, f'{t}.osm') for t in ELEMENT_TYPES}
+        files = {t: open(path, 'wb') for t, path in parts.items()}
+        try:
+            for f in files.values():
+                f.write(b'<osm version="0.6">\n')
+            with InputFile(source) as f:
+                # The start events make the root element the one cleared while parsing.
+                for ev, el in parse_input(f, events=('start', 'end'), progress=None):
+                    if ev == 'end' and el.tag in files:
+                        files[el.tag].write(etree.tostring(el, encoding='utf-8', with_tail=False) + b'\n')
+            for f in files.values():
+                f.write(b'</osm>\n')
+        finally:
+            for f in files.values():
+                f.close()
+
+        written = 0
+        with bz2.open(target, 'wb') as out:
+            out.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                      b'<osm version="0.6" generator="data_wrangling.benchmarking">\n')
+            for element_type in ELEMENT_TYPES:
+                for copy in range(scale):
+                    with InputFile(parts[element_type]) as f:
+                        for ev, el in parse_input(f, events=('start', 'end'), progress=None):
+                            if ev != 'end' or el.tag != element_type:
+                                continue
+                            _shift_ids(el, copy * ID_STRIDE)
+                            out.write(etree.tostring(el, encoding='utf-8', with_tail=False) + b'\n')
+                            written += 1
+            out.write(b'</osm>\n')
+        return written
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _shift_ids(el: etree.Element, offset: int):
+    if offset == 0:
+        return
+    el.attrib['id'] = str(int(el.attrib['id']) + offset)
+    for child in el:
+        if child.tag == 'nd' or child.tag == 'member':
+            child.attrib['ref'] = str(int(child.attrib['ref']) + offset)
+
+
+def stage_result(runs: List[float], items: int, unit: str) -> Dict[str, Any]:
+    """
+    Summarizes the runs of a stage.
+    :param runs: The time of each run in seconds.
+    :param items: The number of items processed per run.
+    :param unit: The unit of the items, e.g. 'elements'.
+    :return: The median time, the individual runs and the throughput.
+    """
+    seconds = statistics.median(runs)
+    return {'seconds': seconds, 'runs': runs, 'items': items, 'unit': unit, 'rate': items / max(seconds, 1e-9)}
+
+
+def time_decompression(filename: str, target: str, repeat: int = DEFAULT_REPEAT) -> Dict[str, Any]:
+    """
+    Times reading the decompressed contents of a file, which are written to a file for the later stages.
+    :param filename: The (compressed) input file.
+    :param target: The file to write the decompressed contents to.
+    :param repeat: The number of runs.
+    :return: The stage result; the items are decompressed bytes.
+    """
+    runs = []
+    size = 0
+    for run in range(repeat):
+        elapsed = 0.
+        size = 0
+        with InputFile(filename) as f, open(target if run == 0 else os.devnull, 'wb') as out:
+            while True:
+                start = time.perf_counter()
+                data = f.read(_READ_SIZE)
+                elapsed += time.perf_counter() - start
+                if len(data) == 0:
+                    break
+                size += len(data)
+                out.write(data)
+        runs.append(elapsed)
+    return stage_result(runs, size, 'bytes')
+
+
+def reset_collection(collection: Collection):
+    """
+    Removes a collection along with its statistics, addresses and metadata.
+    :param collection: The collection.
+    """
+    collection.drop()
+    statistics_collection(collection).drop()
+    address_collection(collection).drop()
+    collection.database.get_collection('osm_meta').delete_many({'_id': {'$regex': f':{collection.name}$'}})
+
+
+def time_pipeline(filename: str, collection: Collection, batch_size: int = 1000,
+                  chunk_size: int = DEFAULT_CHUNK_SIZE,
+                  regions: Optional[RegionAssigner] = None) -> Tuple[Dict[str, float], int, List[float]]:
+    """
+    Imports an uncompressed extract into an empty collection, timing the parsing, auditing, conversion and writes.
+    :param filename: The uncompressed extract.
+    :param collection: The collection, which is reset first.
+    :param batch_size: The number of documents per bulk write.
+    :param chunk_size: The number of elements passed through the stages at once.
+    :param regions: An optional assigner of districts and Bezirksregionen.
+    :return: The time of each stage, the number of elements and the bounding box of the nodes
+             as [min lon, min lat, max lon, max lat].
+    """
+    reset_collection(collection)
+    create_indexes(collection)
+    ensure_tag_tokens(collection, empty=True)
+    audit = address_audit()
+    times = {'parsing': 0., 'auditing': 0., 'conversion': 0., 'writes': 0.}
+    bbox = [180., 90., -180., -90.]
+    elements = 0
+
+    start = time.perf_counter()
+    stats = ImportStatistics(collection)
+    stats.begin(empty=True)
+    addresses = AddressIndex(collection, batch_size=batch_size)
+    addresses.begin(empty=True)
+    # The collection was reset, so the documents are inserted as by import.py in its default mode.
+    writer = BulkWriter(collection, batch_size=batch_size, upsert=False, prepare=regions,
+                        statistics=stats, addresses=addresses)
+    times['writes'] += time.perf_counter() - start
+
+    with InputFile(filename) as f:
+        events = iter(parse_input(f, events=('start', 'end'), progress=None))
+        done = False
+        while not done:
+            start = time.perf_counter()
+            chunk = []
+            for ev, el in events:
+                if ev == 'end' and el.tag in ELEMENT_TYPES:
+                    chunk.append(el)
+                    if len(chunk) == chunk_size:
+                        break
+            else:
+                done = True
+            times['parsing'] += time.perf_counter() - start
+            elements += len(chunk)
+
+            start = time.perf_counter()
+            audited = [el for el in (audit(el) for el in chunk) if el is not None]
+            times['auditing'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            docs = [elem_to_doc(el) for el in audited]
+            times['conversion'] += time.perf_counter() - start
+
+            for id, doc in docs:
+                if id['type'] == 'node':
+                    lon, lat = doc['loc']['coordinates']
+                    bbox = [min(bbox[0], lon), min(bbox[1], lat), max(bbox[2], lon), max(bbox[3], lat)]
+
+            start = time.perf_counter()
+            for id, doc in docs:
+                writer.add(id, doc)
+            times['writes'] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    writer.close()
+    stats.finish()
+    addresses.finish()
+    times['writes'] += time.perf_counter() - start
+    bump_generation(collection.database, collection.name)
+    return times, elements, bbox
+
+
+def bbox_region(bbox: List[float], fraction: float = 0.5) -> GeoJSON:
+    """
+    Creates a rectangular region in the center of a bounding box.
+    :param bbox: The bounding box as [min lon, min lat, max lon, max lat].
+    :param fraction: The size of the region relative to the bounding box.
+    :return: The region as a GeoJSON polygon.
+    """
+    center_lon, center_lat = (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
+    half_width, half_height = (bbox[2] - bbox[0]) * fraction / 2, (bbox[3] - bbox[1]) * fraction / 2
+    west, east = center_lon - half_width, center_lon + half_width
+    south, north = center_lat - half_height, center_lat + half_height
+    return {'type': 'Polygon', 'coordinates': [[[west, south], [east, south], [east, north], [west, north],
+                                                [west, south]]]}
+
+
+def query_cases(bbox: List[float],
+                districts: Optional[Dict[str, GeoJSON]] = None) -> List[Tuple[str, Callable[[Collection], Any]]]:
+    """
+    Creates the query benchmarks.
+    :param bbox: The bounding box of the nodes, used to place the regions and coordinates.
+    :param districts: The district boundaries, if available.
+    :return: The name and the query of each benchmark.
+    """
+    region = bbox_region(bbox)
+    rng = np.random.default_rng(0)
+    points = np.column_stack([rng.uniform(bbox[0], bbox[2], GEOCODING_POINTS),
+                              rng.uniform(bbox[1], bbox[3], GEOCODING_POINTS)]).tolist()
+    center = [(bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2]
+    cases = [
+        ('get_tag_types', lambda c: queries.get_tag_types(c)),
+        ('count_elems', lambda c: queries.count_elems(c, 'node')),
+        ('count_tags', lambda c: queries.count_tags(c, 'tags.amenity', 'bench')),
+        ('count_tags_unsummarized', lambda c: queries.count_tags(c, 'tags.surface', 'asphalt')),
+        ('count_tag_keys', lambda c: queries.count_tag_keys(c, 'amenity')),
+        ('count_distinct_values', lambda c: queries.count_distinct_values(c, 'amenity')),
+        ('count_street_types_by_suffix', lambda c: queries.count_street_types_by_suffix(c, 'straße')),
+        ('get_closest_address', lambda c: queries.get_closest_address(c, center)),
+        ('get_closest_addresses_queries',
+         lambda c: queries.get_closest_addresses(c, points[:GEOCODING_QUERIES], tree_threshold=GEOCODING_QUERIES + 1)),
+        ('get_closest_addresses_tree', lambda c: queries.get_closest_addresses(c, points, tree_threshold=1)),
+        ('get_streets_in_region', lambda c: queries.get_streets_in_region(c, region)),
+        ('get_ways_in_region', lambda c: queries.get_ways_in_region(c, region, tags={'highway': {'$exists': True}})),
+        ('get_trees_in_region', lambda c: queries.get_trees_in_region(c, region)),
+    ]
+    if districts is not None:
+        cases += [
+            ('get_streets_per_district', lambda c: queries.get_streets_per_district(c, districts)),
+            ('get_trees_per_district', lambda c: queries.get_trees_per_district(c, districts)),
+        ]
+    return cases
+
+
+def time_queries(collection: Collection, cases: List[Tuple[str, Callable[[Collection], Any]]],
+                 repeat: int = DEFAULT_REPEAT) -> Dict[str, Dict[str, Any]]:
+    """
+    Times queries with the query cache disabled.
+    :param collection: The collection.
+    :param cases: The name and the query of each benchmark, see query_cases().
+    :param repeat: The number of runs per query.
+    :return: The result of each query; queries the server does not support report an error instead.
+    """
+    results = {}
+    enabled = query_cache.enabled
+    query_cache.enabled = False
+    try:
+        for name, query in cases:
+            runs = []
+            try:
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    query(collection)
+                    runs.append(time.perf_counter() - start)
+            except (OperationFailure, NotImplementedError) as e:
+                results[name] = {'error': str(e)}
+                continue
+            results[name] = stage_result(runs, 1, 'queries')
+    finally:
+        query_cache.enabled = enabled
+    return results
+
+
+def run_benchmark(filename: str, collection: Collection, repeat: int = DEFAULT_REPEAT, batch_size: int = 1000,
+                  chunk_size: int = DEFAULT_CHUNK_SIZE, regions: Optional[RegionAssigner] = None,
+                  districts: Optional[Dict[str, GeoJSON]] = None, run_queries: bool = True,
+                  log: Callable[[str], None] = print) -> Dict[str, Any]:
+    """
+    Benchmarks all stages on an extract.
+    :param filename: The (compressed) extract.
+    :param collection: The collection to import into; it is dropped and recreated by every run.
+    :param repeat: The number of runs per stage.
+    :param batch_size: The number of documents per bulk write.
+    :param chunk_size: The number of elements passed through the pipeline stages at once.
+    :param regions: An optional assigner of districts and Bezirksregionen used during the writes.
+    :param districts: The district boundaries for the per-district queries, if available.
+    :param run_queries: Whether to benchmark the queries.
+    :param log: A function reporting progress.
+    :return: The stage and query results.
+    """
+    directory = tempfile.mkdtemp(prefix='osm-benchmark-')
+    try:
+        uncompressed = os.path.join(directory, 'extract.osm')
+        log(f'Timing decompression of {filename}')
+        stages = {'decompression': time_decompression(filename, uncompressed, repeat=repeat)}
+
+        runs = {}  # type: Dict[str, List[float]]
+        elements = 0
+        bbox = None
+        for run in range(repeat):
+            log(f'Timing the import, run {run + 1} of {repeat}')
+            times, elements, bbox = time_pipeline(uncompressed, collection, batch_size=batch_size,
+                                                  chunk_size=chunk_size, regions=regions)
+            for stage, seconds in times.items():
+                runs.setdefault(stage, []).append(seconds)
+        for stage, stage_runs in runs.items():
+            stages[stage] = stage_result(stage_runs, elements, 'elements')
+
+        query_results = {}
+        if run_queries:
+            log('Timing the queries')
+            query_results = time_queries(collection, query_cases(bbox, districts), repeat=repeat)
+        return {'file': filename, 'bytes': os.path.getsize(filename), 'elements': elements,
+                'stages': stages, 'queries': query_results}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def environment_info() -> Dict[str, Any]:
+    """
+    Describes the machine the benchmark runs on, which should match between compared runs.
+    """
+    return {
+        'created': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count()
+    }
+
+
+def flatten_results(results: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Gets the median time of every stage and query of a benchmark.
+    :param results: The results written by benchmark.py.
+    :return: The times by name, e.g. 'x1/stages/parsing' or 'x4/queries/count_elems'.
+    """
+    times = {}
+    for extract in results['extracts']:
+        for group in ('stages', 'queries'):
+            for name, result in extract[group].items():
+                if 'seconds' in result:
+                    times[f'x{extract["scale"]}/{group}/{name}'] = result['seconds']
+    return times
+
+
+def compare_results(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float = 0.1,
+                    min_seconds: float = 0.001) -> List[Tuple[str, float, float]]:
+    """
+    Finds the stages and queries that became slower than in a baseline.
+    :param baseline: The baseline results.
+    :param current: The current results.
+    :param tolerance: The relative slowdown that is tolerated, e.g. 0.1 for 10 %.
+    :param min_seconds: The absolute slowdown below which differences are considered noise.
+    :return: The name, baseline time and current time of each regression.
+    """
+    if baseline.get('version') != BENCHMARK_VERSION:
+        raise BenchmarkException('The baseline was written by an incompatible version of the benchmark.')
+    before, after = flatten_results(baseline), flatten_results(current)
+    regressions = []
+    for name in sorted(before.keys() & after.keys()):
+        if after[name] > before[name] * (1 + tolerance) and after[name] - before[name] > min_seconds:
+            regressions.append((name, before[name], after[name]))
+    return regressions
@@ -0,0 +1,312 @@
+"""
+A columnar, memory-mapped binary cache of a parsed OSM extract.
+
+The cache is a directory of NumPy arrays. Node coordinates, timestamps and user IDs
+are stored as plain columns, way node references and relation members use CSR-style
+offset arrays, and tag keys and values are interned into string tables referenced by
+integer codes. Timestamps are seconds since the epoch, or MISSING_TIMESTAMP for elements
+without one, like the uid -1 of elements without a user. Reopening a cache memory-maps
+the arrays, so only the pages that are actually accessed are read from disk.
+"""
+
+import os
+import json
+import hashlib
+import calendar
+from array import array
+from typing import Dict, List, Optional, Iterable
+
+import numpy as np
+from tqdm import tqdm
+
+from data_wrangling.xml_processing import open_elements
+
+CACHE_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+MEMBER_TYPES = ('node', 'way', 'relation')
+# The timestamp of elements without a timestamp attribute.
+MISSING_TIMESTAMP = -1
+
+
+class CacheException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class StringTable:
+    """
+    An immutable table of strings stored as a single UTF-8 blob and an offset array.
+    """
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self._blob = blob
+        self._offsets = offsets
+        self._codes = None  # type: Optional[Dict[str, int]]
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, code: int) -> str:
+        return bytes(self._blob[self._offsets[code]:self._offsets[code + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        return (self[code] for code in range(len(self)))
+
+    def code_of(self, value: str) -> int:
+        """
+        Gets the code of a string.
+        :param value: The string to look up.
+        :return: The code of the string or -1 if the table does not contain it.
+        """
+        if self._codes is None:
+            self._codes = {value: code for code, value in enumerate(self)}
+        return self._codes.get(value, -1)
+
+
+class ElementTable:
+    """
+    The columns of one element type (node, way or relation).
+    """
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        self.columns = columns
+        self._tag_owners = None  # type: Optional[np.ndarray]
+
+    def __len__(self) -> int:
+        return len(self.columns['id'])
+
+    def __getattr__(self, name: str) -> np.ndarray:
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    @property
+    def tag_owners(self) -> np.ndarray:
+        """
+        For each tag, the index of the element it belongs to.
+        """
+        if self._tag_owners is None:
+            offsets = self.columns['tag_offsets']
+            self._tag_owners = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        return self._tag_owners
+
+
+class ColumnarExtract:
+    """
+    A memory-mapped columnar cache of an OSM extract.
+    """
+    def __init__(self, directory: str, manifest: Dict, nodes: ElementTable, ways: ElementTable,
+                 relations: ElementTable, strings: Dict[str, StringTable]):
+        self.directory = directory
+        self.manifest = manifest
+        self.nodes = nodes
+        self.ways = ways
+        self.relations = relations
+        self.keys = strings['keys']
+        self.values = strings['values']
+        self.users = strings['users']
+        self.roles = strings['roles']
+
+    def table(self, element_type: str) -> ElementTable:
+        return {'node': self.nodes, 'way': self.ways, 'relation': self.relations}[element_type]
+
+    def tags(self, element_type: str, index: int) -> Dict[str, str]:
+        """
+        Gets the tags of an element.
+        :param element_type: The element type, e.g. 'node'.
+        :param index: The index of the element within its table.
+        :return: The tags.
+        """
+        table = self.table(element_type)
+        begin, end = table.tag_offsets[index], table.tag_offsets[index + 1]
+        return {self.keys[k]: self.values[v] for k, v in zip(table.tag_keys[begin:end], table.tag_values[begin:end])}
+
+    def tag_mask(self, element_type: str, key: str, value: Optional[str] = None) -> np.ndarray:
+        """
+        Determines the elements having a tag.
+        :param element_type: The element type, e.g. 'node'.
+        :param key: The tag key.
+        :param value: The tag value; if None, any value matches.
+        :return: A boolean mask over the elements of the table.
+        """
+        table = self.table(element_type)
+        mask = np.zeros(len(table), dtype=bool)
+        key_code = self.keys.code_of(key)
+        if key_code < 0:
+            return mask
+        matches = table.tag_keys == key_code
+        if value is not None:
+            value_code = self.values.code_of(value)
+            if value_code < 0:
+                return mask
+            matches &= table.tag_values == value_code
+        mask[table.tag_owners[matches]] = True
+        return mask
+
+
+class _Interner:
+    def __init__(self):
+        self._codes = {}  # type: Dict[str, int]
+        self._strings = []  # type: List[str]
+
+    def __call__(self, value: str) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self._strings)
+            self._strings.append(value)
+        return code
+
+    def save(self, directory: str, name: str):
+        encoded = [s.encode('utf-8') for s in self._strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        np.save(os.path.join(directory, f'{name}.blob.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        np.save(os.path.join(directory, f'{name}.offsets.npy'), offsets)
+
+
+class _TableBuilder:
+    def __init__(self, columns: Dict[str, str]):
+        self.columns = {name: array(typecode) for name, typecode in columns.items()}
+        self.columns['tag_offsets'].append(0)
+
+    def save(self, directory: str, prefix: str):
+        for name, values in self.columns.items():
+            np.save(os.path.join(directory, f'{prefix}.{name}.npy'), np.frombuffer(values, dtype=values.typecode)
+                    if len(values) > 0 else np.zeros(0, dtype=values.typecode))
+
+
+def _common_columns() -> Dict[str, str]:
+    return {'id': 'q', 'timestamp': 'q', 'uid': 'q', 'user': 'i',
+            'tag_offsets': 'q', 'tag_keys': 'i', 'tag_values': 'i'}
+
+
+def _parse_timestamp(value: str) -> int:
+    # 2015-11-15T09:51:47Z; the typed elements report a missing timestamp as ''.
+    if len(value) == 0:
+        return MISSING_TIMESTAMP
+    return calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                            int(value[11:13]), int(value[14:16]), int(value[17:19])))
+
+
+def file_hash(filename: str) -> str:
+    """
+    Computes the SHA-256 hash of a file.
+    :param filename: The file.
+    :return: The hex digest.
+    """
+    sha = hashlib.sha256()
+    with open(filename, mode='rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def build_cache(filename: str, directory: str, progress: Optional[tqdm] = None,
+                decompress_workers: Optional[int] = None) -> ColumnarExtract:
+    """
+    Parses an OSM extract and writes it to a columnar cache.
+    :param filename: The OSM file to parse.
+    :param directory: The cache directory to create.
+    :param progress: An optional progress bar.
+    :param decompress_workers: The number of processes used to decompress bzip2 files.
+    :return: The opened cache.
+    """
+    keys, values, users, roles = _Interner(), _Interner(), _Interner(), _Interner()
+    nodes = _TableBuilder(dict(_common_columns(), lat='d', lon='d'))
+    ways = _TableBuilder(dict(_common_columns(), node_offsets='q', node_refs='q'))
+    relations = _TableBuilder(dict(_common_columns(), member_offsets='q', member_types='b',
+                                   member_refs='q', member_roles='i'))
+    ways.columns['node_offsets'].append(0)
+    relations.columns['member_offsets'].append(0)
+    builders = {'node': nodes, 'way': ways, 'relation': relations}
+    member_types = {name: code for code, name in enumerate(MEMBER_TYPES)}
+
+    for el in open_elements(filename, progress=progress, decompress_workers=decompress_workers):
+        columns = builders[el.type].columns
+        columns['id'].append(el.id)
+        columns['timestamp'].append(_parse_timestamp(el.timestamp))
+        columns['uid'].append(el.uid)
+        columns['user'].append(users(el.user))
+        tag_keys, tag_values = columns['tag_keys'], columns['tag_values']
+        for key, value in el.tags.items():
+            tag_keys.append(keys(key))
+            tag_values.append(values(value))
+        if el.type == 'node':
+            columns['lat'].append(el.lat)
+            columns['lon'].append(el.lon)
+        elif el.type == 'way':
+            columns['node_refs'].extend(el.nodes)
+            columns['node_offsets'].append(len(columns['node_refs']))
+        else:
+            for member_type, ref, role in el.members:
+                columns['member_types'].append(member_types[member_type])
+                columns['member_refs'].append(ref)
+                columns['member_roles'].append(roles(role))
+            columns['member_offsets'].append(len(columns['member_refs']))
+        columns['tag_offsets'].append(len(tag_keys))
+
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    for element_type, builder in builders.items():
+        builder.save(directory, element_type)
+    for name, interner in (('keys', keys), ('values', values), ('users', users), ('roles', roles)):
+        interner.save(directory, name)
+
+    stat = os.stat(filename)
+    manifest = {
+        'version': CACHE_VERSION,
+        'source': {
+            'path': os.path.abspath(filename),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': file_hash(filename)
+        },
+        'counts': {element_type: len(builder.columns['id']) for element_type, builder in builders.items()}
+    }
+    # The manifest is written last so that an interrupted build is not mistaken for a valid cache.
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return open_cache(directory)
+
+
+def open_cache(directory: str, source: Optional[str] = None) -> ColumnarExtract:
+    """
+    Opens a columnar cache by memory-mapping its arrays.
+    :param directory: The cache directory.
+    :param source: If specified, the OSM file the cache must have been built from. If the file's
+                   size or modification time changed, its hash is compared to the one of the cache.
+    :return: The opened cache.
+    """
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        raise CacheException(f'No cache found in {directory}.')
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != CACHE_VERSION:
+        raise CacheException(f'Unsupported cache version {manifest.get("version")}; expected {CACHE_VERSION}.')
+    if source is not None and not _matches_source(manifest['source'], source):
+        raise CacheException(f'The cache in {directory} was not built from {source}.')
+
+    def load(name: str) -> np.ndarray:
+        return np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+
+    def load_table(element_type: str, columns: Iterable[str]) -> ElementTable:
+        return ElementTable({column: load(f'{element_type}.{column}') for column in columns})
+
+    common = list(_common_columns().keys())
+    nodes = load_table('node', common + ['lat', 'lon'])
+    ways = load_table('way', common + ['node_offsets', 'node_refs'])
+    relations = load_table('relation', common + ['member_offsets', 'member_types', 'member_refs', 'member_roles'])
+    strings = {name: StringTable(load(f'{name}.blob'), load(f'{name}.offsets'))
+               for name in ('keys', 'values', 'users', 'roles')}
+    return ColumnarExtract(directory, manifest, nodes, ways, relations, strings)
+
+
+def _matches_source(recorded: Dict, filename: str) -> bool:
+    stat = os.stat(filename)
+    if stat.st_size != recorded['size']:
+        return False
+    if stat.st_mtime == recorded['mtime']:
+        return True
+    return file_hash(filename) == recorded['sha256']
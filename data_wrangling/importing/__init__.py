@@ -0,0 +1,10 @@
+from .documents import elem_to_doc, parse_date
+from .writer import BulkWriter, is_empty, create_indexes, index_models, create_geometry_index
+from .dump import DumpWriter, encode_document, collection_metadata
+from .pipeline import ImportPipeline
+from .checkpoints import Checkpointer, FileCheckpointStore, MongoCheckpointStore, skip_committed, source_info
+from .locations import NodeLocationStore, StoredLocations, LocationStoreException, way_geometry
+from .regions import RegionAssigner, load_region_assigner, representative_point, DISTRICT_FIELD, REGION_FIELD
+from .statistics import ImportStatistics, DEFAULT_VALUE_KEYS, statistics_collection, read_statistics, read_count
+from .address_index import AddressIndex, address_collection, address_document, is_address_index_complete
+from .tag_tokens import TOKEN_FIELD, tag_token, tag_tokens, tag_filter, has_tag_tokens, ensure_tag_tokens
@@ -0,0 +1,184 @@
+"""
+A compact collection of the addressable nodes of an imported collection, used for reverse geocoding.
+
+The collection is named after the imported one with an _addresses suffix and holds one document per
+node with a street name and a house number, covered by a 2dsphere index:
+
+    {'_id': node id, 'loc': {'type': 'Point', ...}, 'street': ..., 'house_no': ..., 'postcode': ..., 'city': ...}
+
+It is maintained by the writers while loading. Whether it is complete is recorded in the osm_meta
+collection; an incomplete index, e.g. after an interrupted load, is rebuilt before the next load.
+"""
+
+import threading
+from typing import Dict, List, Tuple, Optional, Any
+
+from pymongo import ReplaceOne, DeleteOne, GEOSPHERE
+from pymongo.collection import Collection
+
+from .tag_tokens import tag_filter, has_tag_tokens
+from .statistics import Summary
+
+META_COLLECTION = 'osm_meta'
+STREET_KEY = 'addr:street'
+HOUSE_NUMBER_KEY = 'addr:housenumber'
+# Optional address tags copied to the address documents.
+EXTRA_KEYS = {'postcode': 'addr:postcode', 'city': 'addr:city'}
+
+
+def address_collection(collection: Collection) -> Collection:
+    return collection.database.get_collection(f'{collection.name}_addresses')
+
+
+def address_meta_id(collection: Collection) -> str:
+    return f'addresses:{collection.name}'
+
+
+def is_address_index_complete(collection: Collection) -> bool:
+    """
+    Determines whether the address collection of an imported collection is complete.
+    :param collection: The imported collection.
+    :return: True if the address collection can be used.
+    """
+    meta = collection.database.get_collection(META_COLLECTION).find_one({'_id': address_meta_id(collection)})
+    return meta is not None and meta.get('complete', False)
+
+
+def address_document(id: Dict, doc: Dict) -> Optional[Dict]:
+    """
+    Converts the document of a node to an address document.
+    :param id: The ID of the node document.
+    :param doc: The node document.
+    :return: The address document, or None if the node has no address.
+    """
+    tags = doc.get('tags')
+    if tags is None or STREET_KEY not in tags or HOUSE_NUMBER_KEY not in tags or 'loc' not in doc:
+        return None
+    address = {'_id': id['id'], 'loc': doc['loc'], 'street': tags[STREET_KEY], 'house_no': tags[HOUSE_NUMBER_KEY]}
+    for field, key in EXTRA_KEYS.items():
+        if key in tags:
+            address[field] = tags[key]
+    return address
+
+
+class AddressIndex:
+    """
+    Maintains the address collection of an imported collection. An instance may be shared by several writer threads.
+    """
+    def __init__(self, collection: Collection, batch_size: int = 1000):
+        """
+        Initializes the index.
+        :param collection: The imported collection.
+        :param batch_size: The number of address changes to send per bulk write.
+        """
+        self._collection = collection
+        self._addresses = address_collection(collection)
+        self._meta = collection.database.get_collection(META_COLLECTION)
+        self._batch_size = batch_size
+        self._requests = []  # type: List[Any]
+        self._lock = threading.Lock()
+        self._rebuilt = False
+
+    @property
+    def rebuilt(self) -> bool:
+        """
+        Whether the address collection had to be rebuilt from the collection when the load began.
+        """
+        return self._rebuilt
+
+    def begin(self, empty: bool):
+        """
+        Prepares the address collection for a load and marks it as incomplete until finish() is called.
+        :param empty: Whether the imported collection is empty.
+        """
+        self._addresses.create_index([('loc', GEOSPHERE)], background=True)
+        if empty:
+            self._addresses.delete_many({})
+        elif not is_address_index_complete(self._collection):
+            self.rebuild()
+            self._rebuilt = True
+        self._set_complete(False)
+
+    def finish(self):
+        """
+        Writes the remaining changes and marks the address collection as complete.
+        """
+        self.flush()
+        self._set_complete(True)
+
+    def rebuild(self):
+        """
+        Recreates the address collection from the imported collection.
+        """
+        self._addresses.delete_many({})
+        cursor = self._collection.find({'_id.type': 'node',
+                                        **tag_filter({STREET_KEY: {'$exists': True},
+                                                      HOUSE_NUMBER_KEY: {'$exists': True}},
+                                                     tokens=has_tag_tokens(self._collection))},
+                                       projection={'loc': True, 'tags': True})
+        for doc in cursor:
+            address = address_document(doc['_id'], doc)
+            if address is not None:
+                self._add(ReplaceOne({'_id': address['_id']}, address, upsert=True))
+        self.flush()
+
+    def record(self, written: List[Tuple[Dict, Optional[Dict]]], upsert: bool, replace: bool = True,
+               priors: Optional[Dict[Tuple, Summary]] = None):
+        """
+        Records written documents.
+        :param written: The IDs and documents (None for deletions) that were written.
+        :param upsert: Whether the documents may have existed before, in which case nodes
+                       without an address remove a previous address.
+        :param replace: Whether the documents replaced existing ones; otherwise, their fields were set,
+                        which keeps the tags, and thereby the address, of existing documents written without tags.
+        :param priors: The summaries of the documents before they were written, see ImportStatistics.load;
+                       if None, the address collection is queried for the previous addresses.
+        """
+        removed = []  # type: List[Dict]
+        for id, doc in written:
+            if id['type'] != 'node':
+                continue
+            address = address_document(id, doc) if doc is not None else None
+            if address is not None:
+                self._add(ReplaceOne({'_id': address['_id']}, address, upsert=True))
+            elif upsert and (doc is None or replace or 'tags' in doc):
+                removed.append(id)
+        if len(removed) > 0:
+            # Only nodes that had an address need a deletion.
+            for id in self._addressed(removed, priors):
+                self._add(DeleteOne({'_id': id['id']}))
+
+    def _addressed(self, ids: List[Dict], priors: Optional[Dict[Tuple, Summary]]) -> List[Dict]:
+        """
+        Determines which of the given nodes had an address before they were written.
+        """
+        if priors is not None:
+            return [id for id in ids if _has_address(priors.get((id['type'], id['id'])))]
+        stored = {doc['_id'] for doc in self._addresses.find({'_id': {'$in': [id['id'] for id in ids]}},
+                                                             projection={'_id': True})}
+        return [id for id in ids if id['id'] in stored]
+
+    def _add(self, request: Any):
+        with self._lock:
+            self._requests.append(request)
+            if len(self._requests) < self._batch_size:
+                return
+        self.flush()
+
+    def flush(self):
+        """
+        Writes the recorded changes.
+        """
+        with self._lock:
+            requests, self._requests = self._requests, []
+        if len(requests) > 0:
+            # Ordered, since a change file may change the same node more than once.
+            self._addresses.bulk_write(requests, ordered=True)
+
+    def _set_complete(self, complete: bool):
+        self._meta.replace_one({'_id': address_meta_id(self._collection)},
+                               {'_id': address_meta_id(self._collection), 'complete': complete}, upsert=True)
+
+
+def _has_address(summary: Optional[Summary]) -> bool:
+    return summary is not None and STREET_KEY in summary[1] and HOUSE_NUMBER_KEY in summary[1]
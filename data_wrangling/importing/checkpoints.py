@@ -0,0 +1,165 @@
+import os
+import json
+from typing import Dict, Optional, Any, Iterable, Tuple, Callable, List
+
+from lxml.etree import Element
+from pymongo.collection import Collection
+
+# The order of the element types in an OSM file.
+ELEMENT_ORDER = {'node': 0, 'way': 1, 'relation': 2}
+
+CommitCallback = Callable[[str, int, Dict[str, Any], int], None]
+
+
+class FileCheckpointStore:
+    """
+    Stores the import checkpoint in a JSON sidecar file.
+    """
+    def __init__(self, path: str):
+        self._path = path
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        if not os.path.exists(self._path):
+            return None
+        with open(self._path, 'r') as f:
+            return json.load(f)
+
+    def save(self, checkpoint: Dict[str, Any]):
+        # Writing to a temporary file first ensures that a crash never leaves a partial checkpoint.
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(temp_path, self._path)
+
+    def clear(self):
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+
+class MongoCheckpointStore:
+    """
+    Stores the import checkpoint as a document in a metadata collection.
+    """
+    def __init__(self, collection: Collection, key: str):
+        self._collection = collection
+        self._key = key
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        doc = self._collection.find_one({'_id': self._key})
+        if doc is None:
+            return None
+        del doc['_id']
+        return doc
+
+    def save(self, checkpoint: Dict[str, Any]):
+        doc = {'_id': self._key}
+        doc.update(checkpoint)
+        self._collection.replace_one({'_id': self._key}, doc, upsert=True)
+
+    def clear(self):
+        self._collection.delete_one({'_id': self._key})
+
+
+def source_info(filename: str) -> Dict[str, Any]:
+    """
+    Describes an input file, so that checkpoints are only applied to the file they were written for.
+    :param filename: The input file.
+    :return: The description.
+    """
+    stat = os.stat(filename)
+    return {'path': os.path.abspath(filename), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+class Checkpointer:
+    """
+    Periodically saves the position up to which all elements were committed to the database.
+    """
+    def __init__(self, store: Any, source: Dict[str, Any], interval: int):
+        """
+        Initializes the checkpointer.
+        :param store: The checkpoint store, e.g. a FileCheckpointStore.
+        :param source: The description of the input file, see source_info.
+        :param interval: The minimum number of documents between two checkpoints.
+        """
+        self._store = store
+        self._source = source
+        self._interval = interval
+        self._resumed_documents = 0
+        self._saved_documents = 0
+        self._checkpoints = 0
+        self._before_save = []  # type: List[Callable[[], None]]
+
+    @property
+    def checkpoints(self) -> int:
+        return self._checkpoints
+
+    def before_save(self, callback: Callable[[], None]):
+        """
+        Registers a function that is called right before each checkpoint is saved,
+        e.g. to save state that resuming from the checkpoint relies on.
+        :param callback: The function.
+        """
+        self._before_save.append(callback)
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """
+        Loads the last checkpoint if it belongs to the current input file.
+        :return: The checkpoint or None.
+        """
+        checkpoint = self._store.load()
+        if checkpoint is None or checkpoint.get('source') != self._source:
+            return None
+        self._resumed_documents = self._saved_documents = checkpoint['documents']
+        return checkpoint
+
+    def committed(self, element_type: str, element_id: int, position: Dict[str, Any], documents: int):
+        """
+        Reports that all elements up to and including the given one were committed.
+        :param element_type: The type of the last committed element.
+        :param element_id: The ID of the last committed element.
+        :param position: The input position to resume from, see InputFile.resume_point.
+        :param documents: The number of documents committed since the import was (re)started.
+        """
+        documents += self._resumed_documents
+        if documents - self._saved_documents < self._interval:
+            return
+        for callback in self._before_save:
+            callback()
+        self._store.save({
+            'source': self._source,
+            'type': element_type,
+            'id': element_id,
+            'position': position,
+            'documents': documents
+        })
+        self._saved_documents = documents
+        self._checkpoints += 1
+
+    def finish(self):
+        """
+        Removes the checkpoint after a completed import.
+        """
+        self._store.clear()
+
+
+def element_key(element_type: str, element_id: int) -> Tuple[int, int]:
+    return ELEMENT_ORDER[element_type], element_id
+
+
+def skip_committed(events: Iterable[Tuple[str, Element]],
+                   checkpoint: Dict[str, Any]) -> Iterable[Tuple[str, Element]]:
+    """
+    Skips the events of all elements up to and including the last committed element of a checkpoint.
+    This relies on the OSM convention of ordering elements by type and ID.
+    :param events: The parser events.
+    :param checkpoint: The checkpoint.
+    :return: The events of the elements that were not yet committed.
+    """
+    last = element_key(checkpoint['type'], checkpoint['id'])
+    skipping = True
+    for ev, el in events:
+        if skipping and el.tag in ELEMENT_ORDER:
+            if element_key(el.tag, int(el.attrib['id'])) <= last:
+                continue
+            skipping = False
+        yield ev, el
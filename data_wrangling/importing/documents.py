@@ -0,0 +1,83 @@
+from datetime import datetime
+from typing import Dict, Tuple, Optional, Union
+
+import bson
+from xml.etree.cElementTree import Element
+
+from .locations import NodeLocationStore, StoredLocations, way_geometry
+from .tag_tokens import TOKEN_FIELD, tag_tokens
+
+# The fields holding the names of the district and Bezirksregion of a document, see RegionAssigner.
+DISTRICT_FIELD = 'district'
+REGION_FIELD = 'region'
+
+
+def parse_date(inp: str) -> datetime:
+    # 2015-11-15T09:51:47Z
+    return datetime.strptime(inp, '%Y-%m-%dT%H:%M:%SZ')
+
+
+def elem_to_doc(el: Element,
+                locations: Optional[Union[NodeLocationStore, StoredLocations]] = None) -> Tuple[Dict, Dict]:
+    id = {
+            'type': el.tag,
+            'id': bson.Int64(el.attrib['id'])
+        }
+
+    time = parse_date(el.attrib['timestamp'])
+    user = {
+                'name': el.attrib['user'],
+                'id': el.attrib['uid']
+            }
+
+    doc = {}
+    if el.tag == 'node':
+        doc = {
+            't': time,
+            'user': user,
+            'loc': {
+                'type': 'Point',
+                'coordinates': [
+                    float(el.attrib['lon']),
+                    float(el.attrib['lat'])
+                ]
+            }
+        }
+    elif el.tag == 'way':
+        doc = {
+            't': time,
+            'user': user,
+            'nodes': [bson.Int64(x.attrib['ref']) for x in el.iter('nd')]
+        }
+    elif el.tag == 'relation':
+        doc = {
+            't': time,
+            'user': user,
+            'members': [
+                {
+                    'type': x.attrib['type'],
+                    'ref': bson.Int64(x.attrib['ref']),
+                    'role': x.attrib['role']
+                }
+                for x in el.iter('member')
+            ]
+        }
+
+    tags = {}
+    for tag in el.iter('tag'):
+        key = tag.attrib['k']
+        value = tag.attrib['v']
+        tags[key] = value
+
+    if len(tags) > 0:
+        doc['tags'] = tags
+        doc['tag_keys'] = list(tags.keys())
+        doc['tag_values'] = '\n'.join(list(tags.values()))
+        doc[TOKEN_FIELD] = tag_tokens(tags)
+
+    if locations is not None and el.tag == 'way':
+        geometry = way_geometry(doc['nodes'], tags, locations)
+        if geometry is not None:
+            doc['geometry'], doc['bbox'] = geometry
+
+    return id, doc
@@ -0,0 +1,207 @@
+"""
+Writes the documents of an import as BSON files in the layout of mongodump, to be loaded with mongorestore.
+
+Each collection is stored as <directory>/<database>/<collection>.bson, a plain concatenation of BSON documents,
+along with <collection>.metadata.json describing its indexes, which mongorestore builds after loading the documents.
+Optionally, the documents are split into one file per element type, e.g. osm_berlin.node.bson, which can be restored
+into the same collection one after another or selectively.
+"""
+
+import os
+import time
+import threading
+from typing import Dict, List, Tuple, Callable, Optional, Any, Iterable
+
+import bson
+from bson import json_util
+from pymongo import IndexModel
+
+from .writer import _with_id
+
+ELEMENT_TYPES = ('node', 'way', 'relation')
+# The size of the write buffer of each file.
+BUFFER_SIZE = 1 << 20
+
+
+def encode_document(id: Dict, doc: Dict) -> bytes:
+    """
+    Encodes a document and its ID as BSON, as it would be inserted into the collection.
+    :param id: The document ID.
+    :param doc: The document, without its ID.
+    :return: The encoded document.
+    """
+    return bson.encode(_with_id(id, doc))
+
+
+def collection_metadata(namespace: str, indexes: Iterable[IndexModel]) -> Dict[str, Any]:
+    """
+    Gets the metadata mongorestore reads for a collection.
+    :param namespace: The namespace of the collection, i.e. <database>.<collection>.
+    :param indexes: The indexes of the collection, in addition to the one on _id.
+    :return: The metadata document.
+    """
+    specs = [{'v': 2, 'key': {'_id': 1}, 'name': '_id_', 'ns': namespace}]
+    for index in indexes:
+        spec = {'v': 2}
+        spec.update(index.document)
+        spec['ns'] = namespace
+        specs.append(spec)
+    return {'options': {}, 'indexes': specs}
+
+
+class DumpWriter:
+    """
+    Writes documents to a mongodump directory instead of a collection. It can be used in place of
+    a BulkWriter that inserts into an empty collection, but does not maintain the statistics or the
+    address collection, which are rebuilt once the dump was restored.
+    The writer may be shared by several threads.
+    """
+    def __init__(self, directory: str, database: str, collection: str, split: bool = False,
+                 batch_size: int = 1000, indexes: Iterable[IndexModel] = (),
+                 prepare: Optional[Callable[[List[Tuple[Dict, Optional[Dict]]]], Any]] = None):
+        """
+        Initializes the writer, replacing the files of an earlier dump of the same collection.
+        :param directory: The dump directory, which contains one directory per database.
+        :param database: The name of the database.
+        :param collection: The name of the collection.
+        :param split: If True, the documents of each element type are written to a separate file.
+        :param batch_size: The number of documents to encode and write at once.
+        :param indexes: The indexes to create when restoring, see index_models.
+        :param prepare: A function applied to each batch of IDs and documents right before it is
+                        written, e.g. to assign regions to all documents at once.
+        """
+        assert batch_size > 0, 'The batch size must be positive.'
+        self._directory = os.path.join(directory, database)
+        self._namespace = f'{database}.{collection}'
+        self._batch_size = batch_size
+        self._prepare = prepare
+        names = {element_type: f'{collection}.{element_type}' for element_type in ELEMENT_TYPES} if split \
+            else dict.fromkeys(ELEMENT_TYPES, collection)
+        os.makedirs(self._directory, exist_ok=True)
+        metadata = json_util.dumps(collection_metadata(self._namespace, indexes))
+        self._files = {}  # type: Dict[str, Any]
+        opened = {}  # type: Dict[str, Any]
+        for element_type, name in names.items():
+            if name not in opened:
+                with open(os.path.join(self._directory, f'{name}.metadata.json'), 'w', encoding='utf-8') as f:
+                    f.write(metadata)
+                opened[name] = open(os.path.join(self._directory, f'{name}.bson'), 'wb', buffering=BUFFER_SIZE)
+            self._files[element_type] = opened[name]
+        self._batch = []  # type: List[Tuple[Dict, Optional[Dict]]]
+        self._lock = threading.Lock()
+        self._documents_written = 0
+        self._bytes_written = 0
+        self._batches_written = 0
+        self._write_time = 0.
+
+    @property
+    def directory(self) -> str:
+        """
+        The directory of the database, i.e. the one containing the BSON files.
+        """
+        return self._directory
+
+    @property
+    def namespace(self) -> str:
+        """
+        The namespace the dump is restored to, i.e. <database>.<collection>.
+        """
+        return self._namespace
+
+    @property
+    def files(self) -> List[str]:
+        """
+        The BSON files that were written.
+        """
+        return sorted({f.name for f in self._files.values()})
+
+    @property
+    def upsert(self) -> bool:
+        return False
+
+    @property
+    def documents_written(self) -> int:
+        return self._documents_written
+
+    @property
+    def bytes_written(self) -> int:
+        return self._bytes_written
+
+    @property
+    def batches_written(self) -> int:
+        return self._batches_written
+
+    @property
+    def errors(self) -> int:
+        return 0
+
+    @property
+    def write_time(self) -> float:
+        return self._write_time
+
+    @property
+    def pending(self) -> int:
+        """
+        The number of documents added but not yet written.
+        """
+        return len(self._batch)
+
+    def add(self, id: Dict, doc: Dict):
+        """
+        Adds a document to the current batch and writes the batch if it is full.
+        :param id: The document ID.
+        :param doc: The document, without its ID.
+        """
+        self._batch.append((id, doc))
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+
+    def add_encoded(self, documents: Iterable[Tuple[str, bytes]]):
+        """
+        Writes documents that were encoded already, e.g. by worker processes.
+        :param documents: The element types and the encoded documents, see encode_document.
+        """
+        start = time.perf_counter()
+        grouped = {}  # type: Dict[str, List[bytes]]
+        count = 0
+        for element_type, data in documents:
+            grouped.setdefault(element_type, []).append(data)
+            count += 1
+        with self._lock:
+            for element_type, encoded in grouped.items():
+                data = b''.join(encoded)
+                self._files[element_type].write(data)
+                self._bytes_written += len(data)
+            self._documents_written += count
+            self._batches_written += 1
+            self._write_time += time.perf_counter() - start
+
+    def flush(self):
+        """
+        Writes all pending documents.
+        """
+        if len(self._batch) == 0:
+            return
+        batch, self._batch = self._batch, []
+        if self._prepare is not None:
+            self._prepare(batch)
+        self.add_encoded([(id['type'], encode_document(id, doc)) for id, doc in batch])
+
+    def close(self):
+        """
+        Writes all pending documents and closes the files.
+        """
+        self.flush()
+        with self._lock:
+            for f in set(self._files.values()):
+                f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return f'{type(self).__name__}: wrote {self.documents_written} documents ' \
+               f'({self.bytes_written / 2 ** 20:.1f} MiB) to {len(self.files)} files in {self._directory}'
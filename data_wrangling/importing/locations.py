@@ -0,0 +1,356 @@
+"""
+An on-disk store of node locations used to resolve the geometries of ways.
+
+The store consists of two flat binary files: the sorted node IDs as 64 bit integers and
+the locations as pairs of 32 bit fixed-point integers with a resolution of 1e-7 degrees,
+which is the precision of OSM coordinates. Both files are memory-mapped for lookups, so
+the store costs 16 bytes of disk space per node and only the accessed pages of memory.
+Node IDs are located by binary search, which supports arbitrarily sparse IDs.
+While the nodes are read, the store can be saved along with import checkpoints and resumed.
+
+When changes are applied to an imported collection, StoredLocations looks up the nodes
+of the changed ways in the node documents of the collection instead.
+"""
+
+import os
+import json
+import threading
+from array import array
+from typing import Dict, List, Optional, Tuple, Any, Iterable, Union
+
+import bson
+import numpy as np
+from pymongo.collection import Collection
+
+STORE_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+# Describes the nodes saved so far while the store is incomplete.
+PARTIAL_FILE = 'partial.json'
+IDS_FILE = 'ids.bin'
+COORDINATES_FILE = 'coordinates.bin'
+SCALE = 10 ** 7
+
+_FLUSH_SIZE = 1024 * 1024
+
+# Closed ways with one of these keys are lines (e.g. roundabouts) unless tagged with area=yes.
+_LINEAR_KEYS = {'highway', 'barrier', 'railway', 'waterway', 'power'}
+
+
+class LocationStoreException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class NodeLocationStore:
+    """
+    Stores node locations while the nodes of a file are read and looks them up afterwards.
+    Nodes may be added while another thread saves the store, see save_partial.
+    """
+    def __init__(self, directory: str, source: Optional[Dict[str, Any]] = None):
+        """
+        Creates an empty store.
+        :param directory: The directory to create the store in.
+        :param source: An optional description of the input file, e.g. from checkpoints.source_info.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in (MANIFEST_FILE, PARTIAL_FILE):
+            if os.path.exists(os.path.join(directory, name)):
+                os.remove(os.path.join(directory, name))
+        self._init(directory, source, 'wb')
+
+    def _init(self, directory: str, source: Optional[Dict[str, Any]], mode: str):
+        self._directory = directory
+        self._source = source
+        self._ids_file = open(os.path.join(directory, IDS_FILE), mode)
+        self._coordinates_file = open(os.path.join(directory, COORDINATES_FILE), mode)
+        self._ids = array('q')
+        self._coordinates = array('i')
+        self._count = 0
+        self._last_id = None  # type: Optional[int]
+        self._sorted = True
+        # When resuming, nodes up to this ID were saved already and are read again.
+        self._skip_until = None  # type: Optional[int]
+        self._lock = threading.Lock()
+        self._id_index = None  # type: Optional[np.ndarray]
+        self._locations = None  # type: Optional[np.ndarray]
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    @property
+    def finished(self) -> bool:
+        return self._id_index is not None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, id: int, lat: str, lon: str):
+        """
+        Adds the location of a node.
+        :param id: The node ID.
+        :param lat: The latitude as given in the file.
+        :param lon: The longitude as given in the file.
+        """
+        assert self._id_index is None, 'The store was already finished.'
+        if self._skip_until is not None:
+            if id <= self._skip_until:
+                return
+            self._skip_until = None
+        with self._lock:
+            if self._last_id is not None and id <= self._last_id:
+                self._sorted = False
+            self._last_id = id
+            self._ids.append(id)
+            self._coordinates.append(round(float(lon) * SCALE))
+            self._coordinates.append(round(float(lat) * SCALE))
+            self._count += 1
+            if len(self._ids) >= _FLUSH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        self._ids.tofile(self._ids_file)
+        self._coordinates.tofile(self._coordinates_file)
+        self._ids = array('q')
+        self._coordinates = array('i')
+
+    def save_partial(self):
+        """
+        Saves the nodes added so far, so that an interrupted import can resume the store, see resume.
+        This is called before a checkpoint is saved and may be called from another thread than add.
+        """
+        with self._lock:
+            if self._id_index is not None:
+                return
+            self._flush()
+            self._ids_file.flush()
+            self._coordinates_file.flush()
+            state = {'version': STORE_VERSION, 'count': self._count, 'source': self._source,
+                     'last_id': self._last_id, 'sorted': self._sorted}
+        path = os.path.join(self._directory, PARTIAL_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def resume(cls, directory: str, source: Optional[Dict[str, Any]] = None) -> 'NodeLocationStore':
+        """
+        Opens an incomplete store saved by save_partial to add the remaining nodes.
+        Nodes added after it was saved are discarded. If the store was finished already,
+        it is opened for lookups instead.
+        :param directory: The store directory.
+        :param source: If specified, the description of the input file the store must have been built from.
+        :return: The store.
+        """
+        if os.path.isfile(os.path.join(directory, MANIFEST_FILE)):
+            return cls.open(directory, source=source)
+        path = os.path.join(directory, PARTIAL_FILE)
+        if not os.path.isfile(path):
+            raise LocationStoreException(f'No saved node location store found in {directory}.')
+        with open(path, 'r') as f:
+            state = json.load(f)
+        if state.get('version') != STORE_VERSION:
+            raise LocationStoreException(f'Unsupported node location store version {state.get("version")}.')
+        if source is not None and state.get('source') != source:
+            raise LocationStoreException(f'The node location store in {directory} was built from another file.')
+        count = state['count']
+        for name, size in ((IDS_FILE, 8), (COORDINATES_FILE, 8)):
+            file_path = os.path.join(directory, name)
+            if not os.path.isfile(file_path) or os.path.getsize(file_path) < count * size:
+                raise LocationStoreException(f'The node location store in {directory} is incomplete.')
+            os.truncate(file_path, count * size)
+        store = cls.__new__(cls)
+        store._init(directory, state.get('source'), 'ab')
+        store._count = count
+        store._last_id = state['last_id']
+        store._sorted = state['sorted']
+        if store._sorted:
+            # The nodes after the checkpoint are read again, but some of them may have been saved already.
+            store._skip_until = store._last_id
+        return store
+
+    def finish(self):
+        """
+        Completes the store after all nodes were added and opens it for lookups.
+        """
+        with self._lock:
+            if self._id_index is not None:
+                return
+            self._flush()
+            self._ids_file.close()
+            self._coordinates_file.close()
+            if not self._sorted:
+                # OSM files are sorted by ID, so this is only needed for unusual inputs.
+                self._sort()
+            manifest = {'version': STORE_VERSION, 'count': self._count, 'source': self._source}
+            with open(os.path.join(self._directory, MANIFEST_FILE), 'w') as f:
+                json.dump(manifest, f)
+            partial_path = os.path.join(self._directory, PARTIAL_FILE)
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            self._id_index, self._locations = _map(self._directory, self._count)
+
+    def _sort(self):
+        ids = np.fromfile(os.path.join(self._directory, IDS_FILE), dtype=np.int64)
+        coordinates = np.fromfile(os.path.join(self._directory, COORDINATES_FILE), dtype=np.int32).reshape(-1, 2)
+        order = np.argsort(ids, kind='stable')
+        ids, coordinates = ids[order], coordinates[order]
+        # For duplicate IDs, the last location wins.
+        last = np.append(ids[1:] != ids[:-1], True)
+        ids, coordinates = ids[last], coordinates[last]
+        ids.tofile(os.path.join(self._directory, IDS_FILE))
+        coordinates.tofile(os.path.join(self._directory, COORDINATES_FILE))
+        self._count = len(ids)
+
+    @classmethod
+    def open(cls, directory: str, source: Optional[Dict[str, Any]] = None) -> 'NodeLocationStore':
+        """
+        Opens a finished store for lookups.
+        :param directory: The store directory.
+        :param source: If specified, the description of the input file the store must have been built from.
+        :return: The store.
+        """
+        manifest_path = os.path.join(directory, MANIFEST_FILE)
+        if not os.path.isfile(manifest_path):
+            raise LocationStoreException(f'No complete node location store found in {directory}.')
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != STORE_VERSION:
+            raise LocationStoreException(f'Unsupported node location store version {manifest.get("version")}.')
+        if source is not None and manifest.get('source') != source:
+            raise LocationStoreException(f'The node location store in {directory} was built from another file.')
+        store = cls.__new__(cls)
+        store._directory = directory
+        store._source = manifest.get('source')
+        store._count = manifest['count']
+        store._lock = threading.Lock()
+        store._id_index, store._locations = _map(directory, store._count)
+        return store
+
+    def lookup(self, refs: Iterable[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Looks up the locations of nodes.
+        :param refs: The node IDs.
+        :return: The (lon, lat) coordinates in degrees as an n x 2 array and a boolean mask
+                 indicating which nodes were found; the coordinates of missing nodes are undefined.
+        """
+        assert self._id_index is not None, 'The store must be finished before looking up nodes.'
+        refs = np.asarray(refs if isinstance(refs, (list, np.ndarray)) else list(refs), dtype=np.int64)
+        if self._count == 0 or len(refs) == 0:
+            return np.zeros((len(refs), 2)), np.zeros(len(refs), dtype=bool)
+        index = np.searchsorted(self._id_index, refs)
+        np.minimum(index, self._count - 1, out=index)
+        found = self._id_index[index] == refs
+        return self._locations[index] / SCALE, found
+
+    def close(self):
+        if self._id_index is None:
+            self._ids_file.close()
+            self._coordinates_file.close()
+        self._id_index = self._locations = None
+
+
+def _map(directory: str, count: int) -> Tuple[np.ndarray, np.ndarray]:
+    if count == 0:
+        # Empty files cannot be memory-mapped.
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 2), dtype=np.int32)
+    ids = np.memmap(os.path.join(directory, IDS_FILE), dtype=np.int64, mode='r', shape=(count,))
+    locations = np.memmap(os.path.join(directory, COORDINATES_FILE), dtype=np.int32, mode='r', shape=(count, 2))
+    return ids, locations
+
+
+def is_area(tags: Dict[str, str]) -> bool:
+    """
+    Determines whether a closed way describes an area rather than a closed line.
+    :param tags: The tags of the way.
+    :return: True if the way is an area.
+    """
+    area = tags.get('area')
+    if area is not None:
+        return area != 'no'
+    return not any(key in tags for key in _LINEAR_KEYS)
+
+
+class StoredLocations:
+    """
+    Looks up node locations in the node documents of an imported collection, e.g. for the ways of a change file.
+    The locations of nodes created, modified or deleted by the changes take precedence, since their documents
+    may not have been written yet.
+    """
+    def __init__(self, collection: Collection):
+        """
+        Initializes the lookup.
+        :param collection: The imported collection.
+        """
+        self._collection = collection
+        self._changed = {}  # type: Dict[int, Optional[Tuple[float, float]]]
+
+    @property
+    def changed(self) -> List[int]:
+        """
+        The IDs of the nodes that were added, moved or deleted.
+        """
+        return list(self._changed.keys())
+
+    def add(self, id: int, lat: str, lon: str):
+        """
+        Sets the location of a created or modified node.
+        :param id: The node ID.
+        :param lat: The latitude as given in the file.
+        :param lon: The longitude as given in the file.
+        """
+        self._changed[id] = float(lon), float(lat)
+
+    def delete(self, id: int):
+        """
+        Removes a deleted node.
+        :param id: The node ID.
+        """
+        self._changed[id] = None
+
+    def lookup(self, refs: Iterable[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Looks up the locations of nodes; see NodeLocationStore.lookup.
+        """
+        refs = [int(ref) for ref in refs]
+        stored = {}  # type: Dict[int, Tuple[float, float]]
+        missing = {ref for ref in refs if ref not in self._changed}
+        if len(missing) > 0:
+            for doc in self._collection.find({'_id': {'$in': [{'type': 'node', 'id': bson.Int64(ref)}
+                                                              for ref in missing]}},
+                                             projection={'loc': True}):
+                if 'loc' in doc:
+                    stored[int(doc['_id']['id'])] = tuple(doc['loc']['coordinates'])
+        coordinates = np.zeros((len(refs), 2))
+        found = np.zeros(len(refs), dtype=bool)
+        for i, ref in enumerate(refs):
+            location = self._changed[ref] if ref in self._changed else stored.get(ref)
+            if location is not None:
+                coordinates[i] = location
+                found[i] = True
+        return coordinates, found
+
+
+def way_geometry(refs: List[int], tags: Dict[str, str], locations: Union[NodeLocationStore, StoredLocations]) \
+        -> Optional[Tuple[Dict[str, Any], List[float]]]:
+    """
+    Resolves the geometry of a way.
+    :param refs: The IDs of the nodes of the way.
+    :param tags: The tags of the way.
+    :param locations: The node locations.
+    :return: A GeoJSON LineString or Polygon and the bounding box [min lon, min lat, max lon, max lat],
+             or None if fewer than two nodes of the way are known.
+    """
+    coordinates, found = locations.lookup(refs)
+    complete = bool(found.all())
+    if not complete:
+        # Ways crossing the border of an extract reference nodes outside of it.
+        coordinates = coordinates[found]
+    if len(coordinates) < 2:
+        return None
+    minimum, maximum = coordinates.min(axis=0), coordinates.max(axis=0)
+    bbox = [float(minimum[0]), float(minimum[1]), float(maximum[0]), float(maximum[1])]
+    points = coordinates.tolist()
+    if complete and len(refs) >= 4 and refs[0] == refs[-1] and is_area(tags):
+        return {'type': 'Polygon', 'coordinates': [points]}, bbox
+    return {'type': 'LineString', 'coordinates': points}, bbox
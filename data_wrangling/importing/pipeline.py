@@ -0,0 +1,317 @@
+import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED, ALL_COMPLETED
+from typing import List, Tuple, Dict, Iterable, Callable, Optional, Any, Union
+
+import lxml.etree as etree
+from lxml.etree import Element
+from pymongo.collection import Collection
+
+from data_wrangling.auditing import AuditTag
+from .documents import elem_to_doc
+from .writer import BulkWriter
+from .dump import DumpWriter, encode_document
+from .checkpoints import CommitCallback
+from .locations import NodeLocationStore
+from .statistics import ImportStatistics
+from .address_index import AddressIndex
+from data_wrangling.metrics import PipelineMetrics
+
+ELEMENT_TAGS = {'node', 'way', 'relation'}
+
+# The audits, node locations and document preparation of a worker process; these are set by the pool initializer.
+_worker_audits = []  # type: List[AuditTag]
+_worker_locations_directory = None  # type: Optional[str]
+_worker_locations = None  # type: Optional[NodeLocationStore]
+_worker_prepare = None  # type: Optional[Callable[[List[Tuple[Dict, Dict]]], Any]]
+
+
+class ImportPipeline:
+    """
+    Imports OSM elements in three stages: The calling thread streams the serialized
+    elements, a pool of worker processes audits and converts them to documents, and
+    a pool of writer threads sends the documents to MongoDB.
+
+    The stages are connected by bounded queues, so that a slow stage blocks the
+    stages before it instead of letting the number of pending elements grow.
+    """
+    def __init__(self, collection: Collection, audits: List[AuditTag],
+                 workers: int, writers: int = 1,
+                 batch_size: int = 1000, chunk_size: Optional[int] = None,
+                 queue_size: Optional[int] = None, upsert: bool = True,
+                 locations: Optional[NodeLocationStore] = None,
+                 prepare: Optional[Callable[[List[Tuple[Dict, Dict]]], Any]] = None,
+                 statistics: Optional[ImportStatistics] = None,
+                 addresses: Optional[AddressIndex] = None,
+                 metrics: Optional[PipelineMetrics] = None,
+                 dump: Optional[DumpWriter] = None,
+                 log: Optional[Callable[[str], Any]] = print):
+        """
+        Initializes the pipeline.
+        :param collection: The collection to write to; its client is shared by all writer threads.
+        :param audits: The audits to apply to each element. The workers operate on copies of the audits;
+                       their counts are merged back into these instances.
+        :param workers: The number of conversion processes.
+        :param writers: The number of writer threads.
+        :param batch_size: The number of documents per bulk write.
+        :param chunk_size: The number of elements sent to a conversion process at once;
+                           defaults to the batch size.
+        :param queue_size: The maximum number of chunks waiting for either conversion or writing;
+                           defaults to twice the number of workers and writers, respectively.
+        :param upsert: Whether documents are upserted or inserted; see BulkWriter.
+        :param locations: If specified, the locations of all nodes are added to this store,
+                          which is then used to resolve the geometries of ways.
+        :param prepare: A function applied to each chunk of converted documents by the worker processes,
+                        e.g. a RegionAssigner; see BulkWriter.
+        :param statistics: If specified, the statistics of the collection are updated by all writers.
+        :param addresses: If specified, the address collection is updated by all writers.
+        :param metrics: If specified, the time spent in each stage is recorded; the audit and conversion
+                        times are summed over the worker processes.
+        :param dump: If specified, the documents are written to this dump instead of the collection.
+                     The worker processes then encode the documents, and a single thread writes them.
+        :param log: A function used to report failed batches; None disables reporting.
+        """
+        assert workers > 0, 'At least one worker process is required.'
+        assert writers > 0, 'At least one writer thread is required.'
+        self._audits = audits
+        self._workers = workers
+        self._chunk_size = chunk_size if chunk_size is not None else batch_size
+        self._max_pending = queue_size if queue_size is not None else 2 * workers
+        self._queue = queue.Queue(maxsize=queue_size if queue_size is not None else 2 * writers)
+        self._locations = locations
+        self._prepare = prepare
+        self._metrics = metrics
+        self._encode = dump is not None
+        if dump is not None:
+            assert statistics is None and addresses is None, 'A dump does not maintain statistics or addresses.'
+            self._writers = [dump]  # type: List[Union[BulkWriter, DumpWriter]]
+        else:
+            self._writers = [BulkWriter(collection, batch_size=batch_size, upsert=upsert,
+                                        geo_fields=('geometry', 'bbox'), statistics=statistics,
+                                        addresses=addresses, log=log)
+                             for _ in range(writers)]
+        self._error = None  # type: Optional[BaseException]
+        self._on_commit = None  # type: Optional[CommitCallback]
+        self._marks = {}  # type: Dict[int, Tuple[str, int, Dict[str, Any]]]
+        self._written = {}  # type: Dict[int, int]
+        self._watermark = 0
+        self._committed_documents = 0
+        self._commit_lock = threading.Lock()
+
+    @property
+    def writers(self) -> List[Union[BulkWriter, DumpWriter]]:
+        return self._writers
+
+    @property
+    def documents_written(self) -> int:
+        return sum(writer.documents_written for writer in self._writers)
+
+    @property
+    def errors(self) -> int:
+        return sum(writer.errors for writer in self._writers)
+
+    @property
+    def write_time(self) -> float:
+        return sum(writer.write_time for writer in self._writers)
+
+    def run(self, events: Iterable[Tuple[str, Element]],
+            position: Optional[Callable[[], Dict[str, Any]]] = None,
+            on_commit: Optional[CommitCallback] = None):
+        """
+        Imports all elements. Since elements are only complete at their 'end' event,
+        the events must include those.
+        :param events: The parser events, e.g. from open_and_parse.
+        :param position: If specified, returns the current input position, see InputFile.resume_point.
+        :param on_commit: If specified along with position, called with the type and ID of an element,
+                          the input position after it and the total number of written documents
+                          whenever all chunks up to and including that element were written.
+        """
+        self._on_commit = on_commit if position is not None else None
+        threads = [threading.Thread(target=self._write, args=(writer,), daemon=True)
+                   for writer in self._writers]
+        for thread in threads:
+            thread.start()
+        try:
+            locations = self._locations
+            with ProcessPoolExecutor(max_workers=self._workers, initializer=_init_worker,
+                                     initargs=(self._audits, locations.directory if locations is not None else None,
+                                               self._prepare)) as executor:
+                pending = {}  # type: Dict[Future, int]
+                chunk = []
+                sequence = 0
+                metrics = self._metrics
+                timed = metrics is not None
+                last = time.perf_counter() if timed else 0.
+                for ev, el in events:
+                    if ev != 'end' or el.tag not in ELEMENT_TAGS:
+                        continue
+                    if timed:
+                        metrics.add('parse', time.perf_counter() - last)
+                        metrics.count(el.tag)
+                    if locations is not None and not locations.finished:
+                        if el.tag == 'node':
+                            locations.add(int(el.attrib['id']), el.attrib['lat'], el.attrib['lon'])
+                        else:
+                            # All nodes precede the ways, so the store is complete before any way is converted.
+                            locations.finish()
+                    chunk.append(etree.tostring(el, with_tail=False))
+                    if len(chunk) < self._chunk_size:
+                        if timed:
+                            last = time.perf_counter()
+                        continue
+                    if self._on_commit is not None:
+                        self._marks[sequence] = (el.tag, int(el.attrib['id']), position())
+                    pending[executor.submit(_convert_chunk, chunk, timed, self._encode)] = sequence
+                    chunk = []
+                    sequence += 1
+                    if len(pending) >= self._max_pending:
+                        pending = self._collect(pending, FIRST_COMPLETED)
+                    if timed:
+                        # Waiting for the workers is not counted as parsing.
+                        last = time.perf_counter()
+                if len(chunk) > 0:
+                    pending[executor.submit(_convert_chunk, chunk, timed, self._encode)] = sequence
+                self._collect(pending, ALL_COMPLETED)
+        finally:
+            for _ in threads:
+                self._queue.put(None)
+            for thread in threads:
+                thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _collect(self, pending: Dict[Future, int], return_when: str) -> Dict[Future, int]:
+        done, _ = wait(pending.keys(), return_when=return_when)
+        for future in done:
+            docs, counts, entries, times = future.result()
+            for audit, delta, added in zip(self._audits, counts, entries):
+                audit.merge(delta)
+                # The workers' caches are discarded with them, so their new entries are kept in the audits.
+                audit.merge_cache_entries(added)
+            if times is not None:
+                self._metrics.merge(*times)
+            self._put((pending.pop(future), docs))
+        return pending
+
+    def _put(self, item: Tuple[int, List[Tuple[Any, Any]]]):
+        while True:
+            if self._error is not None:
+                raise self._error
+            try:
+                self._queue.put(item, timeout=1.)
+                return
+            except queue.Full:
+                continue
+
+    def _write(self, writer: Union[BulkWriter, DumpWriter]):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                # Keep draining the queue so that the producer does not block.
+                continue
+            sequence, docs = item
+            try:
+                start = time.perf_counter()
+                if self._encode:
+                    writer.add_encoded(docs)
+                else:
+                    for id, doc in docs:
+                        writer.add(id, doc)
+                if self._on_commit is not None:
+                    # A chunk only counts as committed once all of its documents were written.
+                    writer.flush()
+                    self._committed(sequence, len(docs))
+                if self._metrics is not None:
+                    self._metrics.add('write', time.perf_counter() - start, len(docs))
+            except BaseException as e:
+                self._error = e
+        if self._error is None:
+            try:
+                start = time.perf_counter()
+                writer.close()
+                if self._metrics is not None:
+                    self._metrics.add('write', time.perf_counter() - start, 0)
+            except BaseException as e:
+                self._error = e
+
+    def _committed(self, sequence: int, documents: int):
+        """
+        Records a written chunk. Chunks are written out of order, so a checkpoint is only
+        reported for the last chunk of the contiguous sequence of written chunks.
+        """
+        with self._commit_lock:
+            self._written[sequence] = documents
+            mark = None
+            while self._watermark in self._written:
+                self._committed_documents += self._written.pop(self._watermark)
+                mark = self._marks.pop(self._watermark, mark)
+                self._watermark += 1
+            if mark is not None:
+                element_type, element_id, position = mark
+                self._on_commit(element_type, element_id, position, self._committed_documents)
+
+
+def _init_worker(audits: List[AuditTag], locations_directory: Optional[str],
+                 prepare: Optional[Callable[[List[Tuple[Dict, Dict]]], Any]]):
+    global _worker_audits, _worker_locations_directory, _worker_prepare
+    _worker_audits = audits
+    for audit in audits:
+        audit.record_cache_entries()
+    _worker_locations_directory = locations_directory
+    _worker_prepare = prepare
+
+
+def _get_worker_locations() -> Optional[NodeLocationStore]:
+    global _worker_locations
+    if _worker_locations is None and _worker_locations_directory is not None:
+        _worker_locations = NodeLocationStore.open(_worker_locations_directory)
+    return _worker_locations
+
+
+def _convert_chunk(payloads: List[bytes], timed: bool = False, encode: bool = False) \
+        -> Tuple[List[Tuple[Any, Any]], List[Tuple], List[Any], Optional[Tuple[Dict[str, float], Dict[str, int]]]]:
+    """
+    Audits and converts serialized elements.
+    :param payloads: The serialized XML elements.
+    :param timed: Whether to measure the time spent auditing and converting.
+    :param encode: Whether to return the element types and the BSON encoded documents, see DumpWriter.add_encoded,
+                   which are considerably cheaper to send back to the parent process than the documents.
+    :return: The converted documents, for each audit the change of its counters (see AuditTag.counts)
+             and the entries it added to its cache (see AuditTag.take_cache_entries), and if timed, the seconds and items of the audit and convert stages; see PipelineMetrics.merge.
+    """
+    before = [audit.counts() for audit in _worker_audits]
+    docs = []
+    audit_time, convert_time = 0., 0.
+    for payload in payloads:
+        start = time.perf_counter() if timed else 0.
+        el = etree.fromstring(payload)
+        for audit in _worker_audits:
+            el = audit(el)
+            if el is None:
+                break
+        if timed:
+            audited = time.perf_counter()
+            audit_time += audited - start
+        if el is None:
+            continue
+        docs.append(elem_to_doc(el, _get_worker_locations() if el.tag == 'way' else None))
+        if timed:
+            convert_time += time.perf_counter() - audited
+    if _worker_prepare is not None:
+        start = time.perf_counter()
+        _worker_prepare(docs)
+        convert_time += time.perf_counter() - start
+    if encode:
+        start = time.perf_counter()
+        docs = [(id['type'], encode_document(id, doc)) for id, doc in docs]
+        convert_time += time.perf_counter() - start
+    counts = [tuple(after - earlier for after, earlier in zip(audit.counts(), counts))
+              for audit, counts in zip(_worker_audits, before)]
+    entries = [audit.take_cache_entries() for audit in _worker_audits]
+    times = None
+    if timed:
+        times = {'audit': audit_time, 'convert': convert_time}, {'audit': len(payloads), 'convert': len(docs)}
+    return docs, counts, entries, times
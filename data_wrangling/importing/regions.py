@@ -0,0 +1,87 @@
+"""
+Assigns documents to the districts and neighbourhood regions (Bezirksregionen) of Berlin.
+"""
+
+from typing import Dict, List, Tuple, Optional
+
+import numpy as np
+
+from data_wrangling.spatial import PolygonIndex
+from .documents import DISTRICT_FIELD, REGION_FIELD
+
+
+class RegionAssigner:
+    """
+    Sets the names of the regions containing the documents of a batch, using one
+    spatial index per document field. Documents without a location are left unchanged.
+    """
+    def __init__(self, indexes: Dict[str, PolygonIndex]):
+        """
+        Initializes the assigner.
+        :param indexes: The spatial indexes by the document field to store the region name in.
+        """
+        self._indexes = indexes
+
+    @property
+    def fields(self) -> List[str]:
+        return list(self._indexes.keys())
+
+    def assign(self, batch: List[Tuple[Dict, Optional[Dict]]]):
+        """
+        Assigns the documents of a batch to their regions.
+        :param batch: The document IDs and documents; None documents (deletions) are skipped.
+        """
+        docs, points = [], []
+        for _, doc in batch:
+            point = representative_point(doc) if doc is not None else None
+            if point is not None:
+                docs.append(doc)
+                points.append(point)
+        if len(docs) == 0:
+            return
+        points = np.asarray(points, dtype=np.float64)
+        for field, index in self._indexes.items():
+            names = index.names
+            for doc, label in zip(docs, index.query(points[:, 0], points[:, 1])):
+                if label >= 0:
+                    doc[field] = names[label]
+
+    def __call__(self, batch: List[Tuple[Dict, Optional[Dict]]]):
+        self.assign(batch)
+
+
+def representative_point(doc: Dict) -> Optional[Tuple[float, float]]:
+    """
+    Gets a point used to locate a document: the location of a node, the middle node of a line
+    or the center of the bounding box of an area.
+    :param doc: The document.
+    :return: The (lon, lat) coordinates or None if the document has no location.
+    """
+    loc = doc.get('loc')
+    if loc is not None:
+        return loc['coordinates'][0], loc['coordinates'][1]
+    geometry = doc.get('geometry')
+    if geometry is None:
+        return None
+    if geometry['type'] == 'LineString':
+        coordinates = geometry['coordinates']
+        return tuple(coordinates[len(coordinates) // 2])
+    min_lon, min_lat, max_lon, max_lat = doc['bbox']
+    return (min_lon + max_lon) / 2, (min_lat + max_lat) / 2
+
+
+def load_region_assigner(districts: bool = True, regions: bool = True) -> RegionAssigner:
+    """
+    Creates an assigner for the supplemental district and Bezirksregion boundaries.
+    :param districts: Whether to assign districts to the district field.
+    :param regions: Whether to assign Bezirksregionen to the region field.
+    :return: The assigner.
+    """
+    # Imported here, since the boundaries require the optional area package.
+    from supplemental import get_district_geojson, get_region_geojson
+    indexes = {}
+    if districts:
+        indexes[DISTRICT_FIELD] = PolygonIndex(get_district_geojson())
+    if regions:
+        indexes[REGION_FIELD] = PolygonIndex(get_region_geojson())
+    return RegionAssigner(indexes)
@@ -0,0 +1,247 @@
+"""
+Statistics of an imported collection that are maintained while documents are written.
+
+The statistics are kept in a separate collection named after the imported one with a _stats suffix:
+
+- {'_id': {'kind': 'type', 'type': 'node'}, 'count': n}: the number of elements per type,
+- {'_id': {'kind': 'key', 'key': k}, 'count': n}: the number of elements having a tag key,
+- {'_id': {'kind': 'tag', 'key': k, 'value': v}, 'count': n}: the number of elements per tag value,
+  for a configurable set of keys only,
+- {'_id': {'kind': 'distinct', 'key': k}, 'count': n}: the number of distinct values of these keys,
+- {'_id': 'meta', ...}: the version, the keys with value counts, and whether the statistics are complete.
+
+Since upserts may replace existing documents, the writer loads the previous tags of the documents of
+each batch, and the statistics are updated by the difference. Statistics of an interrupted load are
+marked as incomplete and rebuilt by an aggregation over the collection before the next load.
+"""
+
+import threading
+from collections import Counter
+from typing import Dict, List, Tuple, Optional, Iterable, Any
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+from .tag_tokens import tag_filter, has_tag_tokens
+
+STATISTICS_VERSION = 1
+META_ID = 'meta'
+DEFAULT_VALUE_KEYS = ('amenity', 'natural', 'highway', 'building', 'shop', 'leisure',
+                      'addr:street', 'addr:postcode', 'addr:city', 'addr:suburb')
+
+# The element type, tag keys and tracked tag values of a document.
+Summary = Tuple[str, List[str], Dict[str, str]]
+
+
+def statistics_collection(collection: Collection) -> Collection:
+    return collection.database.get_collection(f'{collection.name}_stats')
+
+
+def type_id(element_type: str) -> Dict[str, str]:
+    return {'kind': 'type', 'type': element_type}
+
+
+def key_id(key: str) -> Dict[str, str]:
+    return {'kind': 'key', 'key': key}
+
+
+def tag_id(key: str, value: str) -> Dict[str, str]:
+    return {'kind': 'tag', 'key': key, 'value': value}
+
+
+def distinct_id(key: str) -> Dict[str, str]:
+    return {'kind': 'distinct', 'key': key}
+
+
+class ImportStatistics:
+    """
+    Maintains the statistics of a collection. An instance may be shared by several writer threads.
+    """
+    def __init__(self, collection: Collection, value_keys: Iterable[str] = DEFAULT_VALUE_KEYS,
+                 flush_interval: int = 100):
+        """
+        Initializes the statistics.
+        :param collection: The imported collection.
+        :param value_keys: The tag keys to count the values of.
+        :param flush_interval: The number of recorded batches after which the changes are written.
+        """
+        self._collection = collection
+        self._stats = statistics_collection(collection)
+        self._value_keys = sorted(set(value_keys))
+        self._value_key_set = set(self._value_keys)
+        self._flush_interval = flush_interval
+        self._projection = {'tag_keys': True}
+        self._projection.update({f'tags.{key}': True for key in self._value_keys})
+        self._changes = Counter()  # type: Counter
+        self._batches = 0
+        self._lock = threading.Lock()
+        self._rebuilt = False
+
+    @property
+    def rebuilt(self) -> bool:
+        """
+        Whether the statistics had to be rebuilt from the collection when the load began.
+        """
+        return self._rebuilt
+
+    def begin(self, empty: bool):
+        """
+        Prepares the statistics for a load and marks them as incomplete until finish() is called.
+        :param empty: Whether the collection is empty.
+        """
+        meta = self._stats.find_one({'_id': META_ID})
+        if empty:
+            self._stats.delete_many({})
+        elif meta is None or not meta.get('complete') or meta.get('version') != STATISTICS_VERSION \
+                or meta.get('value_keys') != self._value_keys:
+            self.rebuild()
+            self._rebuilt = True
+        self._write_meta(complete=False)
+
+    def finish(self):
+        """
+        Writes the remaining changes, updates the distinct value counts and marks the statistics as complete.
+        """
+        self.flush()
+        self._update_distinct()
+        self._write_meta(complete=True)
+
+    def rebuild(self):
+        """
+        Recomputes all statistics from the collection.
+        """
+        self._stats.delete_many({})
+        counts = Counter()
+        for result in self._collection.aggregate([
+            {'$group': {'_id': '$_id.type', 'count': {'$sum': 1}}}
+        ], allowDiskUse=True):
+            counts[('type', result['_id'])] = result['count']
+        for result in self._collection.aggregate([
+            {'$unwind': '$tag_keys'},
+            {'$group': {'_id': '$tag_keys', 'count': {'$sum': 1}}}
+        ], allowDiskUse=True):
+            counts[('key', result['_id'])] = result['count']
+        tokens = has_tag_tokens(self._collection)
+        for key in self._value_keys:
+            for result in self._collection.aggregate([
+                {'$match': tag_filter({key: {'$exists': True}}, tokens=tokens)},
+                {'$group': {'_id': f'$tags.{key}', 'count': {'$sum': 1}}}
+            ], allowDiskUse=True):
+                counts[('tag', key, result['_id'])] = result['count']
+        with self._lock:
+            self._changes = counts
+            self._batches = 0
+        self.flush()
+
+    def load(self, batch: List[Tuple[Dict, Optional[Dict]]]) -> Dict[Tuple, Summary]:
+        """
+        Loads the current state of the documents of a batch before they are written.
+        :param batch: The document IDs and documents.
+        :return: The summaries of the documents that exist, by their ID key.
+        """
+        ids = [id for id, _ in batch]
+        return {_id_key(doc['_id']): _summarize(doc['_id']['type'], doc, self._value_key_set)
+                for doc in self._collection.find({'_id': {'$in': ids}}, projection=dict(self._projection))}
+
+    def record(self, written: List[Tuple[Dict, Optional[Dict]]], priors: Dict[Tuple, Summary], replace: bool):
+        """
+        Records written documents.
+        :param written: The IDs and documents (None for deletions) that were written.
+        :param priors: The summaries of the documents before they were written, see load().
+        :param replace: Whether the documents replaced existing ones; otherwise, their fields were set,
+                        which keeps the tags of existing documents written without tags.
+        """
+        changes = Counter()
+        for id, doc in written:
+            prior = priors.get(_id_key(id))
+            after = None
+            if doc is not None:
+                after = _summarize(id['type'], doc, self._value_key_set)
+                if prior is not None and not replace and 'tag_keys' not in doc:
+                    after = prior
+            if prior is not None:
+                _count(changes, prior, -1)
+            if after is not None:
+                _count(changes, after, 1)
+        with self._lock:
+            self._changes.update(changes)
+            self._batches += 1
+            if self._batches < self._flush_interval:
+                return
+        self.flush()
+
+    def flush(self):
+        """
+        Writes the recorded changes.
+        """
+        with self._lock:
+            changes, self._changes = self._changes, Counter()
+            self._batches = 0
+        requests = []
+        for change, count in changes.items():
+            if count == 0:
+                continue
+            kind = change[0]
+            id = type_id(change[1]) if kind == 'type' else key_id(change[1]) if kind == 'key' \
+                else tag_id(change[1], change[2])
+            requests.append(UpdateOne({'_id': id}, {'$inc': {'count': count}}, upsert=True))
+        if len(requests) > 0:
+            self._stats.bulk_write(requests, ordered=False)
+
+    def _update_distinct(self):
+        self._stats.delete_many({'_id.kind': 'distinct'})
+        distinct = Counter()
+        for stat in self._stats.find({'_id.kind': 'tag', 'count': {'$gt': 0}}, projection={'_id': True}):
+            distinct[stat['_id']['key']] += 1
+        requests = [UpdateOne({'_id': distinct_id(key)}, {'$set': {'count': distinct[key]}}, upsert=True)
+                    for key in self._value_keys]
+        self._stats.bulk_write(requests, ordered=False)
+
+    def _write_meta(self, complete: bool):
+        self._stats.replace_one({'_id': META_ID}, {
+            '_id': META_ID,
+            'version': STATISTICS_VERSION,
+            'value_keys': self._value_keys,
+            'complete': complete
+        }, upsert=True)
+
+
+def _id_key(id: Dict) -> Tuple:
+    return id['type'], id['id']
+
+
+def _summarize(element_type: str, doc: Dict, value_keys: Iterable[str]) -> Summary:
+    tags = doc.get('tags', {})
+    return element_type, doc.get('tag_keys', []), {key: tags[key] for key in value_keys if key in tags}
+
+
+def _count(changes: Counter, summary: Summary, sign: int):
+    element_type, keys, values = summary
+    changes[('type', element_type)] += sign
+    for key in keys:
+        changes[('key', key)] += sign
+    for key, value in values.items():
+        changes[('tag', key, value)] += sign
+
+
+def read_statistics(collection: Collection) -> Optional[Dict[str, Any]]:
+    """
+    Reads the metadata of the statistics of a collection.
+    :param collection: The imported collection.
+    :return: The metadata, or None if the statistics are not available or incomplete.
+    """
+    meta = statistics_collection(collection).find_one({'_id': META_ID})
+    if meta is None or not meta.get('complete') or meta.get('version') != STATISTICS_VERSION:
+        return None
+    return meta
+
+
+def read_count(collection: Collection, id: Dict[str, str]) -> int:
+    """
+    Reads a single count from the statistics of a collection.
+    :param collection: The imported collection.
+    :param id: The ID of the statistic, e.g. type_id('node').
+    :return: The count; statistics that were never recorded are zero.
+    """
+    stat = statistics_collection(collection).find_one({'_id': id}, projection={'count': True})
+    return stat['count'] if stat is not None else 0
@@ -0,0 +1,160 @@
+"""
+Tag tokens: a multikey array of the tags of a document that makes tag lookups index seeks.
+
+Every document with tags carries a tag_tokens field with one "key" and one "key=value" token per tag:
+
+    {'tags': {'amenity': 'bench', 'backrest': 'yes'},
+     'tag_tokens': ['amenity', 'amenity=bench', 'backrest', 'backrest=yes']}
+
+An ascending index on the field answers equality, existence and prefix conditions on any tag key.
+tag_filter() rewrites such conditions on tags.<key> fields to use the tokens; the original conditions
+are kept alongside, so that ambiguous tokens (keys containing '=') and truncated tokens cannot change results.
+Whether all documents of a collection carry tokens is recorded in the osm_meta collection.
+"""
+
+from typing import Dict, List, Any, Optional
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+META_COLLECTION = 'osm_meta'
+TOKEN_FIELD = 'tag_tokens'
+# Longer tokens are truncated, so that long values such as descriptions stay below the index key size
+# limit of older MongoDB versions. Truncation keeps prefixes, so that conditions match truncated tokens as well.
+MAX_TOKEN_BYTES = 512
+_REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+
+
+def tag_token(key: str, value: Optional[str] = None) -> str:
+    """
+    Gets the token of a tag key or of a tag.
+    :param key: The tag key.
+    :param value: The tag value, or None for the token of the key.
+    :return: The token.
+    """
+    token = key if value is None else f'{key}={value}'
+    encoded = token.encode('utf-8')
+    if len(encoded) <= MAX_TOKEN_BYTES:
+        return token
+    return encoded[:MAX_TOKEN_BYTES].decode('utf-8', errors='ignore')
+
+
+def tag_tokens(tags: Dict[str, str]) -> List[str]:
+    """
+    Gets the tokens of the tags of a document.
+    :param tags: The tags.
+    :return: The tokens of the keys and the tags.
+    """
+    tokens = []
+    for key, value in tags.items():
+        tokens.append(tag_token(key))
+        tokens.append(tag_token(key, value))
+    return tokens
+
+
+def tag_tokens_meta_id(collection: Collection) -> str:
+    return f'tag_tokens:{collection.name}'
+
+
+def has_tag_tokens(collection: Collection) -> bool:
+    """
+    Determines whether all documents of a collection carry tag tokens.
+    :param collection: The imported collection.
+    :return: True if tag conditions may be rewritten to use the tokens.
+    """
+    meta = collection.database.get_collection(META_COLLECTION).find_one({'_id': tag_tokens_meta_id(collection)})
+    return meta is not None and meta.get('complete', False)
+
+
+def ensure_tag_tokens(collection: Collection, empty: bool, batch_size: int = 1000) -> int:
+    """
+    Adds tag tokens to the documents of a collection imported without them, and marks the collection as tokenized.
+    :param collection: The imported collection.
+    :param empty: Whether the collection is empty, in which case all documents will be written with tokens.
+    :param batch_size: The number of documents to update per bulk write.
+    :return: The number of documents that were updated.
+    """
+    updated = 0
+    if not empty and not has_tag_tokens(collection):
+        requests = []
+        cursor = collection.find({'tags': {'$exists': True}, TOKEN_FIELD: {'$exists': False}},
+                                 projection={'tags': True})
+        for doc in cursor:
+            requests.append(UpdateOne({'_id': doc['_id']}, {'$set': {TOKEN_FIELD: tag_tokens(doc['tags'])}}))
+            if len(requests) >= batch_size:
+                updated += collection.bulk_write(requests, ordered=False).modified_count
+                requests = []
+        if len(requests) > 0:
+            updated += collection.bulk_write(requests, ordered=False).modified_count
+    collection.database.get_collection(META_COLLECTION).replace_one(
+        {'_id': tag_tokens_meta_id(collection)},
+        {'_id': tag_tokens_meta_id(collection), 'complete': True}, upsert=True)
+    return updated
+
+
+def token_condition(key: str, condition: Any) -> Optional[Any]:
+    """
+    Rewrites a condition on a tag value to a condition on the tag tokens.
+    :param key: The tag key.
+    :param condition: The condition on tags.<key>: a value, or a query document using
+                      $eq, $in, $exists: True or a $regex, which uses the index for its literal prefix.
+    :return: The condition on the tag tokens, or None if it cannot be answered from the tokens.
+    """
+    if isinstance(condition, str):
+        return tag_token(key, condition)
+    if not isinstance(condition, dict) or len(condition) == 0:
+        return None
+    if set(condition.keys()) == {'$eq'}:
+        return token_condition(key, condition['$eq'])
+    if set(condition.keys()) == {'$exists'}:
+        return tag_token(key) if condition['$exists'] else None
+    if set(condition.keys()) == {'$in'}:
+        values = condition['$in']
+        if len(values) == 0 or not all(isinstance(value, str) for value in values):
+            return None
+        return {'$in': [tag_token(key, value) for value in values]}
+    if set(condition.keys()) <= {'$regex', '$options'}:
+        regex = condition['$regex']
+        prefix = _literal_prefix(regex) if isinstance(regex, str) and len(condition.get('$options', '')) == 0 else ''
+        return {'$regex': '^' + _escape(tag_token(key, prefix))}
+    return None
+
+
+def tag_filter(tags: Dict[str, Any], tokens: bool = True) -> Dict[str, Any]:
+    """
+    Builds a query document for conditions on tags.
+    :param tags: The conditions by tag key, e.g. {'natural': 'tree', 'addr:street': {'$exists': True}}.
+    :param tokens: Whether the documents carry tag tokens, see has_tag_tokens().
+    :return: The query document, which matches the same documents as the conditions on tags.<key>.
+    """
+    query = {f'tags.{key}': condition for key, condition in tags.items()}
+    if not tokens:
+        return query
+    conditions = [c for c in (token_condition(key, condition) for key, condition in tags.items()) if c is not None]
+    if len(conditions) == 1:
+        query[TOKEN_FIELD] = conditions[0]
+    elif len(conditions) > 1:
+        query['$and'] = [{TOKEN_FIELD: condition} for condition in conditions]
+    return query
+
+
+def _escape(text: str) -> str:
+    # Only escapes the special characters, which keeps the expression a simple prefix for the query planner.
+    return ''.join('\\' + c if c in _REGEX_SPECIAL else c for c in text)
+
+
+def _literal_prefix(regex: str) -> str:
+    """
+    Gets the literal text every match of a regular expression starts with.
+    """
+    if not regex.startswith('^') or '|' in regex:
+        return ''
+    prefix = []
+    for c in regex[1:]:
+        if c in _REGEX_SPECIAL:
+            if c in '*?{' and len(prefix) > 0:
+                # The preceding character is optional or repeated.
+                prefix.pop()
+            break
+        prefix.append(c)
+    return ''.join(prefix)
@@ -0,0 +1,370 @@
+import time
+from typing import Dict, List, Tuple, Callable, Optional, Any, Set, Iterable
+
+from pymongo import InsertOne, UpdateOne, ReplaceOne, DeleteOne, IndexModel, ASCENDING, TEXT, GEOSPHERE
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from .statistics import ImportStatistics, Summary
+from .address_index import AddressIndex
+from .documents import DISTRICT_FIELD, REGION_FIELD
+from .tag_tokens import TOKEN_FIELD
+
+
+DUPLICATE_KEY_ERROR = 11000
+# Raised when a geometry cannot be indexed, e.g. a self-intersecting polygon.
+GEO_KEY_ERROR = 16755
+
+
+class BulkWriter:
+    """
+    Collects documents into batches and writes them to a collection using
+    unordered bulk operations instead of one round trip per document.
+    """
+    def __init__(self, collection: Collection, batch_size: int = 1000, upsert: bool = True,
+                 replace: bool = False, geo_fields: Iterable[str] = (),
+                 prepare: Optional[Callable[[List[Tuple[Dict, Optional[Dict]]]], Any]] = None,
+                 statistics: Optional[ImportStatistics] = None,
+                 addresses: Optional[AddressIndex] = None,
+                 log: Optional[Callable[[str], Any]] = print):
+        """
+        Initializes the bulk writer.
+        :param collection: The collection to write to.
+        :param batch_size: The number of documents to send per bulk operation.
+        :param upsert: If True, documents are upserted (which is required for re-imports);
+                       if False, documents are inserted, which is considerably faster
+                       but only valid for an empty collection.
+        :param replace: If True, upserted documents replace existing ones entirely instead of
+                        only setting their fields, and repeated writes of the same document,
+                        including deletions, are applied in the order they were added.
+        :param geo_fields: Fields of geo-indexed geometries; documents whose geometry cannot be
+                           indexed are written again without these fields instead of failing.
+        :param prepare: A function applied to each batch of IDs and documents (None for deletions)
+                        right before it is written, e.g. to assign regions to all documents at once.
+        :param statistics: If specified, the statistics of the collection are updated with the written documents.
+        :param addresses: If specified, the address collection is updated with the written nodes.
+        :param log: A function used to report failed batches; None disables reporting.
+        """
+        assert batch_size > 0, 'The batch size must be positive.'
+        self._collection = collection
+        self._batch_size = batch_size
+        self._upsert = upsert
+        self._replace = replace
+        self._geo_fields = tuple(geo_fields)
+        self._retry_codes = {GEO_KEY_ERROR} if len(self._geo_fields) > 0 else set()
+        self._prepare = prepare
+        self._statistics = statistics
+        self._addresses = addresses
+        self._log = log
+        self._batch = []  # type: List[Tuple[Dict, Optional[Dict]]]
+        self._batch_keys = set()  # type: Set[Tuple]
+        self._documents_written = 0
+        self._batches_written = 0
+        self._geometries_dropped = 0
+        self._errors = 0
+        self._write_time = 0.
+
+    @property
+    def upsert(self) -> bool:
+        return self._upsert
+
+    @property
+    def documents_written(self) -> int:
+        return self._documents_written
+
+    @property
+    def batches_written(self) -> int:
+        return self._batches_written
+
+    @property
+    def errors(self) -> int:
+        return self._errors
+
+    @property
+    def write_time(self) -> float:
+        return self._write_time
+
+    @property
+    def geometries_dropped(self) -> int:
+        """
+        The number of documents written without their geometry since it could not be indexed.
+        """
+        return self._geometries_dropped
+
+    @property
+    def pending(self) -> int:
+        """
+        The number of documents added but not yet written.
+        """
+        return len(self._batch)
+
+    def add(self, id: Dict, doc: Dict):
+        """
+        Adds a document to the current batch and writes the batch if it is full.
+        :param id: The document ID.
+        :param doc: The document, without its ID.
+        """
+        self._append(id, doc)
+
+    def delete(self, id: Dict):
+        """
+        Adds the deletion of a document to the current batch and writes the batch if it is full.
+        :param id: The document ID.
+        """
+        self._append(id, None)
+
+    def _append(self, id: Dict, doc: Optional[Dict]):
+        if self._replace:
+            # The operations of an unordered bulk write may be applied in any order,
+            # so a batch must not contain more than one operation per document.
+            key = tuple(id.items())
+            if key in self._batch_keys:
+                self.flush()
+            self._batch_keys.add(key)
+        self._batch.append((id, doc))
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all pending documents.
+        """
+        if len(self._batch) == 0:
+            return
+        batch, self._batch = self._batch, []
+        self._batch_keys.clear()
+        if self._prepare is not None:
+            self._prepare(batch)
+        start = time.perf_counter()
+        # Inserted documents do not exist yet, so only upserts need the previous state for the statistics.
+        priors = self._statistics.load(batch) if self._statistics is not None and self._upsert else {}
+        if self._upsert:
+            failed = self._write(batch, [self._upsert_request(id, doc) for id, doc in batch],
+                                 retry_codes=self._retry_codes, priors=priors)
+        else:
+            failed = self._write(batch, [InsertOne(_with_id(id, doc)) if doc is not None else DeleteOne({'_id': id})
+                                         for id, doc in batch],
+                                 retry_codes=self._retry_codes | {DUPLICATE_KEY_ERROR}, priors=priors)
+        self._retry(failed, self._retry_codes, priors)
+        self._write_time += time.perf_counter() - start
+        self._batches_written += 1
+
+    def _retry(self, failed: List[Tuple[int, Tuple[Dict, Optional[Dict]]]], retry_codes: Set[int],
+               priors: Dict[Tuple, Summary]):
+        """
+        Upserts documents whose write failed with a retry code.
+        :param failed: The error codes and the documents.
+        :param retry_codes: The error codes for which another retry is allowed.
+        :param priors: The previous state of the documents for the statistics, see ImportStatistics.load.
+        """
+        if len(failed) == 0:
+            return
+        if self._statistics is not None:
+            duplicates = [entry for code, entry in failed if code == DUPLICATE_KEY_ERROR]
+            if len(duplicates) > 0:
+                priors = dict(priors)
+                priors.update(self._statistics.load(duplicates))
+        batch, requests = [], []
+        for code, (id, doc) in failed:
+            if code == GEO_KEY_ERROR:
+                doc = {key: value for key, value in doc.items() if key not in self._geo_fields}
+                self._geometries_dropped += 1
+                requests.append(self._upsert_request(id, doc, unset=self._geo_fields))
+            else:
+                # Documents that already exist are not an error per se, e.g. when resuming
+                # an interrupted import; they are simply updated instead.
+                requests.append(self._upsert_request(id, doc))
+            batch.append((id, doc))
+        retry_codes = retry_codes - {GEO_KEY_ERROR}
+        self._retry(self._write(batch, requests, retry_codes=retry_codes, priors=priors), retry_codes, priors)
+
+    def _upsert_request(self, id: Dict, doc: Optional[Dict], unset: Iterable[str] = ()) -> Any:
+        if doc is None:
+            return DeleteOne({'_id': id})
+        if self._replace:
+            return ReplaceOne({'_id': id}, _with_id(id, doc), upsert=True)
+        update = {'$set': doc}
+        if len(unset) > 0:
+            # Remove a geometry stored by an earlier import.
+            update['$unset'] = {field: '' for field in unset}
+        return UpdateOne({'_id': id}, update, upsert=True)
+
+    def _write(self, batch: List[Tuple[Dict, Optional[Dict]]], requests: List[Any],
+               retry_codes: Optional[Set[int]] = None,
+               priors: Optional[Dict[Tuple, Summary]] = None) -> List[Tuple[int, Tuple[Dict, Optional[Dict]]]]:
+        """
+        Executes an unordered bulk write.
+        :param batch: The documents that belong to the requests.
+        :param requests: The write requests.
+        :param retry_codes: Error codes for which the documents should be returned rather than reported.
+        :param priors: The previous state of the documents for the statistics, see ImportStatistics.load.
+        :return: The error codes and documents of the writes that failed with one of the retry codes.
+        """
+        try:
+            self._collection.bulk_write(requests, ordered=False)
+            self._documents_written += len(batch)
+            self._record(batch, priors)
+            return []
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            retry = [error for error in write_errors if retry_codes is not None and error['code'] in retry_codes]
+            errors = [error for error in write_errors if retry_codes is None or error['code'] not in retry_codes]
+            self._documents_written += len(batch) - len(write_errors)
+            self._errors += len(errors)
+            if self._statistics is not None or self._addresses is not None:
+                failed = {error['index'] for error in write_errors}
+                self._record([entry for index, entry in enumerate(batch) if index not in failed], priors)
+            if len(errors) > 0 and self._log is not None:
+                self._log(f'Batch {self._batches_written + 1}: {len(errors)} of {len(batch)} writes failed, '
+                          f'first error: {errors[0]["errmsg"]}')
+            return [(error['code'], batch[error['index']]) for error in retry]
+
+    def _record(self, written: List[Tuple[Dict, Optional[Dict]]], priors: Optional[Dict[Tuple, Summary]]):
+        """
+        Updates the statistics and the address collection with the written documents.
+        """
+        if self._statistics is not None:
+            self._statistics.record(written, priors or {}, replace=self._replace)
+        if self._addresses is not None:
+            self._addresses.record(written, upsert=self._upsert, replace=self._replace,
+                                   priors=priors if self._statistics is not None else None)
+
+    def close(self):
+        """
+        Writes all pending documents.
+        """
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        mode = ('replace' if self._replace else 'upsert') if self._upsert else 'insert'
+        text = f'{type(self).__name__} ({mode}): wrote {self.documents_written} documents ' \
+               f'in {self.batches_written} batches, {self.errors} errors'
+        if self._geometries_dropped > 0:
+            text += f', {self._geometries_dropped} without geometry'
+        return text
+
+
+def _with_id(id: Dict, doc: Dict) -> Dict:
+    full = {'_id': id}
+    full.update(doc)
+    return full
+
+
+def is_empty(collection: Collection) -> bool:
+    """
+    Determines whether a collection contains no documents without counting all of them.
+    :param collection: The collection to check.
+    :return: True if the collection is empty.
+    """
+    return collection.find_one(projection={'_id': True}) is None
+
+
+def index_models(geometry: bool = True) -> List[IndexModel]:
+    """
+    Gets the indexes the queries rely on.
+    :param geometry: If False, the geometry index of the ways is left out, e.g. for a dump whose
+                     geometries were not checked by the server; see create_geometry_index.
+    :return: The index definitions, e.g. for Collection.create_indexes.
+    """
+    models = [
+        IndexModel([('_id.type', ASCENDING)], background=True, unique=False),
+        IndexModel([('user.name', ASCENDING)], background=True, unique=False),
+        IndexModel([('user.id', ASCENDING)], background=True, unique=False),
+        IndexModel([('t', ASCENDING)], background=True, unique=False),
+        IndexModel([('tag_keys', TEXT),
+                    ('tag_values', TEXT)], background=True, unique=False),
+        IndexModel([(TOKEN_FIELD, ASCENDING)], background=True, unique=False),
+        # Finds the ways whose geometry changes along with one of their nodes, see apply_changes.py.
+        IndexModel([('nodes', ASCENDING)], background=True, unique=False,
+                   partialFilterExpression={'_id.type': 'way'}),
+        IndexModel([('loc', GEOSPHERE)],
+                   background=True, unique=False,
+                   partialFilterExpression={'_id.type': 'node'}),
+        IndexModel([(DISTRICT_FIELD, ASCENDING)], background=True, unique=False, sparse=True),
+        IndexModel([(REGION_FIELD, ASCENDING)], background=True, unique=False, sparse=True)
+    ]
+    if geometry:
+        models.append(geometry_index_model())
+    return models
+
+
+def geometry_index_model() -> IndexModel:
+    """
+    Gets the geo index of the way geometries.
+    """
+    return IndexModel([('geometry', GEOSPHERE)],
+                      background=True, unique=False,
+                      partialFilterExpression={'_id.type': 'way'})
+
+
+def create_indexes(collection: Collection):
+    """
+    Creates the indexes the queries rely on, unless they exist already.
+    :param collection: The imported collection.
+    """
+    collection.create_indexes(index_models())
+
+
+def create_geometry_index(collection: Collection, batch_size: int = 1000) -> int:
+    """
+    Creates the geo index of the way geometries, unless it exists already. If the server rejects
+    some geometries, e.g. of ways restored from a dump, these are removed like BulkWriter does.
+    :param collection: The imported collection.
+    :param batch_size: The number of geometries to check at once.
+    :return: The number of ways whose geometry was removed.
+    """
+    try:
+        collection.create_indexes([geometry_index_model()])
+        return 0
+    except OperationFailure as e:
+        if e.code != GEO_KEY_ERROR:
+            raise
+    invalid = find_invalid_geometries(collection, batch_size)
+    for start in range(0, len(invalid), batch_size):
+        collection.update_many({'_id': {'$in': invalid[start:start + batch_size]}},
+                               {'$unset': {'geometry': '', 'bbox': ''}})
+    collection.create_indexes([geometry_index_model()])
+    return len(invalid)
+
+
+def find_invalid_geometries(collection: Collection, batch_size: int = 1000) -> List[Dict]:
+    """
+    Finds the ways whose geometry the server cannot index by copying the geometries
+    into a temporary collection with a geo index.
+    :param collection: The imported collection.
+    :param batch_size: The number of geometries to copy at once.
+    :return: The IDs of the ways.
+    """
+    scratch = collection.database.get_collection(f'{collection.name}_geometry_check')
+    scratch.drop()
+    scratch.create_index([('geometry', GEOSPHERE)])
+    invalid = []  # type: List[Dict]
+
+    def check(docs: List[Dict]):
+        try:
+            scratch.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                if error['code'] != GEO_KEY_ERROR:
+                    raise
+                invalid.append(docs[error['index']]['_id'])
+        scratch.delete_many({})
+
+    try:
+        batch = []  # type: List[Dict]
+        for doc in collection.find({'_id.type': 'way', 'geometry': {'$exists': True}}, projection={'geometry': True}):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                check(batch)
+                batch = []
+        if len(batch) > 0:
+            check(batch)
+    finally:
+        scratch.drop()
+    return invalid
@@ -0,0 +1,288 @@
+"""
+Per-stage metrics and profiling hooks for the import.
+
+PipelineMetrics accumulates the time spent and the items processed in each stage of the import
+(decompress, parse, audit, convert and write), as well as the number of elements per type.
+The loops time whole stages with a few perf_counter calls per element and only touch the
+metrics if they are enabled, so that disabled metrics cost a single comparison per element.
+The results can be exported as a JSON summary or as a Prometheus text file, e.g. for the
+textfile collector of the node exporter.
+
+The hot loop can additionally be run under cProfile, or under a sampling profiler that records the
+stacks of the importing thread at a fixed interval in the collapsed format used by flame graph tools.
+"""
+
+import sys
+import json
+import time
+import cProfile
+import pstats
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Callable, Iterator
+
+STAGES = ('decompress', 'parse', 'audit', 'convert', 'write')
+# The number of elements between two progress reports.
+DEFAULT_REPORT_INTERVAL = 10000
+DEFAULT_SAMPLE_INTERVAL = 0.005
+PROFILERS = ('cprofile', 'sample')
+
+
+class PipelineMetrics:
+    """
+    Counters and timers of the import stages. The counters may be updated by several threads.
+    """
+    def __init__(self, report: Optional[Callable[[str], Any]] = None,
+                 report_interval: int = DEFAULT_REPORT_INTERVAL):
+        """
+        Initializes the metrics.
+        :param report: An optional function called with a short summary of the element rates
+                       every report_interval elements, e.g. to set the postfix of a progress bar.
+        :param report_interval: The number of elements between two reports.
+        """
+        self.seconds = dict.fromkeys(STAGES, 0.)  # type: Dict[str, float]
+        self.items = dict.fromkeys(STAGES, 0)  # type: Dict[str, int]
+        self.elements = Counter()  # type: Counter
+        self._report = report
+        self._report_interval = report_interval
+        self._until_report = report_interval
+        self._started = None  # type: Optional[float]
+        self._stopped = None  # type: Optional[float]
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._started = time.perf_counter()
+
+    def stop(self):
+        self._stopped = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        """
+        The wall-clock time between start() and stop(), or until now if the metrics were not stopped yet.
+        """
+        if self._started is None:
+            return 0.
+        return (self._stopped if self._stopped is not None else time.perf_counter()) - self._started
+
+    def add(self, stage: str, seconds: float, items: int = 1):
+        """
+        Records time spent in a stage.
+        :param stage: The stage, see STAGES.
+        :param seconds: The time spent.
+        :param items: The number of items processed in that time, e.g. elements or bytes.
+        """
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.items[stage] += items
+
+    def count(self, element_type: str):
+        """
+        Counts a parsed element.
+        :param element_type: The element type, e.g. 'node'.
+        """
+        self.elements[element_type] += 1
+        self._until_report -= 1
+        if self._until_report <= 0:
+            self._until_report = self._report_interval
+            if self._report is not None:
+                self._report(self.rates_text())
+
+    def merge(self, seconds: Dict[str, float], items: Dict[str, int]):
+        """
+        Adds the times and items recorded elsewhere, e.g. by a worker process.
+        """
+        with self._lock:
+            for stage, value in seconds.items():
+                self.seconds[stage] += value
+            for stage, value in items.items():
+                self.items[stage] += value
+
+    def rates(self) -> Dict[str, float]:
+        """
+        Gets the elements per second of each element type and in total, over the elapsed time.
+        """
+        elapsed = max(self.elapsed, 1e-9)
+        rates = {element_type: count / elapsed for element_type, count in self.elements.items()}
+        rates['total'] = sum(self.elements.values()) / elapsed
+        return rates
+
+    def rates_text(self) -> str:
+        return ', '.join(f'{element_type}s/s={rate:.0f}' for element_type, rate in self.rates().items()
+                         if element_type != 'total')
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Summarizes the metrics.
+        :return: The elapsed time, and the seconds, items and items per second of each stage,
+                 as well as the number and rate of the elements of each type.
+        """
+        with self._lock:
+            seconds = dict(self.seconds)
+            items = dict(self.items)
+        # The parser reads, and thereby decompresses, its input while it is timed.
+        seconds['parse'] = max(0., seconds['parse'] - seconds['decompress'])
+        rates = self.rates()
+        return {
+            'elapsed_seconds': self.elapsed,
+            'stages': {stage: {'seconds': seconds[stage], 'items': items[stage],
+                               'items_per_second': items[stage] / seconds[stage] if seconds[stage] > 0 else 0.}
+                       for stage in STAGES},
+            'elements': {element_type: {'count': count, 'per_second': rates[element_type]}
+                         for element_type, count in sorted(self.elements.items())},
+            'elements_per_second': rates['total']
+        }
+
+    def write_json(self, filename: str):
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, filename: str, prefix: str = 'osm_import'):
+        """
+        Writes the metrics in the Prometheus text exposition format.
+        :param filename: The file to write.
+        :param prefix: The prefix of the metric names.
+        """
+        summary = self.summary()
+        lines = [
+            f'# HELP {prefix}_duration_seconds The wall-clock time of the import.',
+            f'# TYPE {prefix}_duration_seconds gauge',
+            f'{prefix}_duration_seconds {summary["elapsed_seconds"]}',
+            f'# HELP {prefix}_stage_seconds_total The time spent in each stage, summed over all processes.',
+            f'# TYPE {prefix}_stage_seconds_total counter'
+        ]
+        lines += [f'{prefix}_stage_seconds_total{{stage="{stage}"}} {result["seconds"]}'
+                  for stage, result in summary['stages'].items()]
+        lines += [
+            f'# HELP {prefix}_stage_items_total The items processed in each stage (bytes for decompress).',
+            f'# TYPE {prefix}_stage_items_total counter'
+        ]
+        lines += [f'{prefix}_stage_items_total{{stage="{stage}"}} {result["items"]}'
+                  for stage, result in summary['stages'].items()]
+        lines += [
+            f'# HELP {prefix}_elements_total The parsed elements of each type.',
+            f'# TYPE {prefix}_elements_total counter'
+        ]
+        lines += [f'{prefix}_elements_total{{type="{element_type}"}} {result["count"]}'
+                  for element_type, result in summary['elements'].items()]
+        lines += [
+            f'# HELP {prefix}_elements_per_second The parsed elements of each type per second of the import.',
+            f'# TYPE {prefix}_elements_per_second gauge'
+        ]
+        lines += [f'{prefix}_elements_per_second{{type="{element_type}"}} {result["per_second"]}'
+                  for element_type, result in summary['elements'].items()]
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def __str__(self):
+        summary = self.summary()
+        lines = [f'{stage:>10}: {result["seconds"]:8.1f} s, {result["items_per_second"]:.0f} '
+                 f'{"bytes" if stage == "decompress" else "elements"}/s'
+                 for stage, result in summary['stages'].items()]
+        lines.append(f'{"elements":>10}: {self.rates_text()}, total/s={summary["elements_per_second"]:.0f}')
+        return '\n'.join(lines)
+
+
+class TimedInput:
+    """
+    Wraps an input file to record the time spent reading, i.e. decompressing, in the metrics.
+    """
+    def __init__(self, f: Any, metrics: PipelineMetrics):
+        self._f = f
+        self._metrics = metrics
+
+    def read(self, size: int = -1) -> bytes:
+        start = time.perf_counter()
+        data = self._f.read(size)
+        self._metrics.add('decompress', time.perf_counter() - start, len(data))
+        return data
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._f, name)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of a thread at a fixed interval from a background thread.
+    The samples are written in the collapsed stack format, one line per distinct stack:
+
+        module:function;module:function... count
+    """
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL, thread_id: Optional[int] = None):
+        """
+        Initializes the profiler.
+        :param interval: The number of seconds between two samples.
+        :param thread_id: The thread to sample; defaults to the thread calling start().
+        """
+        self._interval = interval
+        self._thread_id = thread_id
+        self._stacks = Counter()  # type: Counter
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def samples(self) -> int:
+        return sum(self._stacks.values())
+
+    def start(self):
+        if self._thread_id is None:
+            self._thread_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{frame.f_globals.get("__name__", "?")}:{code.co_name}')
+                frame = frame.f_back
+            if len(stack) > 0:
+                self._stacks[';'.join(reversed(stack))] += 1
+
+    def write(self, filename: str):
+        with open(filename, 'w', encoding='utf-8') as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+@contextmanager
+def profiled(profiler: Optional[str], filename: Optional[str]) -> Iterator[None]:
+    """
+    Runs a block of code under a profiler.
+    :param profiler: 'cprofile', 'sample' or None to run the block without profiling.
+    :param filename: The file to write the results to: pstats data for cProfile,
+                     which can be viewed with e.g. snakeviz, or collapsed stacks for the sampling profiler.
+    """
+    if profiler is None:
+        yield
+        return
+    assert profiler in PROFILERS, f'Unknown profiler: {profiler}'
+    assert filename is not None, 'The profile requires a file name.'
+    if profiler == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(filename)
+            pstats.Stats(profile).sort_stats('cumulative').print_stats(20)
+    else:
+        sampler = SamplingProfiler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            sampler.write(filename)
+            print(f'{sampler.samples} stack samples written to {filename}')
@@ -1,39 +1,145 @@
-from typing import List, Dict
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Callable, TypeVar, Tuple
+
+import numpy as np
 from pymongo.collection import Collection
 from supplemental import GeoJSON, geojson_area
+from data_wrangling.importing.documents import DISTRICT_FIELD
+from data_wrangling.importing.statistics import read_statistics, read_count, statistics_collection, \
+    type_id, key_id, tag_id, distinct_id
+from data_wrangling.importing.address_index import address_collection, is_address_index_complete
+from data_wrangling.importing.tag_tokens import tag_filter, has_tag_tokens
+from data_wrangling.query_cache import cached, query_cache
+from data_wrangling.spatial import KDTree, unit_vectors, chord_to_angle
+
+T = TypeVar('T')
+
+ELEMENT_TYPES = ('node', 'way', 'relation')
+EARTH_RADIUS_METERS = 6371 * 1000
+# The default batch size from which reverse geocoding uses an in-memory tree instead of $geoNear queries.
+DEFAULT_TREE_THRESHOLD = 1000
+
+# The default number of queries run at once; the connection pool of the client should be at least as large.
+DEFAULT_QUERY_WORKERS = 8
+
+
+@cached
+def uses_tag_tokens(berlin: Collection) -> bool:
+    """
+    Determines whether all documents carry tag tokens, so that tag conditions are answered from their index.
+    :param berlin: The collection.
+    :return: True if tag conditions can be rewritten, see data_wrangling.importing.tag_tokens.
+    """
+    return has_tag_tokens(berlin)
+
 
+def match_tags(berlin: Collection, tags: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Builds a query document for conditions on tags that uses the tag token index where possible.
+    :param berlin: The collection.
+    :param tags: The conditions by tag key, e.g. {'natural': 'tree'} or {'addr:street': {'$exists': True}}.
+    :return: The query document.
+    """
+    return tag_filter(tags, tokens=uses_tag_tokens(berlin))
 
+
+@cached
 def get_tag_types(berlin: Collection) -> str:
-    tag_types = list(berlin.aggregate([
-        {
-            '$group': {'_id': '$_id.type',
-                       'count': {'$sum': 1}}
-        }
-    ]))
+    if read_statistics(berlin) is not None:
+        tag_types = [{'_id': stat['_id']['type'], 'count': stat['count']}
+                     for stat in statistics_collection(berlin).find({'_id.kind': 'type', 'count': {'$gt': 0}})]
+        tag_types.sort(key=lambda t: ELEMENT_TYPES.index(t['_id']) if t['_id'] in ELEMENT_TYPES else len(ELEMENT_TYPES))
+    else:
+        tag_types = list(berlin.aggregate([
+            {
+                '$group': {'_id': '$_id.type',
+                           'count': {'$sum': 1}}
+            }
+        ]))
     return '\n'.join([f"{t['_id']:9}: {t['count']}"
                       for t in tag_types])
 
 
+@cached
 def count_elems(berlin: Collection, name: str) -> int:
-    return berlin.find({'_id.type': name}).count()
+    if read_statistics(berlin) is not None:
+        return read_count(berlin, type_id(name))
+    return berlin.count_documents({'_id.type': name})
 
 
+@cached
 def count_tags(berlin: Collection, tag: str, value: str) -> int:
-    return berlin.find({tag: value}).count()
+    stats = read_statistics(berlin)
+    if stats is not None and tag.startswith('tags.') and tag[len('tags.'):] in stats['value_keys']:
+        return read_count(berlin, tag_id(tag[len('tags.'):], value))
+    if tag.startswith('tags.'):
+        return berlin.count_documents(match_tags(berlin, {tag[len('tags.'):]: value}))
+    return berlin.count_documents({tag: value})
+
+
+@cached
+def count_tag_keys(berlin: Collection, key: str) -> int:
+    """
+    Counts the elements having a tag key.
+    :param berlin: The collection.
+    :param key: The tag key, e.g. 'amenity'.
+    :return: The number of elements.
+    """
+    if read_statistics(berlin) is not None:
+        return read_count(berlin, key_id(key))
+    return berlin.count_documents(match_tags(berlin, {key: {'$exists': True}}))
 
 
+@cached
+def count_distinct_values(berlin: Collection, key: str) -> int:
+    """
+    Counts the distinct values of a tag key.
+    :param berlin: The collection.
+    :param key: The tag key, e.g. 'amenity'.
+    :return: The number of distinct values.
+    """
+    stats = read_statistics(berlin)
+    if stats is not None and key in stats['value_keys']:
+        return read_count(berlin, distinct_id(key))
+    return len(berlin.distinct(f'tags.{key}', match_tags(berlin, {key: {'$exists': True}})))
+
+
+@cached
 def get_closest_address(berlin: Collection, coordinate: List[float]):
+    if is_address_index_complete(berlin):
+        # The compact address collection only holds addressable nodes and has its own geo index.
+        near = address_collection(berlin).aggregate([
+            {
+                '$geoNear': {
+                    'near': coordinate,
+                    'distanceField': 'distance_meters',
+                    'distanceMultiplier': EARTH_RADIUS_METERS,
+                    'spherical': True
+                }
+            },
+            {'$limit': 1},
+            {
+                '$project': {
+                    'distance_meters': '$distance_meters',
+                    'coordinates': '$loc.coordinates',
+                    'addr.street': '$street',
+                    'addr.house_no': '$house_no',
+                    '_id': 0
+                }
+            }
+        ])
+        return list(near)[0]
     near = berlin.aggregate([
         {
             '$geoNear': {
                 'near': coordinate,
                 'distanceField': 'distance_meters',
-                'distanceMultiplier': 6371 * 1000,
+                'distanceMultiplier': EARTH_RADIUS_METERS,
                 'spherical': True,
                 'query': {
                     '_id.type': 'node',
-                    'tags.addr:street': {'$exists': True},
-                    'tags.addr:housenumber': {'$exists': True}
+                    **match_tags(berlin, {'addr:street': {'$exists': True}, 'addr:housenumber': {'$exists': True}})
                 }
             }
         },
@@ -51,9 +157,88 @@ def get_closest_address(berlin: Collection, coordinate: List[float]):
     return list(near)[0]
 
 
+class AddressTree:
+    """
+    The addresses of a collection in a k-d tree over points on the unit sphere.
+    """
+    def __init__(self, berlin: Collection):
+        """
+        Loads the addresses, from the address collection if it is complete.
+        :param berlin: The collection.
+        """
+        if is_address_index_complete(berlin):
+            docs = address_collection(berlin).find(projection={'loc': True, 'street': True, 'house_no': True})
+            addresses = [(d['loc']['coordinates'], d['street'], d['house_no']) for d in docs]
+        else:
+            docs = berlin.find({'_id.type': 'node',
+                                **match_tags(berlin, {'addr:street': {'$exists': True},
+                                                      'addr:housenumber': {'$exists': True}})},
+                               projection={'loc': True, 'tags.addr:street': True, 'tags.addr:housenumber': True})
+            addresses = [(d['loc']['coordinates'], d['tags']['addr:street'], d['tags']['addr:housenumber'])
+                         for d in docs]
+        self.coordinates = np.array([a[0] for a in addresses], dtype=np.float64).reshape(-1, 2)
+        self.streets = [a[1] for a in addresses]
+        self.house_numbers = [a[2] for a in addresses]
+        self.tree = KDTree(unit_vectors(self.coordinates[:, 0], self.coordinates[:, 1]))
+
+    def __len__(self) -> int:
+        return len(self.streets)
+
+    def closest(self, coordinates: List[List[float]]) -> List[Dict[str, Any]]:
+        if len(self) == 0:
+            raise IndexError('The collection contains no addresses.')
+        points = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        indices, chords = self.tree.query(unit_vectors(points[:, 0], points[:, 1]))
+        return [{
+            'distance_meters': chord_to_angle(chord) * EARTH_RADIUS_METERS,
+            'coordinates': self.coordinates[index].tolist(),
+            'addr': {'street': self.streets[index], 'house_no': self.house_numbers[index]}
+        } for index, chord in zip(indices.tolist(), chords.tolist())]
+
+
+# The address trees by collection, along with the generation they were loaded in.
+_address_trees = {}  # type: Dict[str, Tuple[Optional[str], AddressTree]]
+_address_trees_lock = threading.Lock()
+
+
+def get_address_tree(berlin: Collection) -> AddressTree:
+    """
+    Gets the address tree of a collection, which is reloaded whenever the collection was changed.
+    :param berlin: The collection.
+    :return: The address tree.
+    """
+    generation = query_cache.generation(berlin)
+    with _address_trees_lock:
+        entry = _address_trees.get(berlin.full_name)
+        if entry is None or entry[0] != generation or generation is None:
+            entry = _address_trees[berlin.full_name] = generation, AddressTree(berlin)
+    return entry[1]
+
+
+def get_closest_addresses(berlin: Collection, coordinates: List[List[float]],
+                          tree_threshold: int = DEFAULT_TREE_THRESHOLD,
+                          workers: int = DEFAULT_QUERY_WORKERS) -> List[Dict[str, Any]]:
+    """
+    Finds the closest address of each of a batch of coordinates.
+    :param berlin: The collection.
+    :param coordinates: The [lon, lat] coordinates.
+    :param tree_threshold: The batch size from which the addresses are loaded into an in-memory k-d tree;
+                           smaller batches run concurrent $geoNear queries.
+    :param workers: The maximum number of queries to run at once for small batches.
+    :return: The closest address of each coordinate, see get_closest_address.
+    """
+    if len(coordinates) == 0:
+        return []
+    if len(coordinates) >= tree_threshold:
+        return get_address_tree(berlin).closest(coordinates)
+    with ThreadPoolExecutor(max_workers=min(workers, len(coordinates))) as executor:
+        return list(executor.map(lambda coordinate: get_closest_address(berlin, list(coordinate)), coordinates))
+
+
+@cached
 def count_street_types_by_regex(berlin: Collection, regex: str) -> int:
     return list(berlin.aggregate([
-        {'$match': {'tags.addr:street': {'$regex': regex}}},
+        {'$match': match_tags(berlin, {'addr:street': {'$regex': regex}})},
         {'$count': 'count'}
     ]))[0]['count']
 
@@ -62,30 +247,105 @@ def count_street_types_by_suffix(berlin: Collection, regex: str) -> int:
     return count_street_types_by_regex(berlin, regex + '$')
 
 
-def get_streets_in_region(berlin: Collection, region: GeoJSON) -> List[str]:
-    results = list(berlin.aggregate([
-        {'$match': {
-            'loc': {
-                '$geoWithin': {
-                    '$geometry': region
-                }
-            },
-            '_id.type': 'node'
+@cached
+def get_streets_in_region(berlin: Collection, region: GeoJSON, include_ways: bool = False) -> List[str]:
+    within = {
+        '$geoWithin': {
+            '$geometry': region
         }
-        },
-        {'$match': {'tags.addr:street': {'$exists': True}}},
+    }
+    if include_ways:
+        # Ways only have a geometry if their nodes were resolved during the import.
+        location = {'$or': [{'loc': within, '_id.type': 'node'}, {'geometry': within, '_id.type': 'way'}]}
+    else:
+        location = {'loc': within, '_id.type': 'node'}
+    results = list(berlin.aggregate([
+        {'$match': location},
+        {'$match': match_tags(berlin, {'addr:street': {'$exists': True}})},
         {'$group': {'_id': '$tags.addr:street', 'count': {'$sum': 1}}}
     ]))
     return sorted([result['_id'] for result in results])
 
 
-def get_streets_per_district(berlin: Collection, districts: Dict[str, GeoJSON]) -> Dict[str, List[str]]:
-    results = {}
-    for district in sorted(districts.keys()):
-        print(f'Finding streets in {district} ...')
-        streets = get_streets_in_region(berlin, districts[district])
-        results[district] = streets
-    return results
+def get_ways_in_region(berlin: Collection, region: GeoJSON, tags: Optional[Dict[str, Any]] = None,
+                       intersecting: bool = False) -> List[Dict]:
+    """
+    Finds the ways located in a region, e.g. streets or building outlines.
+    :param berlin: The collection.
+    :param region: The region.
+    :param tags: Optional tag conditions, e.g. {'building': {'$exists': True}}.
+    :param intersecting: If True, ways crossing the border of the region are included as well.
+    :return: The ways.
+    """
+    query = {
+        'geometry': {
+            '$geoIntersects' if intersecting else '$geoWithin': {
+                '$geometry': region
+            }
+        },
+        '_id.type': 'way',
+        **match_tags(berlin, tags or {})
+    }
+    return list(berlin.find(query))
+
+
+@cached
+def has_districts(berlin: Collection) -> bool:
+    """
+    Determines whether the documents were assigned to districts during the import.
+    :param berlin: The collection.
+    :return: True if the district field is available.
+    """
+    return berlin.find_one({DISTRICT_FIELD: {'$exists': True}}, projection={'_id': True}) is not None
+
+
+@cached
+def get_streets_in_district(berlin: Collection, district: str, field: str = DISTRICT_FIELD) -> List[str]:
+    """
+    Finds the streets of the addresses in a district using the district assigned during the import.
+    :param berlin: The collection.
+    :param district: The name of the district.
+    :param field: The field to match; use 'region' for a Bezirksregion.
+    :return: The sorted street names.
+    """
+    return sorted(berlin.distinct('tags.addr:street',
+                                  {field: district, **match_tags(berlin, {'addr:street': {'$exists': True}})}))
+
+
+def run_per_region(query: Callable[[Collection, GeoJSON], T], berlin: Collection, regions: Dict[str, GeoJSON],
+                   workers: int = DEFAULT_QUERY_WORKERS) -> Dict[str, T]:
+    """
+    Runs a query for each region concurrently on a pool of threads sharing the connection pool of the client,
+    so that the total time is close to that of the slowest region rather than the sum over all regions.
+    :param query: The query, called with the collection and the region.
+    :param berlin: The collection.
+    :param regions: The regions by name.
+    :param workers: The maximum number of queries to run at once.
+    :return: The results by region name, in the order of the names.
+    """
+    assert workers > 0, 'At least one worker thread is required.'
+    if len(regions) == 0:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(workers, len(regions))) as executor:
+        futures = {name: executor.submit(query, berlin, region) for name, region in regions.items()}
+        return {name: futures[name].result() for name in sorted(futures.keys())}
+
+
+@cached
+def get_streets_per_district(berlin: Collection, districts: Dict[str, GeoJSON],
+                             workers: int = DEFAULT_QUERY_WORKERS) -> Dict[str, List[str]]:
+    if not has_districts(berlin):
+        return run_per_region(get_streets_in_region, berlin, districts, workers=workers)
+    # A single pass over the indexed district field instead of one geo query per district.
+    results = {district: [] for district in districts.keys()}
+    for result in berlin.aggregate([
+        {'$match': {DISTRICT_FIELD: {'$in': list(districts.keys())},
+                    '_id.type': 'node',
+                    **match_tags(berlin, {'addr:street': {'$exists': True}})}},
+        {'$group': {'_id': {'district': '$' + DISTRICT_FIELD, 'street': '$tags.addr:street'}}}
+    ]):
+        results[result['_id']['district']].append(result['_id']['street'])
+    return {district: sorted(streets) for district, streets in sorted(results.items())}
 
 
 def get_district_areas(districts: Dict[str, GeoJSON], scale: float=1.0) -> Dict[str, float]:
@@ -105,7 +365,8 @@ def count_streets_per_area(streets: Dict[str, List[str]], areas: Dict[str, float
     return counts
 
 
-def get_trees_in_region(berlin: Collection, region: GeoJSON) -> List[str]:
+@cached
+def get_trees_in_region(berlin: Collection, region: GeoJSON) -> int:
     results = list(berlin.aggregate([
         {'$match': {
             'loc': {
@@ -114,8 +375,14 @@ def get_trees_in_region(berlin: Collection, region: GeoJSON) -> List[str]:
                 }
             },
             '_id.type': 'node',
-            'tags.natural': 'tree',
+            **match_tags(berlin, {'natural': 'tree'})
         }},
         {'$count': 'count'}
     ]))
-    return results[0]['count']
+    return results[0]['count'] if len(results) > 0 else 0
+
+
+@cached
+def get_trees_per_district(berlin: Collection, districts: Dict[str, GeoJSON],
+                           workers: int = DEFAULT_QUERY_WORKERS) -> Dict[str, int]:
+    return run_per_region(get_trees_in_region, berlin, districts, workers=workers)
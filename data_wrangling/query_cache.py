@@ -0,0 +1,274 @@
+"""
+A cache of query results that is invalidated whenever the queried collection is re-imported.
+
+Every import or applied change file stores a new random generation token for the collection in
+the osm_meta collection. Cached results are keyed on the query function, its arguments and the
+collection, and are only returned while the generation they were computed in is still current.
+Results are kept in a bounded in-memory LRU cache and, optionally, in a size-bounded directory
+of pickle files that survives restarts of the notebook.
+"""
+
+import os
+import json
+import time
+import uuid
+import pickle
+import marshal
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Tuple, Optional, Callable, Any
+
+from pymongo.collection import Collection
+from pymongo.database import Database
+
+CACHE_VERSION = 1
+META_COLLECTION = 'osm_meta'
+DEFAULT_MAX_SIZE = 256
+DEFAULT_MAX_DISK_BYTES = 256 * 1024 * 1024
+# The number of seconds a generation token is trusted before it is read again.
+DEFAULT_CHECK_INTERVAL = 1.
+
+
+def generation_key(collection_name: str) -> str:
+    return f'generation:{collection_name}'
+
+
+def bump_generation(database: Database, collection_name: str) -> str:
+    """
+    Marks the data of a collection as changed, which invalidates all cached query results.
+    :param database: The database.
+    :param collection_name: The name of the changed collection.
+    :return: The new generation token.
+    """
+    token = uuid.uuid4().hex
+    database.get_collection(META_COLLECTION).replace_one(
+        {'_id': generation_key(collection_name)},
+        {'_id': generation_key(collection_name), 'generation': token, 'changed': datetime.utcnow()},
+        upsert=True)
+    return token
+
+
+class QueryCache:
+    """
+    Caches the results of query functions taking a collection as their first argument.
+    Cached results are shared between callers and must not be modified.
+    """
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE, directory: Optional[str] = None,
+                 max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES, check_interval: float = DEFAULT_CHECK_INTERVAL):
+        """
+        Initializes the cache.
+        :param max_size: The maximum number of results kept in memory.
+        :param directory: An optional directory to additionally keep the results in.
+        :param max_disk_bytes: The maximum size of the files in the directory; the least
+                               recently used results are removed first.
+        :param check_interval: The number of seconds a generation token is trusted before it is read again.
+        """
+        assert max_size > 0, 'The cache size must be positive.'
+        self._max_size = max_size
+        self._check_interval = check_interval
+        self._memory = OrderedDict()  # type: OrderedDict[str, Tuple[str, Any]]
+        self._generations = {}  # type: Dict[str, Tuple[float, Optional[str]]]
+        self._lock = threading.RLock()
+        self._directory = None  # type: Optional[str]
+        self._max_disk_bytes = max_disk_bytes
+        self._disk_sizes = {}  # type: Dict[str, int]
+        self.enabled = True
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory is not None:
+            self.enable_disk(directory, max_disk_bytes)
+
+    def enable_disk(self, directory: str, max_bytes: int = DEFAULT_MAX_DISK_BYTES):
+        """
+        Keeps the results in a directory in addition to the memory.
+        :param directory: The directory.
+        :param max_bytes: The maximum size of the files in the directory.
+        """
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._directory = directory
+            self._max_disk_bytes = max_bytes
+            self._disk_sizes = {name: os.path.getsize(os.path.join(directory, name))
+                                for name in os.listdir(directory) if name.endswith('.pickle')}
+            self._evict_disk()
+
+    def clear(self):
+        """
+        Removes all results from the memory and the directory.
+        """
+        with self._lock:
+            self._memory.clear()
+            self._generations.clear()
+            if self._directory is not None:
+                for name in list(self._disk_sizes.keys()):
+                    self._remove_file(name)
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+    def generation(self, collection: Collection) -> Optional[str]:
+        """
+        Gets the current generation token of a collection, reading it at most once per check interval.
+        :param collection: The collection.
+        :return: The token or None if the collection was imported without one.
+        """
+        now = time.monotonic()
+        checked = self._generations.get(collection.full_name)
+        if checked is not None and now - checked[0] < self._check_interval:
+            return checked[1]
+        meta = collection.database.get_collection(META_COLLECTION).find_one(
+            {'_id': generation_key(collection.name)}, projection={'generation': True})
+        token = meta['generation'] if meta is not None else None
+        self._generations[collection.full_name] = now, token
+        return token
+
+    def cached(self, fn: Callable) -> Callable:
+        """
+        Decorates a query function to cache its results.
+        :param fn: The function; its first argument must be the queried collection, and
+                   the other arguments must be JSON serializable.
+        :return: The decorated function.
+        """
+        name = f'{fn.__module__}.{fn.__qualname__}'
+
+        @functools.wraps(fn)
+        def wrapper(collection: Collection, *args, **kwargs):
+            if not self.enabled:
+                return fn(collection, *args, **kwargs)
+            generation = self.generation(collection)
+            if generation is None:
+                # Without a generation token, changes of the data could not be detected.
+                return fn(collection, *args, **kwargs)
+            key = _make_key(name, collection, args, kwargs)
+            found, value = self._get(key, generation)
+            if found:
+                return value
+            value = fn(collection, *args, **kwargs)
+            self._put(key, generation, value)
+            return value
+        return wrapper
+
+    def _get(self, key: str, generation: str) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] == generation:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[1]
+                del self._memory[key]
+        entry = self._load(key)
+        if entry is not None and entry[0] == generation:
+            with self._lock:
+                self._remember(key, entry)
+                self.disk_hits += 1
+            return True, entry[1]
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def _put(self, key: str, generation: str, value: Any):
+        with self._lock:
+            self._remember(key, (generation, value))
+        self._store(key, (generation, value))
+
+    def _remember(self, key: str, entry: Tuple[str, Any]):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._max_size:
+            self._memory.popitem(last=False)
+
+    def _load(self, key: str) -> Optional[Tuple[str, Any]]:
+        if self._directory is None:
+            return None
+        name = key + '.pickle'
+        path = os.path.join(self._directory, name)
+        try:
+            with open(path, 'rb') as f:
+                version, generation, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+        if version != CACHE_VERSION:
+            return None
+        with self._lock:
+            try:
+                # The modification time orders the files for eviction.
+                os.utime(path)
+            except OSError:
+                pass
+        return generation, value
+
+    def _store(self, key: str, entry: Tuple[str, Any]):
+        if self._directory is None:
+            return
+        name = key + '.pickle'
+        path = os.path.join(self._directory, name)
+        with self._lock:
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((CACHE_VERSION,) + entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            self._disk_sizes[name] = os.path.getsize(path)
+            self._evict_disk()
+
+    def _evict_disk(self):
+        total = sum(self._disk_sizes.values())
+        if total <= self._max_disk_bytes:
+            return
+        by_age = sorted(self._disk_sizes.keys(), key=lambda name: self._mtime(name))
+        for name in by_age:
+            if total <= self._max_disk_bytes:
+                break
+            total -= self._disk_sizes[name]
+            self._remove_file(name)
+
+    def _mtime(self, name: str) -> float:
+        try:
+            return os.path.getmtime(os.path.join(self._directory, name))
+        except OSError:
+            return 0.
+
+    def _remove_file(self, name: str):
+        self._disk_sizes.pop(name, None)
+        try:
+            os.remove(os.path.join(self._directory, name))
+        except OSError:
+            pass
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {self.hits} hits, {self.disk_hits} disk hits, {self.misses} misses, ' \
+               f'{len(self)} cached'
+
+
+# The marshal format without object references, whose output does not depend on reference counts.
+MARSHAL_VERSION = 2
+
+
+def _digest(value: Any) -> str:
+    """
+    Gets a digest of an argument. Arguments are serialized with marshal where possible, which is
+    many times faster than JSON for large arguments such as GeoJSON polygons of regions.
+    :param value: The argument.
+    :return: The hexadecimal SHA-256 of its serialization.
+    """
+    try:
+        data = b'm' + marshal.dumps(value, MARSHAL_VERSION)
+    except ValueError:
+        # E.g. datetimes or ObjectIds.
+        data = b'j' + json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def _make_key(name: str, collection: Collection, args: Tuple, kwargs: Dict[str, Any]) -> str:
+    text = json.dumps([name, collection.full_name, [_digest(arg) for arg in args],
+                       {key: _digest(value) for key, value in kwargs.items()}], sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# The cache used by the functions in data_wrangling.queries.
+query_cache = QueryCache()
+cached = query_cache.cached
@@ -0,0 +1,308 @@
+"""
+An in-process spatial index of named polygons, e.g. the districts of Berlin.
+
+The bounding boxes of the polygons are packed into an R-tree using the Sort-Tile-Recursive
+algorithm. Points are located in batches: the whole batch descends the tree at once, narrowing
+down the points per node with vectorized bounding box tests, and the candidates of each polygon
+are then tested with a vectorized even-odd ray casting test against all of its edges.
+"""
+
+import math
+from typing import Dict, List, Optional, Tuple, Any, Iterator
+
+import numpy as np
+
+GeoJSON = Dict[str, Any]
+
+DEFAULT_NODE_CAPACITY = 16
+# The maximum number of point/edge pairs tested at once, which bounds the temporary memory.
+_MAX_PAIRS = 1 << 22
+
+
+class PolygonIndex:
+    """
+    Locates points in a set of named, non-overlapping regions.
+    """
+    def __init__(self, regions: Dict[str, GeoJSON], node_capacity: int = DEFAULT_NODE_CAPACITY):
+        """
+        Builds the index.
+        :param regions: The GeoJSON Polygon or MultiPolygon geometries by region name.
+        :param node_capacity: The maximum number of children of a node of the R-tree.
+        """
+        assert node_capacity > 1, 'The node capacity must be at least two.'
+        self._names = sorted(regions.keys())
+        labels, bboxes, edges, offsets = [], [], [], [0]
+        for label, name in enumerate(self._names):
+            for rings in _polygons(regions[name]):
+                ring_edges = [_ring_edges(ring) for ring in rings if len(ring) > 1]
+                if len(ring_edges) == 0:
+                    continue
+                exterior = np.asarray(rings[0], dtype=np.float64)[:, :2]
+                labels.append(label)
+                bboxes.append(np.concatenate([exterior.min(axis=0), exterior.max(axis=0)]))
+                edges.extend(ring_edges)
+                offsets.append(offsets[-1] + sum(len(e) for e in ring_edges))
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        order = _str_order(bboxes, node_capacity)
+        # The polygons are stored in the order of the leaves of the R-tree.
+        offsets = np.asarray(offsets, dtype=np.int64)
+        self._labels = np.asarray(labels, dtype=np.int32)[order]
+        self._bboxes = bboxes[order]
+        self._edge_ranges = np.stack([offsets[:-1], offsets[1:]], axis=1)[order]
+        edges = np.concatenate(edges) if len(edges) > 0 else np.zeros((0, 4))
+        x1, y1, x2, y2 = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+        # The inverse slope is precomputed; horizontal edges never cross a ray, so theirs is irrelevant.
+        dy = y2 - y1
+        self._edges = np.stack([x1, y1, y2, np.divide(x2 - x1, dy, out=np.zeros_like(dy), where=dy != 0)], axis=1)
+        self._levels = _pack(self._bboxes, node_capacity)
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def query(self, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+        """
+        Locates a batch of points.
+        :param lon: The longitudes of the points.
+        :param lat: The latitudes of the points.
+        :return: The index of the region containing each point in names, or -1 for points outside of all regions.
+        """
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        result = np.full(len(lon), -1, dtype=np.int32)
+        for polygon, candidates in self._candidates(lon, lat):
+            # The regions do not overlap, so points already located need not be tested again.
+            candidates = candidates[result[candidates] < 0]
+            if len(candidates) == 0:
+                continue
+            inside = self._contains(polygon, lon[candidates], lat[candidates])
+            result[candidates[inside]] = self._labels[polygon]
+        return result
+
+    def locate(self, lon: float, lat: float) -> Optional[str]:
+        """
+        Locates a single point.
+        :param lon: The longitude.
+        :param lat: The latitude.
+        :return: The name of the region containing the point, or None.
+        """
+        label = self.query(np.array([lon]), np.array([lat]))[0]
+        return self._names[label] if label >= 0 else None
+
+    def locate_all(self, coordinates: List[Tuple[float, float]]) -> List[Optional[str]]:
+        """
+        Locates a batch of points.
+        :param coordinates: The (lon, lat) coordinates of the points.
+        :return: The name of the region containing each point, or None.
+        """
+        if len(coordinates) == 0:
+            return []
+        points = np.asarray(coordinates, dtype=np.float64)
+        return [self._names[label] if label >= 0 else None for label in self.query(points[:, 0], points[:, 1])]
+
+    def _candidates(self, lon: np.ndarray, lat: np.ndarray) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Descends the R-tree with a batch of points.
+        :return: The polygons and the indices of the points within their bounding boxes.
+        """
+        if len(self._levels) == 0 or len(lon) == 0:
+            return
+        stack = [(len(self._levels) - 1, 0, np.arange(len(lon)))]
+        while len(stack) > 0:
+            level, node, points = stack.pop()
+            start, end = self._levels[level][1][node]
+            child_bboxes = self._levels[level - 1][0] if level > 0 else self._bboxes
+            x, y = lon[points], lat[points]
+            for child in range(start, end):
+                min_lon, min_lat, max_lon, max_lat = child_bboxes[child]
+                within = points[(x >= min_lon) & (x <= max_lon) & (y >= min_lat) & (y <= max_lat)]
+                if len(within) == 0:
+                    continue
+                if level > 0:
+                    stack.append((level - 1, child, within))
+                else:
+                    yield child, within
+
+    def _contains(self, polygon: int, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+        """
+        Tests points against all rings of a polygon; points within holes cross an even number of edges.
+        """
+        start, end = self._edge_ranges[polygon]
+        edges = self._edges[start:end]
+        x1, y1, y2, slope = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+        inside = np.zeros(len(lon), dtype=bool)
+        step = max(1, _MAX_PAIRS // max(1, len(edges)))
+        for first in range(0, len(lon), step):
+            x = lon[first:first + step, np.newaxis]
+            y = lat[first:first + step, np.newaxis]
+            crossing = ((y1 > y) != (y2 > y)) & (x < x1 + (y - y1) * slope)
+            inside[first:first + step] = np.count_nonzero(crossing, axis=1) % 2 == 1
+        return inside
+
+
+def _polygons(geometry: GeoJSON) -> List[List[List[List[float]]]]:
+    """
+    Gets the rings of each polygon of a Polygon, MultiPolygon or GeometryCollection.
+    """
+    kind = geometry['type']
+    if kind == 'Polygon':
+        return [geometry['coordinates']]
+    if kind == 'MultiPolygon':
+        return list(geometry['coordinates'])
+    if kind == 'GeometryCollection':
+        return [rings for part in geometry['geometries'] for rings in _polygons(part)]
+    raise ValueError(f'Unsupported geometry type: {kind}')
+
+
+def _ring_edges(ring: List[List[float]]) -> np.ndarray:
+    points = np.asarray(ring, dtype=np.float64)[:, :2]
+    if not np.array_equal(points[0], points[-1]):
+        points = np.vstack([points, points[:1]])
+    return np.hstack([points[:-1], points[1:]])
+
+
+def _pack(bboxes: np.ndarray, capacity: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Builds an R-tree over bounding boxes that are already in Sort-Tile-Recursive order, see _str_order.
+    :return: The levels of the tree from the leaves to the root, each given by the bounding boxes
+             of its nodes and the [start, end) ranges of their children in the level below.
+    """
+    levels = []
+    items = bboxes
+    while len(items) > 0:
+        count = len(items)
+        children = np.array([(start, min(start + capacity, count)) for start in range(0, count, capacity)],
+                            dtype=np.int64)
+        nodes = np.array([np.concatenate([items[start:end, :2].min(axis=0), items[start:end, 2:].max(axis=0)])
+                          for start, end in children])
+        # Sorting the nodes for the next level only permutes their ranges of children.
+        order = _str_order(nodes, capacity)
+        nodes, children = nodes[order], children[order]
+        levels.append((nodes, children))
+        if len(nodes) == 1:
+            break
+        items = nodes
+    return levels
+
+
+def _str_order(bboxes: np.ndarray, capacity: int) -> np.ndarray:
+    """
+    Orders bounding boxes by the Sort-Tile-Recursive scheme: into vertical slices by the x coordinate
+    of their centers, and within each slice by the y coordinate.
+    """
+    count = len(bboxes)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    centers = (bboxes[:, :2] + bboxes[:, 2:]) / 2
+    slices = math.ceil(math.sqrt(math.ceil(count / capacity)))
+    slice_size = capacity * math.ceil(count / (capacity * slices))
+    by_x = np.argsort(centers[:, 0], kind='stable')
+    order = [group[np.argsort(centers[group, 1], kind='stable')]
+             for group in (by_x[start:start + slice_size] for start in range(0, count, slice_size))]
+    return np.concatenate(order)
+
+
+def unit_vectors(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    """
+    Converts coordinates in degrees to points on the unit sphere, on which the Euclidean
+    (chord) distance increases monotonically with the great-circle distance.
+    :param lon: The longitudes.
+    :param lat: The latitudes.
+    :return: An n x 3 array of points.
+    """
+    lon, lat = np.radians(np.asarray(lon, dtype=np.float64)), np.radians(np.asarray(lat, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def chord_to_angle(chord: float) -> float:
+    """
+    Converts the distance of two points on the unit sphere to the angle between them in radians.
+    """
+    return 2. * math.asin(min(1., chord / 2.))
+
+
+class KDTree:
+    """
+    A k-d tree for nearest neighbor queries. The points are split at the median of the axis
+    of their largest extent until at most leaf_size points remain, which are scanned vectorized.
+    """
+    def __init__(self, points: np.ndarray, leaf_size: int = 32):
+        """
+        Builds the tree.
+        :param points: An n x k array of points.
+        :param leaf_size: The maximum number of points in a leaf.
+        """
+        assert leaf_size > 0, 'The leaf size must be positive.'
+        self._points = np.asarray(points, dtype=np.float64)
+        self._order = np.arange(len(self._points))
+        # The nodes are given by their range within the order, the split axis and value, and the child nodes.
+        self._nodes = []  # type: List[Tuple[int, int, int, float, int, int]]
+        if len(self._points) > 0:
+            self._build(0, len(self._points), leaf_size)
+        self._sorted = self._points[self._order]
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def _build(self, start: int, end: int, leaf_size: int) -> int:
+        node = len(self._nodes)
+        self._nodes.append((start, end, -1, 0., -1, -1))
+        if end - start <= leaf_size:
+            return node
+        indices = self._order[start:end]
+        points = self._points[indices]
+        axis = int(np.argmax(points.max(axis=0) - points.min(axis=0)))
+        middle = (end - start) // 2
+        partition = np.argpartition(points[:, axis], middle)
+        self._order[start:end] = indices[partition]
+        split = float(self._points[self._order[start + middle], axis])
+        left = self._build(start, start + middle, leaf_size)
+        right = self._build(start + middle, end, leaf_size)
+        self._nodes[node] = (start, end, axis, split, left, right)
+        return node
+
+    def nearest(self, point: np.ndarray) -> Tuple[int, float]:
+        """
+        Finds the nearest point.
+        :param point: The query point.
+        :return: The index of the nearest point and its Euclidean distance, or (-1, inf) for an empty tree.
+        """
+        point = np.asarray(point, dtype=np.float64)
+        best, best_distance = -1, math.inf
+        if len(self._nodes) == 0:
+            return best, best_distance
+        stack = [(0, 0.)]
+        while len(stack) > 0:
+            node, bound = stack.pop()
+            if bound >= best_distance:
+                continue
+            start, end, axis, split, left, right = self._nodes[node]
+            if axis < 0:
+                distances = np.sum((self._sorted[start:end] - point) ** 2, axis=1)
+                nearest = int(np.argmin(distances))
+                if distances[nearest] < best_distance:
+                    best, best_distance = int(self._order[start + nearest]), float(distances[nearest])
+                continue
+            offset = point[axis] - split
+            near, far = (left, right) if offset < 0 else (right, left)
+            # The far side is visited last, and only if it can contain a closer point.
+            stack.append((far, offset * offset))
+            stack.append((near, bound))
+        return best, math.sqrt(best_distance)
+
+    def query(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest point for each of a batch of query points.
+        :param points: An m x k array of query points.
+        :return: The indices of the nearest points and their Euclidean distances.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        indices = np.full(len(points), -1, dtype=np.int64)
+        distances = np.full(len(points), math.inf)
+        for i, point in enumerate(points):
+            indices[i], distances[i] = self.nearest(point)
+        return indices, distances
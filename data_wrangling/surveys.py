@@ -0,0 +1,158 @@
+"""
+Survey handlers (analyzers) that collect properties of OSM XML files.
+
+The analyzers implement the start/end callbacks of the expat scanner, which
+can be driven by either parser backend, and write their results as a text report.
+The counting analyzers collect their results in a Counter, which makes them usable
+for sharded scans whose partial counts are merged as well.
+"""
+
+from collections import Counter
+from typing import Dict, Iterable, Optional, TextIO, Set
+
+from data_wrangling.auditing import audit_street_name
+
+
+class TagPathCounter:
+    """
+    Counts the XML paths of all elements, e.g. osm.way.tag.
+    """
+    name = 'tag_paths'
+
+    def __init__(self, parents: Optional[Iterable[str]] = None):
+        """
+        Initializes the counter.
+        :param parents: The names of the elements enclosing the scanned data, if the scan
+                        does not start at the beginning of the document.
+        """
+        self.counts = Counter()
+        self._stack = list(parents) if parents is not None else []
+
+    def start(self, name: str, attrs: Dict[str, str]):
+        self._stack.append(name)
+        self.counts['.'.join(self._stack)] += 1
+
+    def end(self, name: str):
+        self._stack.pop()
+
+    def write_report(self, f: TextIO):
+        f.write('XML item counts:\n')
+        for item in sorted(self.counts.items(), key=lambda x: len(x[0])):
+            f.write(f'{item[1]:10d} {item[0]:s}\n')
+
+
+class TagKeyCounter:
+    """
+    Counts the keys of all tag elements.
+    """
+    name = 'tag_keys'
+    end = None
+
+    def __init__(self, parents: Optional[Iterable[str]] = None):
+        """
+        Initializes the counter.
+        :param parents: Unused; see TagPathCounter.
+        """
+        self.counts = Counter()
+
+    def start(self, name: str, attrs: Dict[str, str]):
+        if name == 'tag':
+            self.counts[attrs['k']] += 1
+
+    def write_report(self, f: TextIO):
+        f.write('Tag key counts:\n')
+        for key, count in sorted(self.counts.items(), key=lambda x: x[0]):
+            f.write(f'{count:10d} {key:s}\n')
+
+
+class StreetNameCollector:
+    """
+    Collects the distinct street names (addr:street) of all ways.
+    """
+    name = 'street_names'
+
+    def __init__(self, parents: Optional[Iterable[str]] = None):
+        self.street_names = set()  # type: Set[str]
+        self._depth_in_way = 0
+
+    def start(self, name: str, attrs: Dict[str, str]):
+        if name == 'way':
+            self._depth_in_way = 1
+        elif self._depth_in_way > 0:
+            self._depth_in_way += 1
+            if name == 'tag' and self._depth_in_way == 2 and attrs.get('k') == 'addr:street':
+                self.street_names.add(attrs['v'])
+
+    def end(self, name: str):
+        if self._depth_in_way > 0:
+            self._depth_in_way -= 1
+
+    def write_report(self, f: TextIO):
+        f.write('\n'.join(sorted(self.street_names)))
+
+
+class StreetNameAuditor(StreetNameCollector):
+    """
+    Collects the street names of all ways and audits them, reporting corrected and skipped names.
+    """
+    name = 'street_audit'
+
+    def write_report(self, f: TextIO):
+        for name in sorted(self.street_names):
+            try:
+                was_valid, valid = audit_street_name(name)
+            except ValueError as e:
+                f.write(f'  Invalid "{name}": {e}\n')
+                continue
+            if valid is None:
+                f.write(f'  Skipped "{name}": Not a street.\n')
+                continue
+
+            if not was_valid:
+                f.write(f'Corrected "{name}" to "{valid}".\n')
+
+
+class PostcodeSuburbCounter:
+    """
+    Counts the combinations of postcode (addr:postcode) and suburb (addr:suburb) of all elements having both.
+    The report serves as the lookup table of the postcode/suburb audit.
+    """
+    name = 'postcode_suburbs'
+
+    def __init__(self, parents: Optional[Iterable[str]] = None):
+        """
+        Initializes the counter.
+        :param parents: Unused; see TagPathCounter.
+        """
+        self.counts = Counter()
+        self._postcode = None  # type: Optional[str]
+        self._suburb = None  # type: Optional[str]
+
+    def start(self, name: str, attrs: Dict[str, str]):
+        if name == 'tag':
+            key = attrs.get('k')
+            if key == 'addr:postcode':
+                self._postcode = attrs['v']
+            elif key == 'addr:suburb':
+                self._suburb = attrs['v']
+
+    def end(self, name: str):
+        if name != 'node' and name != 'way' and name != 'relation':
+            return
+        if self._postcode is not None and self._suburb is not None:
+            self.counts[(self._postcode, self._suburb)] += 1
+        self._postcode = self._suburb = None
+
+    def write_report(self, f: TextIO):
+        f.write('Postcode suburb counts:\n')
+        for (postcode, suburb), count in sorted(self.counts.items()):
+            f.write(f'{count:10d} {postcode}\t{suburb}\n')
+
+
+ANALYZERS = {
+    'tag-paths': TagPathCounter,
+    'tag-keys': TagKeyCounter,
+    'street-names': StreetNameCollector,
+    'street-audit': StreetNameAuditor,
+    'postcode-suburbs': PostcodeSuburbCounter,
+}
@@ -1 +1,4 @@
-from .parsing import open_and_parse, FileTypeException
+from .parsing import open_and_parse, parse_input, init_progress, load_schema, FileTypeException
+from .compression import InputFile, detect_codec
+from .scanning import scan, scan_elements, Select
+from .elements import open_elements, parse_elements, OsmElement, Node, Way, Relation, Member, ELEMENT_TYPES
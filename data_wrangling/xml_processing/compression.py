@@ -0,0 +1,213 @@
+import io
+import re
+import bz2
+import gzip
+import lzma
+import mmap
+from collections import deque
+from typing import Optional, Any, Dict
+
+from .parallel_bz2 import ParallelBZ2Reader
+
+CODEC_BZ2 = 'bz2'
+CODEC_GZIP = 'gzip'
+CODEC_XZ = 'xz'
+CODEC_ZSTD = 'zstd'
+
+_MAGIC_BYTES = (
+    (b'BZh', CODEC_BZ2),
+    (b'\x1f\x8b', CODEC_GZIP),
+    (b'\xfd7zXZ\x00', CODEC_XZ),
+    (b'\x28\xb5\x2f\xfd', CODEC_ZSTD),
+)
+_MAGIC_LENGTH = max(len(magic) for magic, _ in _MAGIC_BYTES)
+
+# The start of a top-level OSM element.
+ELEMENT_START = re.compile(rb'<(node|way|relation)[\s/>]')
+# Parsing a resumed file starts with a synthetic root element.
+_RESUME_PREFIX = b'<osm version="0.6">'
+_READ_SIZE = 1024 * 1024
+
+
+def detect_codec(header: bytes) -> Optional[str]:
+    """
+    Determines the compression format of a file from its first bytes.
+    :param header: The first bytes of the file.
+    :return: The name of the codec or None if the data does not appear to be compressed.
+    """
+    for magic, codec in _MAGIC_BYTES:
+        if header.startswith(magic):
+            return codec
+    return None
+
+
+class FileTypeException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class InputFile:
+    """
+    A read-only file object returning the decompressed contents of a possibly compressed file.
+    The codec is detected from the magic bytes of the file; uncompressed files are memory-mapped.
+    """
+    def __init__(self, filename: str, workers: Optional[int] = None,
+                 resume_from: Optional[Dict[str, Any]] = None):
+        """
+        Opens a file for reading.
+        :param filename: The file to open.
+        :param workers: The number of processes used to decompress bzip2 files;
+                        if None or 1, decompression happens in the calling process.
+        :param resume_from: A position previously obtained from resume_point(). If specified, reading
+                            starts at the first top-level OSM element after that position, preceded
+                            by a synthetic osm root element.
+        """
+        assert isinstance(filename, str) and filename is not None, "The specified file name was not a valid string."
+        self._raw = open(filename, mode='rb')
+        self._position = 0  # the offset in the decompressed data
+        self._read_starts = deque([0], maxlen=2)  # the offsets at which the two most recent reads started
+        self._pending = b''  # data to return before reading from the stream again
+        self._synthetic = 0  # the number of leading bytes of the pending data not contained in the file
+        try:
+            self._codec = detect_codec(self._raw.read(_MAGIC_LENGTH))
+            self._raw.seek(0)
+            self._stream = self._open_stream(filename, workers, resume_from)
+            if resume_from is not None:
+                self._resume(resume_from['uncompressed_offset'])
+        except BaseException:
+            self._raw.close()
+            raise
+
+    def _open_stream(self, filename: str, workers: Optional[int], resume_from: Optional[Dict[str, Any]]) -> Any:
+        if self._codec == CODEC_BZ2:
+            if workers is not None and workers > 1:
+                start_block = resume_from.get('bz2_block') if resume_from is not None else None
+                return ParallelBZ2Reader(filename, workers=workers,
+                                         start_block=tuple(start_block) if start_block is not None else None)
+            return bz2.open(self._raw, mode='rb')
+        elif self._codec == CODEC_GZIP:
+            return gzip.open(self._raw, mode='rb')
+        elif self._codec == CODEC_XZ:
+            return lzma.open(self._raw, mode='rb')
+        elif self._codec == CODEC_ZSTD:
+            return _open_zstd(self._raw)
+        if self._raw.seek(0, io.SEEK_END) == 0:
+            # Empty files cannot be memory-mapped.
+            self._raw.seek(0)
+            return self._raw
+        return mmap.mmap(self._raw.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _resume(self, offset: int):
+        if isinstance(self._stream, mmap.mmap):
+            self._stream.seek(offset)
+            self._position = offset
+        else:
+            # Compressed streams cannot seek, so everything up to the offset is
+            # decompressed and discarded (unless the stream started at a later block).
+            self._position = self._stream.tell()
+            while self._position < offset:
+                data = self._stream.read(min(_READ_SIZE, offset - self._position))
+                if len(data) == 0:
+                    break
+                self._position += len(data)
+
+        buffer = b''
+        while True:
+            data = self._stream.read(_READ_SIZE)
+            buffer += data
+            match = ELEMENT_START.search(buffer)
+            if match is not None:
+                self._position += match.start()
+                self._pending = _RESUME_PREFIX + buffer[match.start():]
+                break
+            if len(data) == 0:
+                self._position += len(buffer)
+                self._pending = _RESUME_PREFIX + b'</osm>'
+                break
+            # Keep enough data to match an element start spanning two reads.
+            keep = min(len(buffer), 16)
+            self._position += len(buffer) - keep
+            buffer = buffer[len(buffer) - keep:]
+        self._synthetic = len(_RESUME_PREFIX)
+        self._read_starts = deque([self._position], maxlen=2)
+
+    @property
+    def codec(self) -> Optional[str]:
+        """
+        The detected codec or None if the file is not compressed.
+        """
+        return self._codec
+
+    def read(self, size: int = -1) -> bytes:
+        self._read_starts.append(self._position)
+        if len(self._pending) == 0:
+            data = self._stream.read(size)
+            self._position += len(data)
+            return data
+        if size < 0 or size >= len(self._pending):
+            data, self._pending = self._pending, b''
+        else:
+            data, self._pending = self._pending[:size], self._pending[size:]
+        synthetic = min(self._synthetic, len(data))
+        self._synthetic -= synthetic
+        self._position += len(data) - synthetic
+        return data
+
+    def tell(self) -> int:
+        """
+        Returns the offset in the decompressed data up to which data was read.
+        """
+        return self._position
+
+    def compressed_tell(self) -> int:
+        """
+        Returns the offset in the (compressed) file up to which data was read.
+        """
+        if isinstance(self._stream, ParallelBZ2Reader):
+            return self._stream.compressed_tell()
+        elif self._codec is None:
+            return self._stream.tell()
+        return self._raw.tell()
+
+    def resume_point(self) -> Dict[str, Any]:
+        """
+        Gets a position from which reading can be resumed without missing any element
+        that was (even partially) contained in data returned by the two most recent reads.
+        Since parsers may hold back the end of the data they were given, an element that
+        was not reported yet always starts after this position.
+        :return: The position, see the resume_from parameter of the constructor.
+        """
+        offset = self._read_starts[0]
+        point = {
+            'uncompressed_offset': offset,
+            'compressed_offset': self.compressed_tell()
+        }
+        if isinstance(self._stream, ParallelBZ2Reader):
+            origin = self._stream.block_origin(offset)
+            if origin is not None:
+                point['bz2_block'] = list(origin)
+        return point
+
+    def close(self):
+        if self._stream is not self._raw:
+            self._stream.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _open_zstd(raw: Any) -> Any:
+    try:
+        import zstandard
+    except ImportError:
+        raise FileTypeException('Reading zstd compressed files requires the zstandard package.')
+    decompressor = zstandard.ZstdDecompressor()
+    try:
+        return decompressor.stream_reader(raw, read_across_frames=True)
+    except TypeError:
+        # Older versions of zstandard do not support multiple frames.
+        return decompressor.stream_reader(raw)
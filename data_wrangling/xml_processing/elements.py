@@ -0,0 +1,163 @@
+"""
+A typed stream of OSM elements with bounded memory.
+
+Unlike the events of open_and_parse, the elements are only reported once they are complete,
+i.e. at their end event, as lightweight Node, Way and Relation objects. The lxml subtree of each
+element, and any preceding siblings such as the bounds element, are freed right after, so that the
+parsed tree never holds more than the element being parsed and memory use stays flat regardless of
+the size of the file.
+"""
+
+import os
+from typing import Dict, List, Tuple, Iterable, Iterator, Optional
+
+from lxml.etree import iterparse, XMLSyntaxError
+from tqdm import tqdm
+
+from .compression import InputFile, FileTypeException
+from .parsing import init_progress, PROGRESS_INTERVAL
+
+ELEMENT_TYPES = ('node', 'way', 'relation')
+
+# The type, referenced ID and role of a relation member.
+Member = Tuple[str, int, str]
+
+
+class OsmElement:
+    """
+    The attributes and tags common to all element types. Missing user names and IDs are '' and -1.
+    The timestamp is kept as the string of the file, e.g. '2015-11-15T09:51:47Z'.
+    """
+    __slots__ = ('id', 'version', 'timestamp', 'user', 'uid', 'tags')
+    type = None  # type: str
+
+    def __init__(self, id: int, version: int, timestamp: str, user: str, uid: int, tags: Dict[str, str]):
+        self.id = id
+        self.version = version
+        self.timestamp = timestamp
+        self.user = user
+        self.uid = uid
+        self.tags = tags
+
+    def __repr__(self):
+        return f'{type(self).__name__}(id={self.id}, tags={self.tags})'
+
+
+class Node(OsmElement):
+    __slots__ = ('lat', 'lon')
+    type = 'node'
+
+    def __init__(self, id: int, version: int, timestamp: str, user: str, uid: int, tags: Dict[str, str],
+                 lat: float, lon: float):
+        super().__init__(id, version, timestamp, user, uid, tags)
+        self.lat = lat
+        self.lon = lon
+
+
+class Way(OsmElement):
+    __slots__ = ('nodes',)
+    type = 'way'
+
+    def __init__(self, id: int, version: int, timestamp: str, user: str, uid: int, tags: Dict[str, str],
+                 nodes: List[int]):
+        super().__init__(id, version, timestamp, user, uid, tags)
+        self.nodes = nodes
+
+
+class Relation(OsmElement):
+    __slots__ = ('members',)
+    type = 'relation'
+
+    def __init__(self, id: int, version: int, timestamp: str, user: str, uid: int, tags: Dict[str, str],
+                 members: List[Member]):
+        super().__init__(id, version, timestamp, user, uid, tags)
+        self.members = members
+
+
+def open_elements(filename: str, types: Iterable[str] = ELEMENT_TYPES,
+                  progress: Optional[tqdm] = None, decompress_workers: Optional[int] = None,
+                  osm_version: Optional[str] = None) -> Iterator[OsmElement]:
+    """
+    Streams the elements of a (possibly compressed) OSM XML file.
+    :param filename: The file to parse; bzip2, gzip, xz, zstd and uncompressed files are supported.
+    :param types: The element types to report.
+    :param progress: An optional progress bar that is updated with the number of (compressed) bytes read.
+    :param decompress_workers: The number of processes used to decompress bzip2 files.
+    :param osm_version: If specified, the root element must be an 'osm' element of this version.
+    :return: The elements in the order of the file.
+    """
+    assert os.path.exists(filename), 'The specified file does not exist.'
+    if progress is not None:
+        init_progress(progress, filename)
+    with InputFile(filename, workers=decompress_workers) as f:
+        yield from parse_elements(f, types, progress, osm_version)
+
+
+def parse_elements(f: InputFile, types: Iterable[str] = ELEMENT_TYPES,
+                   progress: Optional[tqdm] = None, osm_version: Optional[str] = None) -> Iterator[OsmElement]:
+    """
+    Streams the elements of an opened input file; see open_elements.
+    :param f: The input file.
+    :param types: The element types to report.
+    :param progress: An optional progress bar that is expected to be initialized already.
+    :param osm_version: If specified, the root element must be an 'osm' element of this version.
+    :return: The elements in the order of the file.
+    """
+    wanted = frozenset(types)
+    # Only the end events of the elements are reported; their children are parsed but not reported.
+    parser = iterparse(f, events=('end',), tag=ELEMENT_TYPES)
+    checked = osm_version is None
+    until_update = 0
+    try:
+        for _, el in parser:
+            if not checked:
+                root = el.getparent()
+                assert root is not None and root.tag == 'osm'
+                assert root.attrib.get('version') == osm_version, 'Unknown version of the OSM format.'
+                checked = True
+            if progress is not None:
+                until_update -= 1
+                if until_update <= 0:
+                    until_update = PROGRESS_INTERVAL
+                    progress.update(f.compressed_tell() - progress.n)
+            element = _convert(el) if el.tag in wanted else None
+            # Free the subtree and all preceding siblings, which also removes elements of other types.
+            el.clear(keep_tail=True)
+            parent = el.getparent()
+            if parent is not None:
+                while el.getprevious() is not None:
+                    del parent[0]
+            if element is not None:
+                yield element
+    except XMLSyntaxError:
+        raise FileTypeException('The specified file does not appear to be a valid XML file.')
+    if progress is not None:
+        progress.update(f.compressed_tell() - progress.n)
+
+
+def _convert(el) -> OsmElement:
+    attrib = el.attrib
+    id, version, timestamp = int(attrib['id']), int(attrib.get('version', 0)), attrib.get('timestamp', '')
+    user, uid = attrib.get('user', ''), int(attrib.get('uid', -1))
+    tags = {}
+    if el.tag == 'node':
+        for child in el:
+            if child.tag == 'tag':
+                tags[child.attrib['k']] = child.attrib['v']
+        return Node(id, version, timestamp, user, uid, tags, float(attrib['lat']), float(attrib['lon']))
+    elif el.tag == 'way':
+        nodes = []
+        for child in el:
+            if child.tag == 'nd':
+                nodes.append(int(child.attrib['ref']))
+            elif child.tag == 'tag':
+                tags[child.attrib['k']] = child.attrib['v']
+        return Way(id, version, timestamp, user, uid, tags, nodes)
+    members = []
+    for child in el:
+        if child.tag == 'member':
+            child_attrib = child.attrib
+            members.append((child_attrib['type'], int(child_attrib['ref']), child_attrib['role']))
+        elif child.tag == 'tag':
+            tags[child.attrib['k']] = child.attrib['v']
+    return Relation(id, version, timestamp, user, uid, tags, members)
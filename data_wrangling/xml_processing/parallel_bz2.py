@@ -0,0 +1,250 @@
+"""
+A bzip2 reader that decompresses the blocks of a stream on a process pool.
+
+A bzip2 stream consists of independently compressed blocks, each of which
+starts with a 48 bit magic number. The blocks are not byte-aligned, so they are
+located by searching the compressed data at all eight bit offsets. Every block is then
+re-wrapped into a standalone single-block stream that the regular bz2 module can decode.
+"""
+
+import io
+import bz2
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Iterator, Tuple, Optional, Deque
+
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+_BLOCK_MAGIC_BYTES = BLOCK_MAGIC.to_bytes(6, 'big')
+_EOS_MAGIC_BYTES = EOS_MAGIC.to_bytes(6, 'big')
+
+# A bit pattern of 48 bits spans at most seven bytes.
+_OVERLAP = 7
+_SCAN_CHUNK_SIZE = 8 * 1024 * 1024
+# The number of recently read blocks for which block_origin() can answer.
+_BLOCK_HISTORY = 16
+
+
+def find_block_boundaries(fp, chunk_size: int = _SCAN_CHUNK_SIZE,
+                          peek_fp=None, start_bit: int = 0) -> Iterator[Tuple[int, int]]:
+    """
+    Finds the bit offsets of all blocks in a bzip2 file.
+    :param fp: The binary file to scan.
+    :param chunk_size: The number of bytes to scan at once.
+    :param peek_fp: An optional second handle of the same file; if specified, it is used
+                    to verify that end-of-stream markers are followed by a new stream or the end
+                    of the file, which rules out markers that appear by chance in compressed data.
+    :param start_bit: The bit offset of the first block to report.
+    :return: An iterator of (start bit, end bit) tuples, one for each block.
+    """
+    block_start = None
+    for position, is_block in _find_markers(fp, chunk_size, start_bit):
+        if not is_block and peek_fp is not None and not _is_stream_end(peek_fp, position):
+            continue
+        if block_start is not None:
+            yield block_start, position
+        block_start = position if is_block else None
+    if block_start is not None:
+        # A truncated stream; the last block ends with the file.
+        yield block_start, fp.seek(0, io.SEEK_END) * 8
+
+
+def _is_stream_end(fp, position: int) -> bool:
+    # The end-of-stream magic is followed by the 32 bit stream CRC and padding
+    # to the next byte boundary, after which either the file ends or another stream starts.
+    fp.seek((position + 80 + 7) // 8)
+    following = fp.read(3)
+    return len(following) == 0 or following == b'BZh'
+
+
+def _find_markers(fp, chunk_size: int, start_bit: int = 0) -> Iterator[Tuple[int, bool]]:
+    """
+    Finds the bit offsets of all block and end-of-stream markers.
+    :param fp: The binary file to scan.
+    :param chunk_size: The number of bytes to scan at once.
+    :param start_bit: The bit offset at which to start.
+    :return: An iterator of (bit offset, is block marker) tuples in file order.
+    """
+    base = start_bit // 8  # the byte offset of the buffer
+    fp.seek(base)
+    buffer = b''
+    last = start_bit - 1
+    while True:
+        data = fp.read(chunk_size)
+        buffer += data
+        is_last = len(data) == 0
+        markers = []
+        value = int.from_bytes(buffer, 'big')
+        for shift in range(8):
+            # After shifting, the bit at offset p in the buffer is byte-aligned
+            # in the shifted data exactly if p % 8 == shift.
+            shifted = (value << shift).to_bytes(len(buffer) + 1, 'big')
+            for pattern, is_block in ((_BLOCK_MAGIC_BYTES, True), (_EOS_MAGIC_BYTES, False)):
+                index = shifted.find(pattern)
+                while index >= 0:
+                    position = 8 * index - 8 + shift
+                    if position >= 0:
+                        markers.append((base * 8 + position, is_block))
+                    index = shifted.find(pattern, index + 1)
+        for position, is_block in sorted(markers):
+            if position > last:
+                last = position
+                yield position, is_block
+        if is_last:
+            return
+        keep = min(_OVERLAP, len(buffer))
+        base += len(buffer) - keep
+        buffer = buffer[len(buffer) - keep:]
+
+
+def decompress_block(payload: bytes, start_bit: int, end_bit: int) -> bytes:
+    """
+    Decompresses a single bzip2 block.
+    :param payload: The compressed bytes containing the block.
+    :param start_bit: The bit offset of the block magic within the payload.
+    :param end_bit: The bit offset of the end of the block within the payload.
+    :return: The decompressed data.
+    """
+    length = end_bit - start_bit
+    value = int.from_bytes(payload, 'big')
+    block = (value >> (len(payload) * 8 - end_bit)) & ((1 << length) - 1)
+    # The block CRC directly follows the block magic; for a stream consisting
+    # of a single block, the combined stream CRC equals the block CRC.
+    crc = (block >> (length - 80)) & 0xFFFFFFFF
+    stream = (((block << 48) | EOS_MAGIC) << 32) | crc
+    bits = length + 80
+    padding = -bits % 8
+    stream <<= padding
+    return bz2.decompress(b'BZh9' + stream.to_bytes((bits + padding) // 8, 'big'))
+
+
+class ParallelBZ2Reader(io.RawIOBase):
+    """
+    A read-only file object decompressing a bzip2 file on a process pool
+    while returning the decompressed data in order.
+    """
+    def __init__(self, filename: str, workers: Optional[int] = None, prefetch: Optional[int] = None,
+                 start_block: Optional[Tuple[int, int]] = None):
+        """
+        Opens a bzip2 file for parallel decompression.
+        :param filename: The file to open.
+        :param workers: The number of worker processes; defaults to the number of CPUs.
+        :param prefetch: The maximum number of blocks being decompressed ahead of the reader;
+                         this bounds the memory use. Defaults to twice the number of workers.
+        :param start_block: If specified, reading starts at a block other than the first one;
+                            the block is given as a tuple of its bit offset and the offset of its
+                            decompressed data as previously returned by block_origin().
+        """
+        super().__init__()
+        workers = workers if workers is not None else os.cpu_count()
+        start_bit, position = start_block if start_block is not None else (0, 0)
+        self._scan_fp = open(filename, mode='rb')
+        self._data_fp = open(filename, mode='rb')
+        self._blocks = find_block_boundaries(self._scan_fp, peek_fp=self._data_fp, start_bit=start_bit)
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._prefetch = prefetch if prefetch is not None else 2 * workers
+        self._pending = deque()  # type: Deque[Tuple[Future, int, int]]
+        self._history = deque(maxlen=_BLOCK_HISTORY)  # type: Deque[Tuple[int, int]]
+        self._buffer = b''
+        self._offset = 0
+        self._position = position
+        self._compressed_position = start_bit // 8
+        self._exhausted = False
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        """
+        Returns the number of decompressed bytes that were read.
+        """
+        return self._position
+
+    def compressed_tell(self) -> int:
+        """
+        Returns the offset in the compressed file up to which data was decompressed and read.
+        """
+        return self._compressed_position
+
+    def block_origin(self, position: int) -> Optional[Tuple[int, int]]:
+        """
+        Finds a recently read block containing a decompressed offset.
+        :param position: The offset in the decompressed data.
+        :return: A tuple of the bit offset of the block and the offset of its decompressed data,
+                 or None if the block is no longer known.
+        """
+        for start_bit, block_position in reversed(self._history):
+            if block_position <= position:
+                return start_bit, block_position
+        return None
+
+    def readinto(self, b) -> int:
+        while self._offset >= len(self._buffer):
+            if not self._next_block():
+                return 0
+        n = min(len(b), len(self._buffer) - self._offset)
+        b[:n] = self._buffer[self._offset:self._offset + n]
+        self._offset += n
+        self._position += n
+        return n
+
+    def _payload(self, start_bit: int, end_bit: int) -> Tuple[bytes, int, int]:
+        first = start_bit // 8
+        self._data_fp.seek(first)
+        payload = self._data_fp.read((end_bit + 7) // 8 - first)
+        return payload, start_bit - first * 8, end_bit - first * 8
+
+    def _fill(self):
+        while not self._exhausted and len(self._pending) < self._prefetch:
+            try:
+                start_bit, end_bit = next(self._blocks)
+            except StopIteration:
+                self._exhausted = True
+                break
+            future = self._executor.submit(decompress_block, *self._payload(start_bit, end_bit))
+            self._pending.append((future, start_bit, end_bit))
+
+    def _next_block(self) -> bool:
+        self._fill()
+        if len(self._pending) == 0:
+            return False
+        future, start_bit, end_bit = self._pending.popleft()
+        try:
+            data = future.result()
+        except (OSError, ValueError):
+            data, end_bit = self._merge_with_successors(start_bit)
+        self._history.append((start_bit, self._position))
+        self._buffer = data
+        self._offset = 0
+        self._compressed_position = (end_bit + 7) // 8
+        self._fill()
+        return True
+
+    def _merge_with_successors(self, start_bit: int) -> Tuple[bytes, int]:
+        """
+        Handles a block that could not be decompressed on its own. This happens when the
+        block magic appeared by chance within the compressed data and split a block in two;
+        the fragments are merged until they form a valid block again.
+        """
+        while True:
+            self._fill()
+            if len(self._pending) == 0:
+                raise OSError('Invalid data stream')
+            future, _, end_bit = self._pending.popleft()
+            future.cancel()
+            try:
+                return decompress_block(*self._payload(start_bit, end_bit)), end_bit
+            except (OSError, ValueError):
+                continue
+
+    def close(self):
+        if self.closed:
+            return
+        for future, _, _ in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
+        self._scan_fp.close()
+        self._data_fp.close()
+        super().close()
@@ -1,69 +1,114 @@
 import os
-import bz2
+from functools import lru_cache
+from itertools import chain
 
 import lxml.etree as etree
-from lxml.etree import iterparse, Element, ParseError
+from lxml.etree import iterparse, Element, XMLSyntaxError
 
-from typing import Any, Union, Iterable, Tuple, Optional
+from typing import Union, Iterable, Tuple, Optional
 
 from tqdm import tqdm
 
+from .compression import InputFile, FileTypeException
+
+# The number of parser events between two updates of a progress bar.
+PROGRESS_INTERVAL = 4096
+
 
 def open_and_parse(filename: str, events: Union[str, Iterable[str]],
                    progress: Optional[tqdm],
-                   schema_filename: Optional[str] = None) -> Iterable[Tuple[str, Element]]:
+                   schema_filename: Optional[str] = None,
+                   decompress_workers: Optional[int] = None,
+                   validate: bool = False) -> Iterable[Tuple[str, Element]]:
+    """
+    Parses a (possibly compressed) OSM XML file.
+    :param filename: The file to parse; bzip2, gzip, xz, zstd and uncompressed files are supported.
+    :param events: The parser events to report.
+    :param progress: An optional progress bar that is updated with the number of (compressed) bytes read.
+    :param schema_filename: The XML schema to validate against; defaults to osm-extracts/osm.xsd.
+    :param decompress_workers: The number of processes used to decompress bzip2 files.
+    :param validate: Whether to validate the document against the XML schema.
+    :return: An iterable of parser events and their elements.
+    """
     if isinstance(events, str):
         events = (events,)
 
     assert os.path.exists(filename), 'The specified file does not exist.'
     if progress is not None:
-        progress.unit = 'B'
-        progress.unit_divisor = 1024
-        progress.unit_scale = True
-        progress.total = os.path.getsize(filename)
+        init_progress(progress, filename)
+
+    schema = None
+    if validate:
+        xsd_path = schema_filename if schema_filename is not None else os.path.join('osm-extracts', 'osm.xsd')
+        schema = load_schema(xsd_path)
+
+    with InputFile(filename, workers=decompress_workers) as f:
+        yield from parse_input(f, events, progress, schema)
+
+
+def parse_input(f: InputFile, events: Union[str, Iterable[str]],
+                progress: Optional[tqdm], schema: Optional[etree.XMLSchema] = None) -> Iterable[Tuple[str, Element]]:
+    """
+    Parses an opened input file; see open_and_parse.
+    :param f: The input file.
+    :param events: The parser events to report.
+    :param progress: An optional progress bar that is updated with the number of (compressed) bytes read
+                     every PROGRESS_INTERVAL events; it is expected to be initialized already.
+    :param schema: An optional XML schema to validate against.
+    :return: An iterable of parser events and their elements.
+    """
+    if isinstance(events, str):
+        events = (events,)
+
+    parser = iterparse(f, events=events, schema=schema)
+    try:
+        first = next(parser)
+    except StopIteration:
+        return
+    except XMLSyntaxError:
+        raise FileTypeException('The specified file does not appear to be an XML file.')
+
+    root = None
+    until_update = 0
+    for event, elem in chain((first,), parser):
+        if progress is not None:
+            until_update -= 1
+            if until_update <= 0:
+                until_update = PROGRESS_INTERVAL
+                progress.update(f.compressed_tell() - progress.n)
+        yield event, elem
+        # To save memory, we need to clear the element.
+        # See e.g.
+        # - https://www.ibm.com/developerworks/xml/library/x-hiperfparse/
+        # - https://stackoverflow.com/questions/7697710/python-running-out-of-memory-parsing-xml-using-celementtree-iterparse
+        root = elem if root is None else root
+        root.clear()
+    if progress is not None:
+        progress.update(f.compressed_tell() - progress.n)
+
 
-    xsd_path = schema_filename if schema_filename is not None else os.path.join('osm-extracts', 'osm.xsd')
+def init_progress(progress: tqdm, filename: str):
+    """
+    Sets up a progress bar for reporting the number of bytes read from a file.
+    :param progress: The progress bar.
+    :param filename: The file.
+    """
+    progress.unit = 'B'
+    progress.unit_divisor = 1024
+    progress.unit_scale = True
+    progress.total = os.path.getsize(filename)
+
+
+@lru_cache(maxsize=None)
+def _load_schema(xsd_path: str) -> etree.XMLSchema:
     xsd_doc = etree.parse(xsd_path)
-    schema = etree.XMLSchema(etree=xsd_doc)
-
-    def probe_gzip() -> bool:
-        try:
-            with _open_file(filename, open_gzip=True) as pf:
-                # An error is only thrown at the first attempt to read, so
-                # we simply
-                next(iterparse(pf, events=('start',), schema=schema))
-                return True  # it's a gzipped file
-        except OSError:
-            pass
-
-        try:
-            with _open_file(filename, open_gzip=False) as pf:
-                next(iterparse(pf, events=('start',)))
-                return False  # it's not a gzipped file
-        except ParseError:
-            raise FileTypeException('The specified file does not appear to be an XML file.')
-
-    open_gzip = probe_gzip()
-    with _open_file(filename, open_gzip=open_gzip) as f:
-        root = None
-        for event, elem in iterparse(f, events=events):
-            if progress is not None:
-                current = f.tell() if not open_gzip else f._fp.tell()
-                progress.update(current - progress.n)
-            yield event, elem
-            # To save memory, we need to clear the element.
-            # See e.g.
-            # - https://www.ibm.com/developerworks/xml/library/x-hiperfparse/
-            # - https://stackoverflow.com/questions/7697710/python-running-out-of-memory-parsing-xml-using-celementtree-iterparse
-            root = elem if root is None else root
-            root.clear()
-
-
-def _open_file(filename: str, open_gzip: bool) -> Any:
-    assert isinstance(filename, str) and filename is not None, "The specified file name was not a valid string."
-    return bz2.open(filename, mode='rb') if open_gzip else open(filename, mode='rb')
-
-
-class FileTypeException(Exception):
-    def __init__(self, message):
-        super().__init__(message)
+    return etree.XMLSchema(etree=xsd_doc)
+
+
+def load_schema(xsd_path: str) -> etree.XMLSchema:
+    """
+    Loads an XML schema; compiled schemas are cached per process.
+    :param xsd_path: The path to the XSD file.
+    :return: The compiled schema.
+    """
+    return _load_schema(os.path.abspath(xsd_path))
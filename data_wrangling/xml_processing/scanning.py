@@ -0,0 +1,170 @@
+"""
+A lightweight alternative to open_and_parse based on the expat parser.
+
+Instead of building lxml Element trees for every XML element, the scanner calls
+back for each start and end tag with the element name and its attributes only.
+On top of that, scan_elements() reports just the attributes of the elements
+a caller asks for as plain tuples.
+"""
+
+import os
+from xml.parsers import expat
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple, List
+
+from tqdm import tqdm
+
+from .compression import InputFile, FileTypeException
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+StartHandler = Callable[[str, Dict[str, str]], None]
+EndHandler = Callable[[str], None]
+
+
+class Select:
+    """
+    Describes the elements and attributes to report from a scan.
+    """
+    def __init__(self, element: str, attributes: Iterable[str],
+                 parent: Optional[str] = None, where: Optional[Dict[str, str]] = None):
+        """
+        Initializes the selection.
+        :param element: The name of the elements to report, e.g. 'tag'.
+        :param attributes: The attributes to report for each element; missing attributes are reported as None.
+        :param parent: If specified, only elements directly below an element of this name are reported.
+        :param where: If specified, only elements whose attributes have the given values are reported.
+        """
+        self.element = element
+        self.attributes = tuple(attributes)
+        self.parent = parent
+        self.where = tuple(where.items()) if where is not None else ()
+
+
+def scan(filename: str, start: Optional[StartHandler] = None, end: Optional[EndHandler] = None,
+         progress: Optional[tqdm] = None, decompress_workers: Optional[int] = None,
+         osm_version: Optional[str] = None, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """
+    Scans a (possibly compressed) XML file, calling back for each start and end tag.
+    :param filename: The file to scan.
+    :param start: Called with the element name and its attributes for each start tag.
+    :param end: Called with the element name for each end tag.
+    :param progress: An optional progress bar that is updated with the number of (compressed) bytes read.
+    :param decompress_workers: The number of processes used to decompress bzip2 files.
+    :param osm_version: If specified, the root element must be an 'osm' element of this version.
+    :param chunk_size: The number of bytes to parse at once.
+    """
+    parser = _create_parser(start, end, osm_version)
+    for _ in _scan_chunks(filename, parser, progress, decompress_workers, chunk_size):
+        pass
+
+
+def _create_parser(start: Optional[StartHandler], end: Optional[EndHandler], osm_version: Optional[str]):
+    """
+    Creates an expat parser calling back to the given handlers, which may be replaced while scanning.
+    """
+    parser = expat.ParserCreate()
+    if osm_version is not None:
+        parser.StartElementHandler = _check_root(parser, osm_version, start)
+    elif start is not None:
+        parser.StartElementHandler = start
+    if end is not None:
+        parser.EndElementHandler = end
+    return parser
+
+
+def _scan_chunks(filename: str, parser, progress: Optional[tqdm], decompress_workers: Optional[int],
+                 chunk_size: int) -> Iterator[None]:
+    """
+    Scans a file like scan() with the given parser, yielding after each parsed chunk.
+    """
+    assert os.path.exists(filename), 'The specified file does not exist.'
+    if progress is not None:
+        progress.unit = 'B'
+        progress.unit_divisor = 1024
+        progress.unit_scale = True
+        progress.total = os.path.getsize(filename)
+
+    with InputFile(filename, workers=decompress_workers) as f:
+        first = True
+        while True:
+            data = f.read(chunk_size)
+            try:
+                parser.Parse(data, len(data) == 0)
+            except expat.ExpatError:
+                if first:
+                    raise FileTypeException('The specified file does not appear to be an XML file.')
+                raise
+            first = False
+            if progress is not None:
+                current = f.compressed_tell()
+                progress.update(current - progress.n)
+            yield
+            if len(data) == 0:
+                break
+
+
+def _check_root(parser, osm_version: str, start: Optional[StartHandler]) -> StartHandler:
+    def check(name: str, attrs: Dict[str, str]):
+        assert name == 'osm'
+        assert 'version' in attrs and attrs['version'] == osm_version, 'Unknown version of the OSM format.'
+        # Only the root element needs to be checked.
+        parser.StartElementHandler = start
+        if start is not None:
+            start(name, attrs)
+    return check
+
+
+def scan_elements(filename: str, select: Select,
+                  progress: Optional[tqdm] = None, decompress_workers: Optional[int] = None,
+                  osm_version: Optional[str] = None,
+                  chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Tuple[Optional[str], ...]]:
+    """
+    Scans a (possibly compressed) XML file and reports the selected attributes of the selected elements.
+    :param filename: The file to scan.
+    :param select: The elements and attributes to report.
+    :param progress: An optional progress bar that is updated with the number of (compressed) bytes read.
+    :param decompress_workers: The number of processes used to decompress bzip2 files.
+    :param osm_version: If specified, the root element must be an 'osm' element of this version.
+    :param chunk_size: The number of bytes to parse at once.
+    :return: An iterator of tuples containing the selected attribute values.
+    """
+    results = []  # type: List[Tuple[Optional[str], ...]]
+    element, attributes, parent, where = select.element, select.attributes, select.parent, select.where
+
+    # Expat calls back for every element, so the handlers do as little as possible for the others.
+    def report(name: str, attrs: Dict[str, str]):
+        if name == element:
+            results.append(tuple(map(attrs.get, attributes)))
+
+    def report_where(name: str, attrs: Dict[str, str]):
+        if name == element:
+            for key, value in where:
+                if attrs.get(key) != value:
+                    return
+            results.append(tuple(map(attrs.get, attributes)))
+
+    if len(where) > 0:
+        report = report_where
+
+    # If the parent element matters, the element stack is only tracked within parent elements,
+    # so that the end tags of all other elements are not reported at all.
+    stack = []  # type: List[str]
+
+    def report_below_parent(name: str, attrs: Dict[str, str]):
+        if len(stack) > 0:
+            if name == element and stack[-1] == parent:
+                report(name, attrs)
+            stack.append(name)
+        elif name == parent:
+            stack.append(name)
+            parser.EndElementHandler = pop
+
+    def pop(_: str):
+        stack.pop()
+        if len(stack) == 0:
+            parser.EndElementHandler = None
+
+    parser = _create_parser(report if parent is None else report_below_parent, None, osm_version)
+    for _ in _scan_chunks(filename, parser, progress, decompress_workers, chunk_size):
+        yield from results
+        results.clear()
@@ -0,0 +1,108 @@
+"""
+Map-reduce style surveys over uncompressed OSM XML files.
+
+The file is split into byte ranges that start at top-level node, way or relation
+elements. Each range is scanned by a separate process and the partial counts are
+merged in file order, so that the result equals that of a serial scan.
+"""
+
+import mmap
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Callable, Iterable, Optional, Any
+from xml.parsers import expat
+
+from tqdm import tqdm
+
+from .compression import InputFile, FileTypeException, ELEMENT_START
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Creates a survey handler given the names of the elements enclosing a shard.
+HandlerFactory = Callable[[Iterable[str]], Any]
+
+
+def find_shards(filename: str, count: int) -> List[Tuple[int, int]]:
+    """
+    Splits an uncompressed OSM XML file into byte ranges.
+    :param filename: The file to split.
+    :param count: The desired number of ranges.
+    :return: A list of (begin, end) byte offsets; all but the first range start at a top-level element.
+    """
+    size = os.path.getsize(filename)
+    if size == 0:
+        return [(0, 0)]
+    with open(filename, mode='rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        boundaries = [0]
+        for i in range(1, count):
+            match = ELEMENT_START.search(data, max(size * i // count, boundaries[-1] + 1))
+            if match is None:
+                break
+            boundaries.append(match.start())
+    boundaries = sorted(set(boundaries)) + [size]
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def scan_shard(filename: str, begin: int, end: int, handler_factory: HandlerFactory,
+               chunk_size: int = DEFAULT_CHUNK_SIZE) -> Counter:
+    """
+    Scans a byte range of an uncompressed OSM XML file.
+    :param filename: The file to scan.
+    :param begin: The offset of the first byte; unless zero, this must be the start of a top-level element.
+    :param end: The offset after the last byte.
+    :param handler_factory: Creates the survey handler, see e.g. TagPathCounter.
+    :param chunk_size: The number of bytes to parse at once.
+    :return: The counts of the handler.
+    """
+    parser = expat.ParserCreate()
+    if begin > 0:
+        # The range lacks the document's root element, so a synthetic one is
+        # parsed before the handlers are attached.
+        parser.Parse(b'<osm>', False)
+    handler = handler_factory([] if begin == 0 else ['osm'])
+    parser.StartElementHandler = handler.start
+    if handler.end is not None:
+        parser.EndElementHandler = handler.end
+
+    size = os.path.getsize(filename)
+    with open(filename, mode='rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for offset in range(begin, end, chunk_size):
+            parser.Parse(data[offset:min(offset + chunk_size, end)], False)
+    if end == size:
+        parser.Parse(b'', True)
+    return handler.counts
+
+
+def survey_sharded(filename: str, handler_factory: HandlerFactory, workers: Optional[int] = None,
+                   shards_per_worker: int = 4, progress: Optional[tqdm] = None) -> Counter:
+    """
+    Runs a survey over an uncompressed OSM XML file using multiple processes.
+    :param filename: The file to scan.
+    :param handler_factory: Creates the survey handlers; must be picklable, e.g. a class like TagPathCounter.
+    :param workers: The number of processes; defaults to the number of CPUs.
+    :param shards_per_worker: The number of byte ranges per process, which evens out the load.
+    :param progress: An optional progress bar that is updated with the number of bytes scanned.
+    :return: The merged counts.
+    """
+    with InputFile(filename) as f:
+        if f.codec is not None:
+            raise FileTypeException(f'Sharded scans require an uncompressed file, but got {f.codec} data.')
+
+    workers = workers if workers is not None else os.cpu_count()
+    shards = find_shards(filename, workers * shards_per_worker)
+    if progress is not None:
+        progress.unit = 'B'
+        progress.unit_divisor = 1024
+        progress.unit_scale = True
+        progress.total = os.path.getsize(filename)
+
+    counts = Counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(scan_shard, filename, begin, end, handler_factory) for begin, end in shards]
+        # Merging in file order retains the order in which keys were first encountered.
+        for future, (begin, end) in zip(futures, shards):
+            counts.update(future.result())
+            if progress is not None:
+                progress.update(end - begin)
+    return counts
@@ -4,13 +4,22 @@ from collections import Counter
 from tqdm import tqdm
 from argparse import ArgumentParser
 
-from data_wrangling.xml_processing.parsing import open_and_parse
+from data_wrangling.xml_processing.elements import open_elements
+from data_wrangling.xml_processing.scanning import scan_elements, Select
+from data_wrangling.xml_processing.sharding import survey_sharded
+from data_wrangling.surveys import TagKeyCounter
 
 
 parser = ArgumentParser()
 parser.add_argument('file', nargs='?',
                     default=os.path.join('osm-extracts', 'berlin.osm.bz2'),
                     help='The OSM map file to scan.')
+parser.add_argument('--decompress-workers', type=int, default=os.cpu_count(),
+                    help='The number of processes used to decompress bzip2 files.')
+parser.add_argument('--backend', choices=('lxml', 'expat'), default='lxml',
+                    help='The parser to use; expat only reports element names and attributes and is faster.')
+parser.add_argument('--shard-workers', type=int, default=0,
+                    help='If positive, scans an uncompressed file in byte ranges using this many processes.')
 args = parser.parse_args()
 
 if not os.path.exists(args.file) or not os.path.isfile(args.file):
@@ -20,11 +29,16 @@ if not os.path.exists(args.file) or not os.path.isfile(args.file):
 cnt = Counter()
 progress = tqdm()
 
-for ev, el in open_and_parse(args.file, events=('start',), progress=progress):
-    if el.tag == 'osm':
-        assert 'version' in el.attrib and el.attrib['version'] == '0.6', 'Unknown version of the OSM format.'
-    tag_keys = [tag.attrib['k'] for tag in el.iter('tag')]
-    cnt.update(tag_keys)
+if args.shard_workers > 0:
+    cnt = survey_sharded(args.file, TagKeyCounter, workers=args.shard_workers, progress=progress)
+elif args.backend == 'expat':
+    cnt.update(key for key, in scan_elements(args.file, Select('tag', attributes=('k',)), progress=progress,
+                                             decompress_workers=args.decompress_workers, osm_version='0.6'))
+else:
+    # The elements are complete when they are reported, unlike at their start events.
+    for el in open_elements(args.file, progress=progress, decompress_workers=args.decompress_workers,
+                            osm_version='0.6'):
+        cnt.update(el.tags.keys())
 
 
 progress.close()
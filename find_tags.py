@@ -1,36 +1,49 @@
 import os
 
-from collections import Counter
 from tqdm import tqdm
 from argparse import ArgumentParser
 
 from data_wrangling.xml_processing.parsing import open_and_parse
+from data_wrangling.xml_processing.scanning import scan
+from data_wrangling.xml_processing.sharding import survey_sharded
+from data_wrangling.surveys import TagPathCounter
 
 
 parser = ArgumentParser()
 parser.add_argument('file', nargs='?',
                     default=os.path.join('osm-extracts', 'berlin.osm.bz2'),
                     help='The OSM map file to scan.')
+parser.add_argument('--decompress-workers', type=int, default=os.cpu_count(),
+                    help='The number of processes used to decompress bzip2 files.')
+parser.add_argument('--backend', choices=('lxml', 'expat'), default='lxml',
+                    help='The parser to use; expat only reports element names and attributes and is faster.')
+parser.add_argument('--shard-workers', type=int, default=0,
+                    help='If positive, scans an uncompressed file in byte ranges using this many processes.')
 args = parser.parse_args()
 
 if not os.path.exists(args.file) or not os.path.isfile(args.file):
     parser.error(f'The specified argument is not a valid file: {args.file}')
     exit(1)
 
-cnt = Counter()
 progress = tqdm()
-stack = []
-
-for ev, el in open_and_parse(args.file, events=('start', 'end'), progress=progress):
-    if ev == 'start':
-        if el.tag == 'osm':
-            assert 'version' in el.attrib and el.attrib['version'] == '0.6', 'Unknown version of the OSM format.'
-        stack.append(el.tag)
-        path = '.'.join(stack)
-        cnt[path] += 1
-    else:
-        stack.pop()
-        
+counter = TagPathCounter()
+
+if args.shard_workers > 0:
+    cnt = survey_sharded(args.file, TagPathCounter, workers=args.shard_workers, progress=progress)
+elif args.backend == 'expat':
+    scan(args.file, start=counter.start, end=counter.end, progress=progress,
+         decompress_workers=args.decompress_workers, osm_version='0.6')
+    cnt = counter.counts
+else:
+    for ev, el in open_and_parse(args.file, events=('start', 'end'), progress=progress,
+                                 decompress_workers=args.decompress_workers):
+        if ev == 'start':
+            if el.tag == 'osm':
+                assert 'version' in el.attrib and el.attrib['version'] == '0.6', 'Unknown version of the OSM format.'
+            counter.start(el.tag, el.attrib)
+        else:
+            counter.end(el.tag)
+    cnt = counter.counts
 
 progress.close()
 
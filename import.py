@@ -1,15 +1,26 @@
 import os
-from datetime import datetime
+import time
+import shutil
+import tempfile
+from typing import Optional, Dict, Any, Union
 
 from argparse import ArgumentParser
-from typing import Dict, Tuple
 
-import bson
 from tqdm import tqdm
-from xml.etree.cElementTree import Element
 import pymongo
-from data_wrangling.xml_processing import open_and_parse
-from data_wrangling.auditing import AuditStreetName
+from data_wrangling.xml_processing import InputFile, parse_input, init_progress
+from data_wrangling.auditing import address_audit, load_postcode_suburbs
+from data_wrangling.importing import BulkWriter, ImportPipeline, elem_to_doc, is_empty, create_indexes, index_models
+from data_wrangling.importing import create_geometry_index
+from data_wrangling.importing import DumpWriter
+from data_wrangling.importing import Checkpointer, FileCheckpointStore, MongoCheckpointStore, skip_committed, \
+    source_info
+from data_wrangling.importing import NodeLocationStore, LocationStoreException
+from data_wrangling.query_cache import bump_generation
+from data_wrangling.metrics import PipelineMetrics, TimedInput, PROFILERS, profiled
+from data_wrangling.importing import ImportStatistics, DEFAULT_VALUE_KEYS, AddressIndex
+from data_wrangling.importing import ensure_tag_tokens
+from data_wrangling.importing import RegionAssigner, load_region_assigner
 
 
 def validate_osm_version(events):
@@ -19,7 +30,7 @@ def validate_osm_version(events):
 
 
 auto_audit = [
-    AuditStreetName()
+    address_audit()
 ]
 
 
@@ -30,115 +41,391 @@ def main():
                         help='The OSM map file to scan.')
     parser.add_argument('--connection', default='mongodb://localhost:27017/dand',
                         help='The MongoDB connection string.')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='The number of documents to send per bulk write.')
+    parser.add_argument('--mode', choices=('auto', 'insert', 'upsert'), default='auto',
+                        help='Whether to insert or upsert documents; auto inserts into '
+                             'an empty collection and upserts otherwise.')
+    parser.add_argument('--decompress-workers', type=int, default=os.cpu_count(),
+                        help='The number of processes used to decompress bzip2 files.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='The number of processes auditing and converting elements; '
+                             '0 converts in the main process.')
+    parser.add_argument('--writers', type=int, default=1,
+                        help='The number of threads writing to MongoDB when using worker processes.')
+    parser.add_argument('--queue-size', type=int, default=None,
+                        help='The maximum number of element chunks queued between the pipeline stages.')
+    parser.add_argument('--audit-cache', default=None,
+                        help='A file to keep the street name audit results in between runs.')
+    parser.add_argument('--postcode-suburbs', default=None,
+                        help='The report of the postcode-suburbs survey; enables the postcode/suburb audit.')
+    parser.add_argument('--profile-audits', action='store_true',
+                        help='Measure the time spent in each audit rule.')
+    parser.add_argument('--no-geometry', action='store_true',
+                        help='Do not resolve the geometries of ways.')
+    parser.add_argument('--locations', default=None,
+                        help='The directory to keep the node locations in, which are used to resolve way '
+                             'geometries; defaults to a temporary directory that is removed after the import.')
+    parser.add_argument('--no-regions', action='store_true',
+                        help='Do not assign the district and Bezirksregion to nodes and ways.')
+    parser.add_argument('--stats-keys', default=','.join(DEFAULT_VALUE_KEYS),
+                        help='The comma-separated tag keys whose values are counted in the statistics collection.')
+    parser.add_argument('--no-stats', action='store_true',
+                        help='Do not maintain the statistics collection.')
+    parser.add_argument('--no-addresses', action='store_true',
+                        help='Do not maintain the address collection used for reverse geocoding.')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Measure the time spent in each stage and print a summary.')
+    parser.add_argument('--metrics-json', default=None,
+                        help='Write the stage metrics to this file as JSON; implies --metrics.')
+    parser.add_argument('--metrics-prometheus', default=None,
+                        help='Write the stage metrics to this file in the Prometheus text format; implies --metrics.')
+    parser.add_argument('--profile', choices=PROFILERS, default=None,
+                        help='Run the import under cProfile or a sampling profiler.')
+    parser.add_argument('--profile-out', default=None,
+                        help='The file to write the profile to; defaults to import.prof for cProfile '
+                             'and import.stacks (collapsed stacks) for the sampling profiler.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume an interrupted import of the same file from its last checkpoint.')
+    parser.add_argument('--checkpoint-file', default=None,
+                        help='Store checkpoints in this file instead of the osm_meta collection.')
+    parser.add_argument('--checkpoint-interval', type=int, default=100000,
+                        help='The number of documents between two checkpoints; 0 disables checkpoints.')
+    parser.add_argument('--dump', default=None,
+                        help='Write the documents to this directory in the layout of mongodump instead of '
+                             'importing them; load them with mongorestore and then run the script with --restored.')
+    parser.add_argument('--dump-split', action='store_true',
+                        help='Write the documents of each element type to a separate file of the dump.')
+    parser.add_argument('--restored', action='store_true',
+                        help='Rebuild the statistics and the address collection after restoring a dump, '
+                             'instead of importing the file.')
     args = parser.parse_args()
 
-    if not os.path.exists(args.file) or not os.path.isfile(args.file):
+    if not args.restored and (not os.path.exists(args.file) or not os.path.isfile(args.file)):
         parser.error(f'The specified argument is not a valid file: {args.file}')
         exit(1)
+    if args.batch_size < 1:
+        parser.error('The batch size must be positive.')
+        exit(1)
+    if args.workers < 0 or args.writers < 1:
+        parser.error('Invalid number of workers or writers.')
+        exit(1)
+    if args.checkpoint_interval < 0:
+        parser.error('The checkpoint interval must not be negative.')
+        exit(1)
+    if args.dump is not None and (args.resume or args.restored or args.mode == 'upsert'):
+        parser.error('A dump can neither be resumed nor upserted.')
+        exit(1)
+    if args.dump_split and args.dump is None:
+        parser.error('--dump-split requires --dump.')
+        exit(1)
+
+    if args.postcode_suburbs is not None and not os.path.isfile(args.postcode_suburbs):
+        parser.error(f'The specified postcode table is not a valid file: {args.postcode_suburbs}')
+        exit(1)
+
+    auto_audit[:] = [address_audit(cache_file=args.audit_cache,
+                                   postcode_suburbs=load_postcode_suburbs(args.postcode_suburbs)
+                                   if args.postcode_suburbs is not None else None,
+                                   profile=args.profile_audits)]
 
-    client = pymongo.MongoClient(args.connection)
+    client = pymongo.MongoClient(args.connection, maxPoolSize=max(100, args.writers))
     database = client.get_default_database()
     collection = database.get_collection('osm_berlin')
 
-    collection.create_index([('_id.type', pymongo.ASCENDING)], background=True, unique=False)
-    collection.create_index([('user.name', pymongo.ASCENDING)], background=True, unique=False)
-    collection.create_index([('user.id', pymongo.ASCENDING)], background=True, unique=False)
-    collection.create_index([('t', pymongo.ASCENDING)], background=True, unique=False)
-    collection.create_index([('tag_keys', pymongo.TEXT),
-                             ('tag_values', pymongo.TEXT)], background=True, unique=False)
-    collection.create_index([('loc', pymongo.GEOSPHERE)],
-                            background=True, unique=False,
-                            partialFilterExpression={'_id.type': 'node'})
+    if args.restored:
+        finish_restore(collection, args)
+        return
 
-    progress = tqdm()
+    # A dump is written without connecting to the server; its indexes are built by mongorestore.
+    dump = args.dump is not None
+    if not dump:
+        create_indexes(collection)
 
-    events = open_and_parse(args.file, events=('start',), progress=progress)
-    validate_osm_version(events)
+    checkpointer = None
+    checkpoint = None
+    if not dump and (args.checkpoint_interval > 0 or args.resume):
+        store = FileCheckpointStore(args.checkpoint_file) if args.checkpoint_file is not None \
+            else MongoCheckpointStore(database.get_collection('osm_meta'), 'checkpoint:osm_berlin')
+        checkpointer = Checkpointer(store, source_info(args.file), interval=args.checkpoint_interval)
+        if args.resume:
+            checkpoint = checkpointer.load()
+            if checkpoint is None:
+                print('No checkpoint found for this file; starting from the beginning.')
+            else:
+                print(f'Resuming after {checkpoint["type"]} {checkpoint["id"]} '
+                      f'({checkpoint["documents"]} documents imported).')
+        if args.checkpoint_interval == 0:
+            checkpointer = None
 
-    for ev, el in events:
-        assert el.tag != 'osm'
-        if el.tag != 'node' and el.tag != 'way' and el.tag != 'relation':
-            continue
+    locations = None
+    locations_directory = None
+    if not args.no_geometry:
+        if checkpoint is not None and args.locations is None:
+            parser.error('The node locations of the interrupted import are needed to resume it; '
+                         'pass the --locations directory it used, or --no-geometry.')
+            exit(1)
+        locations_directory = args.locations if args.locations is not None else tempfile.mkdtemp(prefix='osm-nodes-')
+        try:
+            locations = open_locations(locations_directory, checkpoint, source_info(args.file))
+        except LocationStoreException as e:
+            parser.error(f'The node locations of the interrupted import cannot be resumed: {e}')
+            exit(1)
+        if checkpointer is not None:
+            # A checkpoint within the nodes is only valid along with the nodes read up to it.
+            checkpointer.before_save(locations.save_partial)
 
-        for audit in auto_audit:
-            el = audit(el)
-            if el is not None:
-                continue
+    regions = load_regions() if not args.no_regions else None
+
+    # A resumed import always upserts, since the last batches may have been written partially.
+    empty = dump or is_empty(collection)
+    upsert = args.mode == 'upsert' or (args.mode == 'auto' and (checkpoint is not None or not empty))
+
+    if not dump:
+        tokenized = ensure_tag_tokens(collection, empty, batch_size=args.batch_size)
+        if tokenized > 0:
+            print(f'Added tag tokens to {tokenized} existing documents.')
+
+    statistics = None
+    if not args.no_stats and not dump:
+        statistics = ImportStatistics(collection, [key for key in args.stats_keys.split(',') if len(key) > 0])
+        statistics.begin(empty)
+        if statistics.rebuilt:
+            print('Rebuilt the statistics of the existing documents.')
+
+    addresses = None
+    if not args.no_addresses and not dump:
+        addresses = AddressIndex(collection, batch_size=args.batch_size)
+        addresses.begin(empty)
+        if addresses.rebuilt:
+            print('Rebuilt the addresses of the existing documents.')
 
-        id, doc = elem_to_doc(el)
+    # Cached query results are invalidated as soon as the data starts to change, and again once it is complete.
+    if not dump:
+        bump_generation(database, collection.name)
+
+    progress = tqdm()
+    init_progress(progress, args.file)
+    metrics = None
+    if args.metrics or args.metrics_json is not None or args.metrics_prometheus is not None:
+        metrics = PipelineMetrics(report=progress.set_postfix_str)
+    profile_out = args.profile_out if args.profile_out is not None \
+        else 'import.prof' if args.profile == 'cprofile' else 'import.stacks'
+    start = time.perf_counter()
+    if metrics is not None:
+        metrics.start()
+
+    with InputFile(args.file, workers=args.decompress_workers,
+                   resume_from=checkpoint['position'] if checkpoint is not None else None) as f, \
+            profiled(args.profile, profile_out):
+        source = TimedInput(f, metrics) if metrics is not None else f
+        dump_writer = DumpWriter(args.dump, database.name, collection.name, split=args.dump_split,
+                                 batch_size=args.batch_size, indexes=index_models(geometry=False),
+                                 prepare=regions if args.workers == 0 else None) if dump else None
+        if args.workers > 0:
+            writer = ImportPipeline(collection, auto_audit, workers=args.workers, writers=args.writers,
+                                    batch_size=args.batch_size, queue_size=args.queue_size,
+                                    upsert=upsert, locations=locations, prepare=regions,
+                                    statistics=statistics, addresses=addresses, metrics=metrics,
+                                    dump=dump_writer, log=tqdm.write)
+            events = parse_input(source, events=('start', 'end'), progress=progress)
+            validate_osm_version(events)
+            if checkpoint is not None:
+                events = skip_committed(events, checkpoint)
+            writer.run(events, position=f.resume_point,
+                       on_commit=checkpointer.committed if checkpointer is not None else None)
+        elif dump:
+            writer = dump_writer
+            import_sequential(source, writer, progress, locations=locations, metrics=metrics)
+        else:
+            writer = BulkWriter(collection, batch_size=args.batch_size, upsert=upsert,
+                                geo_fields=('geometry', 'bbox'), prepare=regions,
+                                statistics=statistics, addresses=addresses, log=tqdm.write)
+            import_sequential(source, writer, progress, checkpoint, checkpointer, locations, metrics)
+
+    finish_start = time.perf_counter()
+    if statistics is not None:
+        statistics.finish()
+    if addresses is not None:
+        addresses.finish()
+    if metrics is not None:
+        metrics.add('write', time.perf_counter() - finish_start, 0)
+        metrics.stop()
+    if not dump:
+        bump_generation(database, collection.name)
+    if checkpointer is not None:
+        checkpointer.finish()
+    if locations is not None:
+        locations.close()
+        if args.locations is None:
+            shutil.rmtree(locations_directory, ignore_errors=True)
+    for audit in auto_audit:
+        audit.save_cache()
 
-        find = {'_id': id}
-        update = {'$set': doc}
-        collection.update(find, update, upsert=True)
+    elapsed = time.perf_counter() - start
 
     progress.close()
     print('Audit summary:')
     for audit in auto_audit:
         print('- ' + str(audit))
+    print('Import summary:')
+    for w in (writer.writers if args.workers > 0 else [writer]):
+        print(f'- {w}')
+    print(f'- {writer.documents_written / max(elapsed, 1e-9):.0f} documents/s '
+          f'({elapsed:.1f} s total, {writer.write_time:.1f} s writing)')
+    if checkpointer is not None:
+        print(f'- {checkpointer.checkpoints} checkpoints saved')
+    if dump:
+        print_restore_commands(dump_writer, args)
+    if metrics is not None:
+        print('Stage metrics:')
+        print(metrics)
+        if args.metrics_json is not None:
+            metrics.write_json(args.metrics_json)
+        if args.metrics_prometheus is not None:
+            metrics.write_prometheus(args.metrics_prometheus)
+
+
+def finish_restore(collection: pymongo.collection.Collection, args):
+    """
+    Rebuilds the collections derived from a restored dump, which are not part of the dump.
+    """
+    if is_empty(collection):
+        print(f'The collection {collection.full_name} is empty; restore the dump first.')
+        exit(1)
+    # The geometries of a dump were never checked by the server, so their index is only built now.
+    dropped = create_geometry_index(collection, batch_size=args.batch_size)
+    if dropped > 0:
+        print(f'Removed the geometries of {dropped} ways, which could not be indexed.')
+    create_indexes(collection)
+    ensure_tag_tokens(collection, False, batch_size=args.batch_size)
+    # The statistics and addresses of an earlier import may still be marked as complete, so they are always rebuilt.
+    if not args.no_stats:
+        statistics = ImportStatistics(collection, [key for key in args.stats_keys.split(',') if len(key) > 0])
+        statistics.begin(True)
+        statistics.rebuild()
+        statistics.finish()
+        print('Rebuilt the statistics.')
+    if not args.no_addresses:
+        addresses = AddressIndex(collection, batch_size=args.batch_size)
+        addresses.begin(True)
+        addresses.rebuild()
+        addresses.finish()
+        print('Rebuilt the addresses.')
+    bump_generation(collection.database, collection.name)
+
+
+def print_restore_commands(writer: DumpWriter, args):
+    """
+    Prints how to load a dump.
+    """
+    print('Load the dump with')
+    workers = os.cpu_count() or 1
+    if not args.dump_split:
+        print(f'  mongorestore --uri {args.connection} --drop --numInsertionWorkersPerCollection {workers} '
+              f'--nsInclude {writer.namespace} {os.path.dirname(writer.directory)}')
+    else:
+        database, collection = writer.namespace.split('.', 1)
+        files = writer.files
+        for index, filename in enumerate(files):
+            # Only the first file may drop the collection, and the indexes are built after the last one.
+            print(f'  mongorestore --uri {args.connection} {"--drop " if index == 0 else ""}'
+                  f'{"--noIndexRestore " if index < len(files) - 1 else ""}'
+                  f'--numInsertionWorkersPerCollection {workers} --db {database} --collection {collection} {filename}')
+    print(f'and then run: python import.py --connection {args.connection} --restored')
+
+
+def load_regions() -> Optional[RegionAssigner]:
+    """
+    Loads the district and Bezirksregion boundaries.
+    :return: The region assigner or None if the boundaries are not available.
+    """
+    try:
+        return load_region_assigner()
+    except (ImportError, OSError, ValueError, KeyError) as e:
+        print(f'The district boundaries could not be loaded ({e}); documents are imported without districts.')
+        return None
+
+
+def open_locations(directory: str, checkpoint: Optional[Dict[str, Any]],
+                   source: Dict[str, Any]) -> NodeLocationStore:
+    """
+    Creates the node location store or, when resuming, opens the one of the interrupted import;
+    a LocationStoreException is raised if it is not available.
+    :param directory: The store directory.
+    :param checkpoint: The checkpoint to resume from, if any.
+    :param source: The description of the input file.
+    :return: The store.
+    """
+    if checkpoint is None:
+        return NodeLocationStore(directory, source=source)
+    if checkpoint['type'] == 'node':
+        # The nodes up to the checkpoint were saved along with it.
+        return NodeLocationStore.resume(directory, source=source)
+    return NodeLocationStore.open(directory, source=source)
+
+
+def import_sequential(f: InputFile, writer: Union[BulkWriter, DumpWriter], progress: tqdm,
+                      checkpoint: Optional[Dict[str, Any]] = None, checkpointer: Optional[Checkpointer] = None,
+                      locations: Optional[NodeLocationStore] = None, metrics: Optional[PipelineMetrics] = None):
+    # Elements are only complete at their end event.
+    events = parse_input(f, events=('start', 'end'), progress=progress)
+    validate_osm_version(events)
+    if checkpoint is not None:
+        events = skip_committed(events, checkpoint)
+
+    # The stages are timed between consecutive elements; recording the node locations counts as parsing.
+    timed = metrics is not None
+    last = time.perf_counter() if timed else 0.
+    for ev, el in events:
+        if ev != 'end' or (el.tag != 'node' and el.tag != 'way' and el.tag != 'relation'):
+            continue
+
+        if locations is not None and not locations.finished:
+            if el.tag == 'node':
+                locations.add(int(el.attrib['id']), el.attrib['lat'], el.attrib['lon'])
+            else:
+                # All nodes precede the ways.
+                locations.finish()
+
+        if timed:
+            now = time.perf_counter()
+            metrics.add('parse', now - last)
+            metrics.count(el.tag)
+            last = now
+
+        for audit in auto_audit:
+            el = audit(el)
+            if el is None:
+                break
+        if timed:
+            now = time.perf_counter()
+            metrics.add('audit', now - last)
+            last = now
+        if el is None:
+            continue
+
+        id, doc = elem_to_doc(el, locations if el.tag == 'way' else None)
+        if timed:
+            now = time.perf_counter()
+            metrics.add('convert', now - last)
+            last = now
+        writer.add(id, doc)
+        if timed:
+            now = time.perf_counter()
+            metrics.add('write', now - last)
+            last = now
 
+        # Checkpoints can only be taken directly after a batch was written.
+        if checkpointer is not None and writer.pending == 0:
+            checkpointer.committed(el.tag, int(el.attrib['id']), f.resume_point(), writer.documents_written)
+            if timed:
+                last = time.perf_counter()
 
-def parse_date(inp: str) -> datetime:
-    # 2015-11-15T09:51:47Z
-    return datetime.strptime(inp, '%Y-%m-%dT%H:%M:%SZ')
-
-
-def elem_to_doc(el: Element) -> Tuple[Dict, Dict]:
-    id = {
-            'type': el.tag,
-            'id': bson.Int64(el.attrib['id'])
-        }
-
-    time = parse_date(el.attrib['timestamp'])
-    user = {
-                'name': el.attrib['user'],
-                'id': el.attrib['uid']
-            }
-
-    doc = {}
-    if el.tag == 'node':
-        doc = {
-            't': time,
-            'user': user,
-            'loc': {
-                'type': 'Point',
-                'coordinates': [
-                    float(el.attrib['lon']),
-                    float(el.attrib['lat'])
-                ]
-            }
-        }
-    elif el.tag == 'way':
-        doc = {
-            't': time,
-            'user': user,
-            'nodes': [bson.Int64(x.attrib['ref']) for x in el.iter('nd')]
-        }
-    elif el.tag == 'relation':
-        doc = {
-            't': time,
-            'user': user,
-            'members': [
-                {
-                    'type': x.attrib['type'],
-                    'ref': bson.Int64(x.attrib['ref']),
-                    'role': x.attrib['role']
-                }
-                for x in el.iter('member')
-            ]
-        }
-
-    tags = {}
-    for tag in el.iter('tag'):
-        key = tag.attrib['k']
-        value = tag.attrib['v']
-        tags[key] = value
-
-    if len(tags) > 0:
-        doc['tags'] = tags
-        doc['tag_keys'] = list(tags.keys())
-        doc['tag_values'] = '\n'.join(list(tags.values()))
-
-    return id, doc
+    start = time.perf_counter()
+    writer.close()
+    if timed:
+        metrics.add('write', time.perf_counter() - start, 0)
 
 
 if __name__ == '__main__':
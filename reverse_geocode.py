@@ -0,0 +1,79 @@
+"""
+This script finds the closest address of each coordinate in a CSV file of longitudes and latitudes,
+e.g. GPS points, and reports the throughput in points per second.
+"""
+
+import os
+import csv
+import sys
+import time
+from argparse import ArgumentParser
+
+import pymongo
+from data_wrangling.queries import get_closest_addresses, DEFAULT_TREE_THRESHOLD, DEFAULT_QUERY_WORKERS
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('file', help='A CSV file with the longitude and latitude of a point per line.')
+    parser.add_argument('--out', default=None,
+                        help='The CSV file to write the addresses to; defaults to the standard output.')
+    parser.add_argument('--connection', default='mongodb://localhost:27017/dand',
+                        help='The MongoDB connection string.')
+    parser.add_argument('--tree-threshold', type=int, default=DEFAULT_TREE_THRESHOLD,
+                        help='The number of points from which the addresses are loaded into an in-memory tree.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_QUERY_WORKERS,
+                        help='The number of concurrent queries for smaller batches.')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file) or not os.path.isfile(args.file):
+        parser.error(f'The specified argument is not a valid file: {args.file}')
+        exit(1)
+    if args.workers < 1:
+        parser.error('The number of workers must be positive.')
+        exit(1)
+
+    coordinates = read_coordinates(args.file)
+
+    client = pymongo.MongoClient(args.connection, maxPoolSize=max(100, args.workers))
+    collection = client.get_default_database().get_collection('osm_berlin')
+
+    start = time.perf_counter()
+    addresses = get_closest_addresses(collection, coordinates,
+                                      tree_threshold=args.tree_threshold, workers=args.workers)
+    elapsed = time.perf_counter() - start
+
+    if args.out is not None:
+        with open(args.out, 'w', newline='', encoding='utf-8') as f:
+            write_addresses(f, coordinates, addresses)
+    else:
+        write_addresses(sys.stdout, coordinates, addresses)
+
+    print(f'Resolved {len(coordinates)} points in {elapsed:.2f} s '
+          f'({len(coordinates) / max(elapsed, 1e-9):.0f} points/s).', file=sys.stderr)
+
+
+def write_addresses(f, coordinates, addresses):
+    writer = csv.writer(f)
+    writer.writerow(['lon', 'lat', 'street', 'house_no', 'distance_meters'])
+    for (lon, lat), address in zip(coordinates, addresses):
+        writer.writerow([lon, lat, address['addr']['street'], address['addr']['house_no'],
+                         f'{address["distance_meters"]:.1f}'])
+
+
+def read_coordinates(filename: str):
+    coordinates = []
+    with open(filename, 'r', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2:
+                continue
+            try:
+                coordinates.append([float(row[0]), float(row[1])])
+            except ValueError:
+                # A header line.
+                continue
+    return coordinates
+
+
+if __name__ == '__main__':
+    main()
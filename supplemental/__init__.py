@@ -1,11 +1,14 @@
 import os
 import json
-from typing import Dict, Any, Optional, Union
+from typing import Dict, Any, Optional, Union, Sequence
 from area import area
 
 
 GeoJSON = Dict[str, Any]
 
+# The feature properties that may hold the name of a Bezirksregion, in order of preference.
+REGION_NAME_PROPERTIES = ('bzr_name', 'BZR_NAME', 'bezirksregion', 'name')
+
 
 def get_district_geojson(district: Optional[str] = None) -> Union[Dict[str, GeoJSON], GeoJSON]:
     """
@@ -13,12 +16,34 @@ def get_district_geojson(district: Optional[str] = None) -> Union[Dict[str, GeoJ
     :param district: The optional district to return; if None, all are returned.
     :return: The district or dictionary of districts.
     """
+    districts = _load_features('berlin_bezirke_osm_mh.geojson', ('name',))
+    return districts if district is None else districts[district]
+
+
+def get_region_geojson(region: Optional[str] = None,
+                       name_properties: Sequence[str] = REGION_NAME_PROPERTIES) -> Union[Dict[str, GeoJSON], GeoJSON]:
+    """
+    Gets the Berlin neighbourhood regions (Bezirksregionen) or a single one of them.
+    :param region: The optional region to return; if None, all are returned.
+    :param name_properties: The feature properties to take the region name from; the first one present is used.
+    :return: The region or dictionary of regions.
+    """
+    regions = _load_features('lor_bezirksregionen_berlin.geojson', name_properties)
+    return regions if region is None else regions[region]
+
+
+def _load_features(filename: str, name_properties: Sequence[str]) -> Dict[str, GeoJSON]:
     dir = os.path.dirname(os.path.realpath(__file__))
-    file = os.path.join(dir, 'berlin_bezirke_osm_mh.geojson')
+    file = os.path.join(dir, filename)
     with open(file, 'r') as f:
         data = json.load(f)['features']
-    districts = {d['properties']['name']: d['geometry'] for d in data}
-    return districts if district is None else districts[district]
+    features = {}
+    for d in data:
+        names = [d['properties'][p] for p in name_properties if d['properties'].get(p) is not None]
+        if len(names) == 0:
+            raise KeyError(f'Found a feature without any of the properties {", ".join(name_properties)} in {filename}.')
+        features[names[0]] = d['geometry']
+    return features
 
 
 def geojson_area(geojson: GeoJSON, scale: float = 1.0) -> float:
@@ -0,0 +1,94 @@
+"""
+This script runs several analyses of an OpenStreetMap XML file in a single pass
+and writes the report of each analysis to a separate text file.
+"""
+
+import os
+import importlib
+from argparse import ArgumentParser
+
+from tqdm import tqdm
+
+from data_wrangling.xml_processing import open_and_parse, scan
+from data_wrangling.surveys import ANALYZERS
+
+
+def load_analyzer(spec: str):
+    """
+    Loads a user-supplied analyzer class.
+    :param spec: The analyzer, given as module:ClassName.
+    :return: The analyzer class.
+    """
+    module_name, _, class_name = spec.partition(':')
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('file', nargs='?',
+                        default=os.path.join('osm-extracts', 'berlin.osm.bz2'),
+                        help='The OSM map file to scan.')
+    parser.add_argument('--analyses', nargs='+', choices=sorted(ANALYZERS.keys()),
+                        default=sorted(ANALYZERS.keys()),
+                        help='The built-in analyses to run.')
+    parser.add_argument('--analyzer', action='append', default=[],
+                        help='An additional analyzer class given as module:ClassName; '
+                             'see data_wrangling/surveys.py for the expected interface.')
+    parser.add_argument('--out-dir', default='.',
+                        help='The directory to write the reports to.')
+    parser.add_argument('--decompress-workers', type=int, default=os.cpu_count(),
+                        help='The number of processes used to decompress bzip2 files.')
+    parser.add_argument('--backend', choices=('lxml', 'expat'), default='lxml',
+                        help='The parser to use; expat only reports element names and attributes and is faster.')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file) or not os.path.isfile(args.file):
+        parser.error(f'The specified argument is not a valid file: {args.file}')
+        exit(1)
+
+    try:
+        classes = [ANALYZERS[name] for name in args.analyses] + [load_analyzer(spec) for spec in args.analyzer]
+    except (ImportError, AttributeError, ValueError) as e:
+        parser.error(f'Unable to load analyzer: {e}')
+        exit(1)
+    analyzers = [cls() for cls in classes]
+
+    starts = [analyzer.start for analyzer in analyzers]
+    ends = [analyzer.end for analyzer in analyzers if analyzer.end is not None]
+
+    def start(name, attrs):
+        for fn in starts:
+            fn(name, attrs)
+
+    def end(name):
+        for fn in ends:
+            fn(name)
+
+    progress = tqdm(desc='Surveying')
+    if args.backend == 'expat':
+        scan(args.file, start=start, end=end, progress=progress,
+             decompress_workers=args.decompress_workers, osm_version='0.6')
+    else:
+        events = open_and_parse(args.file, events=('start', 'end'), progress=progress,
+                                decompress_workers=args.decompress_workers)
+        for ev, el in events:
+            if ev == 'start':
+                if el.tag == 'osm':
+                    assert 'version' in el.attrib and el.attrib['version'] == '0.6', \
+                        'Unknown version of the OSM format.'
+                start(el.tag, el.attrib)
+            else:
+                end(el.tag)
+    progress.close()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for analyzer in analyzers:
+        filename = os.path.join(args.out_dir, f'{analyzer.name}.txt')
+        with open(filename, 'w', encoding='utf-8') as f:
+            analyzer.write_report(f)
+        print(f'Wrote {filename}')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,7 @@ import os
 
 from argparse import ArgumentParser
 
-from data_wrangling.auditing import audit_street_name
+from data_wrangling.auditing import audit_street_name, memoized_street_name_audit
 
 
 def main():
@@ -15,16 +15,22 @@ def main():
     parser.add_argument('file', nargs='?',
                         default='street_names.txt',
                         help='The street name file to use.')
+    parser.add_argument('--cache', default=None,
+                        help='A file to keep the audit results in between runs.')
+    parser.add_argument('--no-memoize', action='store_true',
+                        help='Audit every name, even if it was seen before.')
     args = parser.parse_args()
 
     if not os.path.exists(args.file) or not os.path.isfile(args.file):
         parser.error(f'The specified argument is not a valid file: {args.file}')
         exit(1)
 
+    audit = audit_street_name if args.no_memoize else memoized_street_name_audit(cache_file=args.cache)
+
     with open(args.file, 'r', encoding='utf-8') as f:
         for line in f:
             name = line.rstrip(os.linesep)
-            was_valid, valid = audit_street_name(name)
+            was_valid, valid = audit(name)
             if valid is None:
                 print(f'  Skipped "{name}": Not a street.')
                 continue
@@ -32,6 +38,10 @@ def main():
             if not was_valid:
                 print(f'Corrected "{name}" to "{valid}".')
 
+    if audit is not audit_street_name:
+        audit.save()
+        print(f'Cache: {audit}')
+
 
 if __name__ == '__main__':
     main()